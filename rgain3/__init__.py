@@ -14,24 +14,23 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import math
 import sys
 import traceback
-from argparse import ArgumentParser
-
-import gi
-
-gi.require_version("Gst", "1.0")
-
-from gi.repository import Gst  # noqa isort:skip
-
-from rgain3.lib import GSTError, __version__  # noqa isort:skip
-from rgain3.lib.rgio import AudioFormatError, BaseFormatsMap # noqa isort:skip
+from argparse import ArgumentError, ArgumentParser
 
+from rgain3.lib import GSTError, __version__
+from rgain3.lib.rgio import AudioFormatError, BaseFormatsMap
+from rgain3.lib.sidecar import SidecarFormatsMap
 
 __all__ = [
     "Error",
     "init_gstreamer",
+    "gst_options_given",
     "common_parser",
+    "get_formats_map",
+    "PositiveIntOrNone",
+    "NonNegativeFloat",
 ]
 
 
@@ -49,9 +48,10 @@ class Error(Exception):
             return "".join(traceback.format_exception(*self.exc_info))
 
     def _output_full_exception(self):
-        return self.exc_info[0] not in [
+        # e.g. ConnectionRefusedError is an IOError as well
+        return not (self.exc_info[0] and issubclass(self.exc_info[0], (
             IOError, AudioFormatError, GSTError,
-        ]
+        )))
 
 
 def init_gstreamer():
@@ -60,7 +60,15 @@ def init_gstreamer():
     Specifically, GStreamer options are parsed and processed by GStreamer, but
     it is also kept from taking over the main help output (by pretending -h
     or --help wasn't passed, if necessary). --help-gst should be documented in
-    the main help output as a switch to display GStreamer options."""
+    the main help output as a switch to display GStreamer options.
+
+    GStreamer is only imported here, so that reading and writing tags doesn't
+    pay for loading it. The programs therefore call this once they know that
+    they will analyze audio, or right away if ``gst_options_given``."""
+    import gi
+    gi.require_version("Gst", "1.0")
+    from gi.repository import Gst
+
     # Strip any --help options from the command line.
     stripped_options = []
     for opt in ["-h", "--help"]:
@@ -74,6 +82,68 @@ def init_gstreamer():
         sys.argv.append(opt)
 
 
+class PositiveIntOrNone:
+    """A "type" for an argparse argument which can either be None (not present)
+    or a positive integer greater than 0.
+    """
+    def __init__(self, metavar: str):
+        self.metavar = metavar
+
+    def __call__(self, value):
+        if value is None:
+            return None
+
+        try:
+            i = int(value)
+        except ValueError as e:
+            raise ArgumentError(None, str(e)) from None
+        else:
+            if i < 1:
+                raise ArgumentError(
+                    None, "{} must be at least 1".format(self.metavar)
+                )
+        return i
+
+
+class NonNegativeFloat:
+    """A "type" for an argparse argument which is a finite number of at least
+    0, such as a number of seconds.
+    """
+    def __init__(self, metavar: str):
+        self.metavar = metavar
+
+    def __call__(self, value):
+        try:
+            f = float(value)
+        except ValueError as e:
+            raise ArgumentError(None, str(e)) from None
+        if not (math.isfinite(f) and f >= 0):
+            raise ArgumentError(
+                None, "{} must be a number of at least 0".format(self.metavar)
+            )
+        return f
+
+
+def gst_options_given(argv=None) -> bool:
+    """Return whether the command line ``argv`` (``sys.argv`` by default)
+    contains GStreamer options, which ``init_gstreamer`` has to process before
+    the rest can be parsed."""
+    if argv is None:
+        argv = sys.argv
+    return any(arg.startswith("--gst-") or arg in ("--help-gst", "--help-all")
+               for arg in argv[1:])
+
+
+def get_formats_map(mp3_format=None, sidecar_db=None) -> BaseFormatsMap:
+    """Return the formats map for the given command-line options: Replay Gain
+    information is stored in the SQLite database `sidecar_db` if given, or in
+    the tags of the audio files otherwise.
+    """
+    if sidecar_db:
+        return SidecarFormatsMap(sidecar_db, mp3_format)
+    return BaseFormatsMap(mp3_format)
+
+
 def common_parser(**kwargs) -> ArgumentParser:
     """Create a new ArgumentParser instance with default arguments that are
     used both by `replaygain` and `collectiongain`.
@@ -123,6 +193,30 @@ def common_parser(**kwargs) -> ArgumentParser:
         "so it is generally not necessary to mess with this setting. Check the "
         "README or man page for more information.",
     )
+    parser.add_argument(
+        "--sidecar-db",
+        type=str,
+        dest="sidecar_db",
+        metavar="DB",
+        help="Don't store Replay Gain information in the audio files, but in "
+        "the SQLite database DB, keyed by path. Useful for libraries on "
+        "read-only or slow storage.",
+    )
+    parser.add_argument(
+        "--atomic",
+        dest="atomic",
+        action="store_true",
+        help="Write the Replay Gain information of an album all at once: The "
+        "tags are written to temporary copies of the files, which only replace "
+        "the original files once all of them were written successfully.",
+    )
+    parser.add_argument(
+        "--fsync",
+        dest="fsync",
+        action="store_true",
+        help="Flush written files to disk once per album before they replace "
+        "the original files. Implies '--atomic'.",
+    )
     # This option only exists to show up in the help output; if it's actually
     # specified, GStreamer should eat it.
     parser.add_argument(
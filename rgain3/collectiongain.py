@@ -14,22 +14,53 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import collections
 import contextlib
+import functools
 import io
-import multiprocessing
+import itertools
+import json
+import math
 import os.path
-import pickle
+import queue
+import sqlite3
 import sys
+import threading
+import time
 from argparse import ArgumentError
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
+from multiprocessing import AuthenticationError
 
 import mutagen
 
-from rgain3 import Error, common_parser, init_gstreamer
-from rgain3.lib import albumid, rgio
-from rgain3.replaygain import do_gain
+from rgain3 import (
+    Error,
+    NonNegativeFloat,
+    PositiveIntOrNone,
+    common_parser,
+    get_formats_map,
+    gst_options_given,
+    init_gstreamer,
+)
+from rgain3.lib import (
+    albumid,
+    cache,
+    inotify,
+    pipeline,
+    rgio,
+    scan,
+    schedule,
+    util,
+)
+from rgain3.lib.dispatch import Dispatcher, nonforking_context
+from rgain3.lib.remote import RemoteDispatcher, run_worker
+from rgain3.replaygain import analyze_gain, select_files
 
-CURRENT_CACHE_VERSION = 1
+# the shared secret of --coordinator and --worker
+AUTHKEY_VARIABLE = "COLLECTIONGAIN_AUTHKEY"
+# how long --watch waits for further changes of an album, in seconds
+DEFAULT_WATCH_DELAY = 10
 
 
 # all of collectiongain
@@ -41,122 +72,406 @@ def relpath(path, base):
     return path[size:]
 
 
-def cache_entry_valid(filepath, record):
-    return (
-        isinstance(filepath, str) and
-        hasattr(record, "__getitem__") and
-        hasattr(record, "__len__") and
-        len(record) == 3 and
-        (isinstance(record[0], str) or record[0] is None) and
-        (isinstance(record[1], int) or isinstance(record[1], float)) and
-        isinstance(record[2], bool))
+def read_tags(entry):
+    # Runs in a worker process; ``entry`` is a ``scan.ScanEntry``. Returns
+    # the album ID and the length of the audio, which is used to plan the
+    # jobs.
+    tags = mutagen.File(entry.path)
+    if tags is None:
+        raise ValueError("unsupported format")
+    return albumid.get_album_id(tags), getattr(tags.info, "length", None)
 
 
-def read_cache(cache_file):
-    if os.path.isfile(cache_file):
-        try:
-            with open(cache_file, "rb") as f:
-                cache = pickle.load(f)
-                if not isinstance(cache, tuple) or len(cache) != 2:
-                    print("Invalid cache, ignoring it")
-                    return {}
-                cache_version = cache[0]
-                if cache_version != CURRENT_CACHE_VERSION:
-                    print("Old cache format, ignoring it")
-                    return {}
-                files = cache[1]
-                if not isinstance(files, dict):
-                    print("Invalid cache, ignoring it")
-                    return {}
-                to_remove = set()
-                for filepath, record in files.items():
-                    if not cache_entry_valid(filepath, record):
-                        to_remove.add(filepath)
-                for filepath in to_remove:
-                    # remove fishy entries
-                    del files[filepath]
-                return files
-        except Exception as exc:
-            print(
-                "Error while reading the cache, continuing without it - %s" %
-                (exc,))
-    return {}
-
-
-def write_cache(cache_file, files):
-    cache_dir = os.path.dirname(cache_file)
-    try:
-        if not os.path.isdir(cache_dir):
-            os.makedirs(cache_dir, 0o755)
-        with open(cache_file, "wb") as f:
-            pickle.dump((CURRENT_CACHE_VERSION, files), f, 2)
-    except Exception as exc:
-        print("Error while writing the cache - %s" % exc)
-
-
-def collect_files(music_dir, files, visited_cache, is_supported):
-    i = 0
-    for dirpath, dirnames, filenames in os.walk(music_dir):
-        for filename in filenames:
-            filepath = relpath(os.path.join(dirpath, filename), music_dir)
-            properpath = os.path.join(dirpath, filename)
-            mtime = os.path.getmtime(properpath)
-
-            # check the cache
-            if filepath in visited_cache:
-                visited_cache[filepath] = True
-                record = files[filepath]
-                if mtime <= record[1]:
-                    # the file's still ok
-                    continue
-
-            if is_supported(properpath):
-                i += 1
-                print("  [%i] %s |" % (i, filepath), end='')
-                try:
-                    tags = mutagen.File(os.path.join(music_dir, filepath))
-                    if tags is None:
-                        raise Exception()
-                    album_id = albumid.get_album_id(tags)
-                    print(album_id or "<single track>")
-                    # fields here: album_id, mtime, already_processed
-                    files[filepath] = (album_id, mtime, False)
-                except Exception:
-                    # TODO: Maybe optionally abort here?
-                    print("IGNORED: unreadable file or unsupported format")
+def _ancestors(reldir):
+    # ``reldir`` and all directories above it, up to the music directory ("")
+    while True:
+        yield reldir
+        if not reldir:
+            return
+        reldir = os.path.dirname(reldir)
+
+
+def _changed_files(music_dir, files, is_supported, fast, on_subtree=None):
+    # The directory tree is read in parallel; the stat result of each file
+    # is reused for the whole run.
+    for entry in scan.scan_tree(music_dir, dirs=files, fast=fast,
+                                subtrees=on_subtree is not None):
+        if isinstance(entry, scan.SubtreeDone):
+            on_subtree(entry.reldir)
+            continue
+        if isinstance(entry, scan.SkippedDir):
+            # nothing has been added to or removed from this directory
+            files.mark_dir_visited(entry.reldir)
+            continue
+        if rgio.is_staged_file(entry.path):
+            # a temporary file of an interrupted write, not part of the music
+            # collection
+            continue
+        st = entry.stat
+
+        # check the cache
+        record = files.get(entry.relpath)
+        if record is not None:
+            files.mark_visited(entry.relpath)
+            # Inode numbers are only relied upon by the fast scan, which
+            # needs stable ones for directories anyway.
+            if cache.entry_unchanged(record, st, check_inode=fast):
+                # the file's still ok
+                if record.size is None:
+                    # complete an entry of an old cache
+                    files[entry.relpath] = record._replace(
+                        mtime=st.st_mtime_ns, size=st.st_size,
+                        inode=st.st_ino)
+                continue
+
+        if is_supported(entry.path):
+            yield entry
+
+
+def collect_files(music_dir, files, is_supported, fast=False, jobs=0,
+                  on_subtree_done=None, executor=None):
+    """Scan ``music_dir`` and store an entry for every new or changed file in
+    the cache ``files``.
+
+    If given, ``on_subtree_done(reldir)`` is called for every directory once
+    the entries of all files in it and its subdirectories have been stored.
+    Tags are read on the process pool ``executor`` if given, which must have
+    been started before any other threads (see ``util.start_process_pool``);
+    otherwise, a pool of ``jobs`` workers is started here.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    # the number of files in each subtree whose tags are still being read
+    outstanding = collections.Counter()
+    # subtrees which have been scanned completely
+    scanned = []
+
+    def report():
+        still_reading = []
+        for reldir in scanned:
+            if outstanding[reldir]:
+                still_reading.append(reldir)
+            else:
+                on_subtree_done(reldir)
+        scanned[:] = still_reading
+
+    def subtree_scanned(reldir):
+        scanned.append(reldir)
+        report()
+
+    def changed_files():
+        for entry in _changed_files(
+                music_dir, files, is_supported, fast,
+                subtree_scanned if on_subtree_done else None):
+            outstanding.update(_ancestors(os.path.dirname(entry.relpath)))
+            yield entry
+
+    if executor is None:
+        # the workers are started before the scan threads
+        pool = util.start_process_pool(jobs)
+    else:
+        # the caller shuts its own executor down
+        pool = contextlib.nullcontext(executor)
+    with pool as executor:
+        # Tags are read by the workers while the scan goes on; the results
+        # come back in no particular order.
+        results = util.bounded_map(
+            read_tags, changed_files(), jobs, ordered=False,
+            executor=executor)
+        for i, (entry, result, exc) in enumerate(results, 1):
+            if exc is not None:
+                # TODO: Maybe optionally abort here?
+                print("  [%i] %s |IGNORED: unreadable file or unsupported "
+                      "format" % (i, entry.relpath))
+            else:
+                album_id, length = result
+                print("  [%i] %s |%s" % (
+                    i, entry.relpath, album_id or "<single track>"))
+                st = entry.stat
+                files[entry.relpath] = cache.CacheEntry(
+                    album_id, st.st_mtime_ns, False, st.st_size, st.st_ino,
+                    length)
+            outstanding.subtract(_ancestors(os.path.dirname(entry.relpath)))
+            if scanned:
+                report()
 
 
 def transform_cache(files):
     # transform ``files`` into lists of things to process
     albums = {}
+    unprocessed_albums = set()
     single_tracks = []
-    for filepath, (album_id, mtime, processed) in files.items():
+    for filepath, record in files.items():
+        album_id = record.album_id
         if album_id is not None:
             albums.setdefault(album_id, []).append(filepath)
-        else:
+            if not record.processed:
+                unprocessed_albums.add(album_id)
+        elif not record.processed:
             single_tracks.append(filepath)
 
-    # purge anything that's marked as processed
-    for album_id, album_files in list(albums.items()):
-        keep = False
-        for filepath in album_files:
-            if not files[filepath][2]:
-                keep = True
-                break
-        if not keep:
-            del albums[album_id]
+    # purge albums that are completely marked as processed
+    albums = {
+        album_id: album_files for album_id, album_files in albums.items()
+        if album_id in unprocessed_albums
+    }
+    return albums, single_tracks
 
-    for filepath in single_tracks[:]:
-        if files[filepath][2]:
-            single_tracks.remove(filepath)
 
-    return albums, single_tracks
+def job_costs(files, albums, single_tracks):
+    # the estimated time it takes to analyze every file of the jobs, as
+    # returned by ``transform_cache``; other entries of ``files`` aren't read
+    def records():
+        for filepath in itertools.chain(single_tracks, *albums.values()):
+            record = files[filepath]
+            yield filepath, record.length, record.size
+
+    return schedule.estimate_costs(records())
+
+
+def stream_jobs(music_dir, files, is_supported, fast=False, jobs=0,
+                executor=None, shard=None):
+    """Return a ``dispatch`` function for ``run_jobs`` which collects the files
+    in ``music_dir`` and submits the jobs of every top-level directory as soon
+    as it has been scanned completely.
+
+    ``dispatch`` runs alongside other threads, so the process pool
+    ``executor`` the tags are read on should be started beforehand, see
+    ``collect_files``; otherwise, ``dispatch`` starts one which isn't forked
+    from this process. With ``shard``, only the jobs of that shard are
+    submitted, see ``schedule.select_shard``.
+
+    Albums are expected not to span several top-level directories. Those
+    that do are submitted again with all of their files once the whole music
+    directory has been scanned.
+    """
+    def dispatch(submit):
+        # the tracks submitted for every album
+        submitted = {}
+        submitted_singles = set()
+
+        def submit_new(records, skip_albums):
+            albums, single_tracks = schedule.select_shard(
+                *transform_cache(records), shard)
+            albums = {
+                album_id: tracks for album_id, tracks in albums.items()
+                if album_id not in skip_albums and
+                submitted.get(album_id) != set(tracks)
+            }
+            single_tracks = [
+                path for path in single_tracks
+                if path not in submitted_singles
+            ]
+            submitted.update(
+                (album_id, set(tracks)) for album_id, tracks in albums.items())
+            submitted_singles.update(single_tracks)
+            costs = job_costs(records, albums, single_tracks)
+            for tracks, album_id in schedule.plan_jobs(
+                    albums, single_tracks, costs, workers):
+                submit(tracks, album_id)
+
+        def on_subtree_done(reldir):
+            if not reldir or os.path.dirname(reldir):
+                return
+            # an album seen before spans several top-level directories
+            submit_new(dict(files.visited_items(reldir)), submitted)
+
+        if executor is None:
+            pool = util.start_process_pool(
+                workers, mp_context=nonforking_context())
+        else:
+            # the caller shuts its own executor down
+            pool = contextlib.nullcontext(executor)
+        with pool as tag_reader:
+            collect_files(music_dir, files, is_supported, fast, jobs,
+                          on_subtree_done, tag_reader)
+        files.purge_unvisited()
+        # whatever is left: files in ``music_dir`` itself and albums in
+        # several directories
+        submit_new(files, ())
+
+    workers = jobs or os.cpu_count() or 1
+
+    return dispatch
+
+
+def _read_changed(music_dir, relpath, is_supported):
+    # The album ID (or the path of a single track) a changed file belongs
+    # to, and its album ID and length; None if it isn't a music file
+    # (anymore).
+    path = os.path.join(music_dir, relpath)
+    if rgio.is_staged_file(path) or not is_supported(path):
+        return None
+    try:
+        album_id, length = read_tags(scan.ScanEntry(relpath, path, None))
+    except Exception:
+        return None
+    return album_id or relpath, (album_id, length)
+
+
+def _submit_changed(music_dir, files, changed_files, submit, force=False):
+    # Store new entries for the ``changed_files`` of an album or a single
+    # track, see ``_read_changed``, and submit it unless it has been
+    # processed already (or ``force`` is true).
+    album_id = None
+    for relpath, (album_id, length) in changed_files.items():
+        try:
+            st = os.stat(os.path.join(music_dir, relpath))
+        except OSError:
+            continue
+        record = files.get(relpath)
+        if record is not None and cache.entry_unchanged(record, st):
+            # e.g. the tags have just been written by this program
+            if force and album_id is None:
+                submit([relpath], None)
+            continue
+        print("  %s |%s" % (relpath, album_id or "<single track>"))
+        files[relpath] = cache.CacheEntry(
+            album_id, st.st_mtime_ns, False, st.st_size, st.st_ino, length)
+        if album_id is None:
+            submit([relpath], None)
+    if album_id is not None:
+        tracks = list(files.album_items(album_id))
+        if force or not all(record.processed for _, record in tracks):
+            submit([path for path, _ in tracks], album_id)
+
+
+def watch_jobs(music_dir, files, is_supported, watcher, dispatch_all,
+               shard=None, delay=DEFAULT_WATCH_DELAY, stop=None):
+    """Return a ``dispatch`` function for ``run_jobs`` which processes the
+    whole music directory with ``dispatch_all`` (e.g. ``stream_jobs``) and
+    then goes on submitting the albums whose files ``watcher``, an
+    ``inotify.TreeWatcher`` of ``music_dir``, reports as changed.
+
+    An album is submitted once none of its files has changed for ``delay``
+    seconds, e.g. after all of it has been copied. ``dispatch`` only returns
+    once the ``threading.Event`` ``stop`` is set.
+    """
+    def dispatch(submit):
+        dispatch_all(submit)
+        print("Watching %s for changes ..." % music_dir)
+        # For every album (or single track) with changed files, when it's
+        # due and the changed files, see ``_read_changed``.
+        pending = {}
+
+        while stop is None or not stop.is_set():
+            now = time.monotonic()
+            for key, (due, changed_files) in list(pending.items()):
+                if due <= now:
+                    del pending[key]
+                    _submit_changed(music_dir, files, changed_files,
+                                    submit)
+            files.flush()
+            # wake up regularly to check ``stop``
+            timeout = min([due for due, _ in pending.values()] + [now + 1])
+            for change in watcher.changes(max(0, timeout - now)):
+                if change.kind == inotify.RESCAN:
+                    print("Missed some changes, scanning %s again ..." %
+                          music_dir)
+                    files.begin_scan()
+                    dispatch_all(submit)
+                elif change.kind == inotify.REMOVED:
+                    files.remove_tree(change.relpath)
+                    prefix = os.path.join(change.relpath, "")
+                    for _, changed_files in pending.values():
+                        for path in list(changed_files):
+                            if path == change.relpath or \
+                                    path.startswith(prefix):
+                                del changed_files[path]
+                else:
+                    result = _read_changed(music_dir, change.relpath,
+                                           is_supported)
+                    if result is None:
+                        continue
+                    key, info = result
+                    if shard is None or schedule.in_shard(key, shard):
+                        _, changed_files = pending.get(key, (None, {}))
+                        changed_files[change.relpath] = info
+                        pending[key] = (time.monotonic() + delay,
+                                        changed_files)
+
+    return dispatch
+
+
+def read_change_list(stream, null=False):
+    """Return the paths in ``stream``, a binary file, one per line or, if
+    ``null`` is true, separated by NUL characters."""
+    separator = b"\0" if null else b"\n"
+    return [os.fsdecode(path) for path in stream.read().split(separator)
+            if path]
+
+
+def _change_relpath(music_dir, path):
+    # ``path`` relative to ``music_dir``, which relative paths are already;
+    # None if it's outside of ``music_dir``.
+    if os.path.isabs(path):
+        path = os.path.relpath(path, os.path.abspath(music_dir))
+    path = os.path.normpath(path)
+    if path == os.pardir or path.startswith(os.path.join(os.pardir, "")):
+        return None
+    return "" if path == os.curdir else path
+
+
+def change_list_jobs(music_dir, files, is_supported, paths, shard=None,
+                     force=False):
+    """Return a ``dispatch`` function for ``run_jobs`` which, instead of
+    scanning ``music_dir``, only updates the cache entries of ``paths`` and
+    submits the albums (or single tracks) they belong to, along with the
+    other files of these albums in the cache.
 
+    ``paths`` are relative to ``music_dir`` or absolute; directories stand
+    for all files below them, and paths which don't exist anymore are
+    removed from the cache.
+    """
+    def changed_paths():
+        for path in paths:
+            relpath = _change_relpath(music_dir, path)
+            if relpath is None:
+                print("Skipping %s, which is not in %s" % (path, music_dir))
+                continue
+            fullpath = os.path.join(music_dir, relpath)
+            if os.path.isdir(fullpath):
+                for dirpath, _, filenames in os.walk(fullpath):
+                    reldir = os.path.relpath(dirpath, music_dir)
+                    for name in filenames:
+                        yield os.path.normpath(os.path.join(reldir, name))
+            elif os.path.lexists(fullpath):
+                yield relpath
+            else:
+                files.remove_tree(relpath)
+
+    def dispatch(submit):
+        # the changed files of every album (or single track), see
+        # ``_read_changed``
+        changed = {}
+        for relpath in changed_paths():
+            result = _read_changed(music_dir, relpath, is_supported)
+            if result is None:
+                continue
+            key, info = result
+            if shard is None or schedule.in_shard(key, shard):
+                changed.setdefault(key, {})[relpath] = info
+        for changed_files in changed.values():
+            _submit_changed(music_dir, files, changed_files, submit, force)
+
+    return dispatch
 
-def update_cache(files, music_dir, tracks, album_id):
+
+def update_cache(files, music_dir, tracks, album_id, modified=(), gains=None):
+    # Only files which have been written to need to be checked again; for all
+    # others, the stat result found while collecting is still valid. ``gains``
+    # maps paths to the ``(trackdata, albumdata, analyzed)`` of the files,
+    # see ``cache.CacheEntry``.
     for filepath in tracks:
-        mtime = os.path.getmtime(os.path.join(music_dir, filepath))
-        files[filepath] = (album_id, mtime, True)
+        record = files[filepath]._replace(album_id=album_id, processed=True)
+        if gains and filepath in gains:
+            trackdata, albumdata, analyzed = gains[filepath]
+            record = record._replace(track_gain=trackdata,
+                                     album_gain=albumdata, analyzed=analyzed)
+        if filepath in modified:
+            st = os.stat(os.path.join(music_dir, filepath))
+            record = record._replace(
+                mtime=st.st_mtime_ns, size=st.st_size, inode=st.st_ino)
+        files[filepath] = record
 
 
 @contextlib.contextmanager
@@ -172,150 +487,684 @@ def stdstreams(stdout, stderr):
         sys.stderr = old_stderr
 
 
-def do_gain_async(queue, job_key, files, ref_level, force, dry_run, album,
-                  mp3_format):
+def check_job(formats_map, files, album_id, force):
+    # Runs on a thread of the driver process. Returns the output, an error
+    # message, the files which need to be analyzed and a dict of the
+    # ``(trackdata, albumdata)`` found in the tags of the files.
+    output = io.StringIO()
+    found = {}
+    try:
+        if album_id is not None:
+            print("%s:" % album_id, end='', file=output)
+        files = select_files(formats_map, files, force, album_id is not None,
+                             output, found.__setitem__)
+        if not files:
+            print("Nothing to do.", file=output)
+    except Exception as exc:
+        return output.getvalue(), str(exc), None, None
+    return output.getvalue(), None, files, found
+
+
+def check_jobs(formats_map, music_dir, job_keys, force, read_jobs):
+    # Check the ``(tracks, album_id)`` jobs in ``job_keys`` on ``read_jobs``
+    # threads. Yields ``(job_key, output, exc, files, gains)`` for every job
+    # as soon as it has been checked, even while ``job_keys`` waits for more
+    # jobs (e.g. in watch mode); ``gains`` is meant for ``update_cache``. At
+    # most ``2 * read_jobs`` jobs are pending.
+    results = queue.Queue()
+    slots = threading.Semaphore(2 * max(1, read_jobs))
+
+    def check(job_key):
+        tracks, album_id = job_key
+        try:
+            output, exc, todo, found = check_job(
+                formats_map, [os.path.join(music_dir, path) for path in tracks],
+                album_id, force)
+            gains = {relpath(filename, music_dir): (trackdata, albumdata, None)
+                     for filename, (trackdata, albumdata)
+                     in (found or {}).items()}
+            result = job_key, output, exc, todo, gains
+        except Exception as error:
+            result = job_key, "", str(error) or repr(error), None, None
+        results.put(result)
+
+    def feed():
+        try:
+            with ThreadPoolExecutor(max(1, read_jobs)) as pool:
+                for job_key in job_keys:
+                    slots.acquire()
+                    pool.submit(check, job_key)
+        finally:
+            results.put(None)
+
+    threading.Thread(target=feed, daemon=True).start()
+    for result in iter(results.get, None):
+        slots.release()
+        yield result
+
+
+def submit_checked(checked, dispatcher, finish, superseded, *job_args,
+                   job_dir=None):
+    # Hand the jobs yielded by ``check_jobs`` which need to be analyzed over
+    # to the workers of ``dispatcher``; the others are finished right away.
+    # If ``job_dir`` is given, the workers get paths relative to it.
+    for job_key, output, exc, todo, gains in checked:
+        if superseded(job_key):
+            continue
+        if exc or not todo:
+            finish(job_key, output, exc, gains=gains)
+        else:
+            if job_dir is not None:
+                todo = [relpath(filename, job_dir) for filename in todo]
+            # blocks while enough jobs are in flight
+            dispatcher.submit((job_key, output, gains), do_gain_job, todo,
+                              job_key[1], *job_args)
+
+
+def write_results(dispatcher, writer, finish, superseded, on_written,
+                  dry_run=False, music_dir=""):
+    # Hand the results of the workers of ``dispatcher`` over to ``writer``,
+    # which calls ``on_written`` once the tags are written, along with the
+    # gains of the job for ``update_cache``. Failed jobs and those of a dry
+    # run are finished right away. Relative paths in the results are relative
+    # to ``music_dir``.
+    for (job_key, output, gains), future in dispatcher.completed():
+        try:
+            job_output, exc, result = future.result()
+        except Exception as e:
+            # e.g. the worker process died
+            job_output, exc, result = "", str(e) or repr(e), None
+        output += job_output
+        if superseded(job_key):
+            continue
+        if exc or result is None or dry_run:
+            finish(job_key, output, exc)
+            continue
+        tracks_data, albumdata = result
+        items = [(os.path.join(music_dir, filename), trackdata, albumdata)
+                 for filename, trackdata in tracks_data.items()]
+        # the files which have been analyzed override the tags read before
+        analyzed = time.time()
+        gains = dict(gains or {})
+        for filename, trackdata, _ in items:
+            gains[relpath(filename, music_dir)] = (
+                trackdata, albumdata, analyzed)
+        writer.submit(items, functools.partial(
+            on_written, job_key, output, items, gains))
+
+
+def do_gain_job(files, album_id, ref_level, mp3_format, sidecar_db=None):
+    # Runs in a worker process; ``album_id`` is None for single tracks.
+    # ``files`` have been checked by ``check_job`` already.
     output = io.StringIO()
     try:
         with stdstreams(output, output):
-            if album:
-                print("%s:" % job_key[1], end='')
-            do_gain(files, ref_level, force, dry_run, album, mp3_format)
-            print("")
+            # Tags are written by the driver process, so that this worker can
+            # move on to the next job in the meantime.
+            with get_formats_map(mp3_format, sidecar_db) as formats_map:
+                result = analyze_gain(formats_map, files, ref_level, True,
+                                      album_id is not None)
     except BaseException as exc:
         # We can't reliably serialise and pass the exception information to the
         # driver process so we stringify it here.
         # And yes, we want to catch KeyboardInterrupt et al.
-        queue.put((job_key, output.getvalue(), str(exc)))
-    else:
-        queue.put((job_key, output.getvalue(), None))
+        return output.getvalue(), str(exc), None
+    return output.getvalue(), None, result
+
+
+def format_written(items, errors):
+    failed = {result.filename for result in errors}
+    lines = ["Writing Replay Gain information to files ..."]
+    for filename, _, _ in items:
+        lines.append("  %s:%s" % (
+            filename, "failed" if filename in failed else "done"))
+    if not errors:
+        lines.append("Done")
+    return "\n".join(lines)
+
+
+def pool_options(max_jobs_per_worker, max_worker_memory):
+    # the arguments of ``Dispatcher``; pools replacing the first one (and
+    # with recycling, that one as well) aren't forked from this process, so
+    # their workers initialize GStreamer themselves
+    options = dict(initializer=init_gstreamer)
+    if max_jobs_per_worker or max_worker_memory:
+        options.update(
+            max_jobs_per_worker=max_jobs_per_worker,
+            max_worker_rss=max_worker_memory and max_worker_memory * 2 ** 20)
+    return options
+
+
+def make_dispatcher(jobs, max_jobs_per_worker, max_worker_memory,
+                    coordinator=None, authkey=None):
+    if coordinator is None:
+        return Dispatcher(jobs, **pool_options(
+            max_jobs_per_worker, max_worker_memory))
+    try:
+        dispatcher = RemoteDispatcher(coordinator, authkey)
+    except OSError as exc:
+        raise Error("Can't listen on %s:%i: %s" % (coordinator + (exc,)))
+    print("Waiting for workers on %s:%i ..." % dispatcher.address)
+    return dispatcher
+
+
+def report_workers(stats):
+    # the peak memory usage of the workers, e.g. to size containers
+    stats = [s for s in stats if s.peak_rss is not None]
+    if stats:
+        print("Peak memory usage of the worker processes:")
+    for s in stats:
+        print("  %i: %.1f MiB (%i jobs)" % (
+            s.pid, s.peak_rss / 2 ** 20, s.jobs))
+
+
+def all_jobs(files, albums, single_tracks, jobs=0):
+    """Return a ``dispatch`` function for ``run_jobs`` which submits the jobs
+    of ``albums`` and ``single_tracks``, as returned by
+    ``transform_cache``."""
+    def dispatch(submit):
+        # Longest jobs first, so that no long album is left over for the end
+        # when the other workers are idle already. Single tracks are split
+        # into chunks for the same reason.
+        costs = job_costs(files, albums, single_tracks)
+        for tracks, album_id in schedule.plan_jobs(
+                albums, single_tracks, costs, jobs or os.cpu_count() or 1):
+            submit(tracks, album_id)
+
+    return dispatch
 
 
 def do_gain_all(music_dir, albums, single_tracks, files, ref_level=89,
                 force=False, dry_run=False, mp3_format=None, jobs=0,
-                stop_on_error=False):
-    pool = multiprocessing.Pool(None if jobs == 0 else jobs)
-    manager = multiprocessing.Manager()
-    queue = manager.Queue()
+                stop_on_error=False, atomic=False, fsync=False,
+                sidecar_db=None, checkpoint_interval=0,
+                max_jobs_per_worker=None, max_worker_memory=None,
+                read_jobs=rgio.DEFAULT_IO_JOBS, write_jobs=1,
+                coordinator=None, authkey=None):
+    run_jobs(music_dir, all_jobs(files, albums, single_tracks, jobs),
+             files, ref_level, force, dry_run,
+             mp3_format, jobs, stop_on_error, atomic, fsync, sidecar_db,
+             checkpoint_interval, max_jobs_per_worker, max_worker_memory,
+             read_jobs, write_jobs, coordinator, authkey)
+
+
+def run_jobs(music_dir, dispatch, files, ref_level=89, force=False,
+             dry_run=False, mp3_format=None, jobs=0, stop_on_error=False,
+             atomic=False, fsync=False, sidecar_db=None,
+             checkpoint_interval=0, max_jobs_per_worker=None,
+             max_worker_memory=None, read_jobs=rgio.DEFAULT_IO_JOBS,
+             write_jobs=1, coordinator=None, authkey=None):
+    """Run the jobs that ``dispatch`` passes to its only argument, a
+    ``submit(tracks, album_id)`` function, and update the cache ``files``
+    with the results.
+
+    ``dispatch`` is called in a separate thread, so it may go on collecting
+    jobs while the first ones are being processed. If an album is submitted
+    again, only the result of the last job for it is used.
+
+    Worker processes are replaced after ``max_jobs_per_worker`` jobs or once
+    they use more than ``max_worker_memory`` MiB, see ``Dispatcher``.
+
+    Every job passes three stages: ``read_jobs`` threads check which files
+    lack Replay Gain information, ``jobs`` worker processes analyze them and
+    ``write_jobs`` threads write the tags. The queues between the stages are
+    bounded, so each stage only runs ahead of the next one by a few jobs.
+
+    If ``coordinator``, a ``(host, port)`` tuple, is given, the jobs are
+    analyzed by ``collectiongain --worker`` processes connecting to it with
+    ``authkey`` instead, see ``RemoteDispatcher``; they get the paths
+    relative to ``music_dir``. Tags are still checked and written here.
+    """
+    lock = threading.Lock()
     num_jobs = 0
+    # the tracks of the last job of every album
+    latest = {}
+    dispatch_error = []
+    # jobs waiting to be checked
+    unchecked = queue.Queue(maxsize=max(1, read_jobs))
 
-    print("Dispatching jobs ...")
-    if single_tracks:
-        pool.apply_async(
-            do_gain_async, [
-                queue, (single_tracks, None),
-                [os.path.join(music_dir, path) for path in single_tracks],
-                ref_level, force, dry_run, False, mp3_format])
-        num_jobs += 1
-
-    for album_id, album_files in albums.items():
-        pool.apply_async(
-            do_gain_async, [
-                queue, (album_files, album_id),
-                [os.path.join(music_dir, path) for path in album_files],
-                ref_level, force, dry_run, True, mp3_format])
-        num_jobs += 1
-    pool.close()
-
-    print("Now waiting for results ...")
+    def submit(tracks, album_id):
+        nonlocal num_jobs
+        tracks = list(tracks)
+        with lock:
+            num_jobs += 1
+            if album_id is not None:
+                latest[album_id] = tracks
+        # blocks while enough jobs are waiting
+        unchecked.put((tracks, album_id))
+
+    def run_dispatch():
+        try:
+            dispatch(submit)
+        except BaseException as exc:
+            dispatch_error.append(exc)
+        finally:
+            # no more jobs
+            unchecked.put(None)
+
+    def run_checks():
+        try:
+            submit_checked(
+                check_jobs(formats_map, music_dir, iter(unchecked.get, None),
+                           force, read_jobs),
+                dispatcher, finish, superseded, *job_args, job_dir=job_dir)
+        except BaseException as exc:
+            dispatch_error.append(exc)
+            # don't leave the dispatch thread blocked
+            while unchecked.get() is not None:
+                pass
+        finally:
+            dispatcher.close()
+
+    def superseded(job_key):
+        # by a later job for the same album
+        tracks, album_id = job_key
+        with lock:
+            return latest.get(album_id, tracks) != tracks
+
+    # Jobs are finished either here or, once their tags are written, by the
+    # writer thread.
     failed_jobs = []
-    try:
-        all_jobs = num_jobs
-        successful = 0
-        while num_jobs > 0:
-            job_key, output, exc = queue.get()
-            num_jobs -= 1
+    successful = 0
+
+    # Finished jobs are written to the cache at most once every
+    # ``checkpoint_interval`` seconds, namely when a job finishes after the
+    # interval has passed. An aborted run only has to redo the jobs that were
+    # in flight and those that finished since the last write.
+    last_checkpoint = time.monotonic()
+
+    def finish(job_key, output, exc, modified=(), gains=None):
+        nonlocal successful, last_checkpoint
+        with lock:
             if exc:
                 failed_jobs.append((job_key, output, exc))
             else:
                 successful += 1
                 print(output.strip())
                 print(
-                    "Successfully finished %s of %s." % (successful, all_jobs))
+                    "Successfully finished %s of %s." % (successful, num_jobs))
                 print("")
-            # Update cache.
-            if not dry_run:
+            # Update cache. Failed jobs are left unprocessed so that they are
+            # retried next time.
+            if not dry_run and not exc:
                 tracks, album_id = job_key
-                update_cache(files, music_dir, tracks, album_id)
+                update_cache(files, music_dir, tracks, album_id, modified,
+                             gains)
+                if time.monotonic() - last_checkpoint >= checkpoint_interval:
+                    files.flush()
+                    last_checkpoint = time.monotonic()
+
+    def on_written(job_key, output, items, gains, errors):
+        output += format_written(items, errors)
+        # files that failed may have been modified as well
+        modified = {relpath(filename, music_dir) for filename, _, _ in items}
+        finish(job_key, output, "; ".join(
+            "%s: %s" % (result.filename, result.error) for result in errors),
+            modified, gains)
+
+    if coordinator is None:
+        job_args, job_dir = (ref_level, mp3_format, sidecar_db), None
+    else:
+        # the analysis doesn't need tags, and workers on other hosts lack
+        # the sidecar database anyway
+        job_args, job_dir = (ref_level, mp3_format), music_dir
+
+    print("Dispatching jobs ...")
+    try:
+        with make_dispatcher(jobs, max_jobs_per_worker, max_worker_memory,
+                             coordinator, authkey) as dispatcher, \
+                get_formats_map(mp3_format, sidecar_db) as formats_map:
+            writer = pipeline.TagWriter(
+                formats_map, max(pipeline.DEFAULT_WRITE_DEPTH, 2 * write_jobs),
+                atomic, fsync, write_jobs)
+            with writer:
+                threading.Thread(target=run_dispatch, daemon=True).start()
+                threading.Thread(target=run_checks, daemon=True).start()
+                print("Now waiting for results ...")
+                write_results(dispatcher, writer, finish, superseded,
+                              on_written, dry_run, music_dir)
+                report_workers(dispatcher.worker_stats())
+        if dispatch_error:
+            raise dispatch_error[0]
     finally:
-        try:
-            pool.terminate()
-        except Exception:
-            # terminate ends rather horribly so we just silence it.
-            pass
-        if len(failed_jobs) > 0:
-            print("Unfortunately, there were some errors:")
-            for key, output, exc in failed_jobs:
-                print(output.strip())
-                print(exc, file=sys.stderr)
-                print("")
-        print("%s successful, %s failed." % (successful, len(failed_jobs)))
+        report_failures(successful, failed_jobs)
 
 
-def do_collectiongain(music_dir, ref_level=89, force=False, dry_run=False,
-                      mp3_format=None, ignore_cache=False, jobs=0):
+def report_failures(successful, failed_jobs):
+    if len(failed_jobs) > 0:
+        print("Unfortunately, there were some errors:")
+        for key, output, exc in failed_jobs:
+            print(output.strip())
+            print(exc, file=sys.stderr)
+            print("")
+    print("%s successful, %s failed." % (successful, len(failed_jobs)))
+
+
+def cache_paths(music_dir, shard=None):
+    # The cache file of ``music_dir`` (or of one shard of it) and the pickle
+    # file it used to be stored in, which is migrated on first use.
     music_abspath = os.path.abspath(music_dir)
     musicpath_hash = md5(music_abspath.encode("utf-8")).hexdigest()
-    cache_file = os.path.join(os.path.expanduser("~"), ".cache",
-                              "collectiongain-cache.%s" % musicpath_hash)
+    cache_dir = os.path.join(os.path.expanduser("~"), ".cache")
+    if shard is not None:
+        return os.path.join(
+            cache_dir, "collectiongain-cache.%s.shard-%i-of-%i.sqlite" % (
+                (musicpath_hash,) + tuple(shard))), None
+    cache_file = os.path.join(cache_dir,
+                              "collectiongain-cache.%s.sqlite" % musicpath_hash)
+    pickle_file = os.path.join(cache_dir,
+                               "collectiongain-cache.%s" % musicpath_hash)
+    return cache_file, pickle_file
+
+
+def merge_caches(music_dir, cache_files):
+    """Fold the caches ``cache_files``, e.g. those of the shards of a run on
+    several hosts, into the cache of ``music_dir``."""
+    cache_file, pickle_file = cache_paths(music_dir)
+    with cache.Cache(cache_file, pickle_file) as files:
+        for other in cache_files:
+            print("Merging %s ..." % other)
+            try:
+                files.merge(other)
+            except (OSError, ValueError, sqlite3.Error) as exc:
+                raise Error("Can't merge %s: %s" % (other, exc))
+    print("All finished.")
+
+
+REPORT_FORMATS = ("text", "json")
+# the width of the bins of the loudness histogram, in dB
+LOUDNESS_BIN = 1.0
+
+
+class CacheReport:
+    """Aggregate Replay Gain statistics of the entries of a cache, which are
+    added one at a time with ``add``. Only counts and one record per album
+    are kept."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        # the number of files with every reference loudness, as a string
+        self.ref_levels = collections.Counter()
+        # the number of tracks in every bin of the loudness histogram
+        self.loudness = collections.Counter()
+        # album ID -> the highest album peak of its files, or None
+        self.albums = {}
+        self.first_analyzed = self.last_analyzed = None
+
+    def add(self, record):
+        """Count the ``cache.CacheEntry`` ``record``."""
+        self.counts["files"] += 1
+        if record.album_id is not None:
+            peak = self.albums.get(record.album_id)
+            if record.album_gain is not None:
+                peak = max(peak or 0.0, record.album_gain.peak)
+            self.albums[record.album_id] = peak
+        if not record.processed:
+            self.counts["unprocessed"] += 1
+        elif record.track_gain is None and record.album_gain is None:
+            # entries of older caches (e.g. migrated pickle caches) are
+            # processed, but nothing is known about their gain
+            self.counts["no_gain" if record.analyzed is not None
+                        else "not_recorded"] += 1
+        trackdata = record.track_gain
+        if trackdata is not None:
+            self.counts["track_gain"] += 1
+            if trackdata.peak >= 1.0:
+                self.counts["track_peak_full_scale"] += 1
+            if trackdata.ref_level is not None:
+                # the loudness the track would have without gain
+                self.loudness[math.floor(
+                    (trackdata.ref_level - trackdata.gain) / LOUDNESS_BIN)] += 1
+        gaindata = trackdata or record.album_gain
+        if gaindata is not None:
+            self.ref_levels["%g" % gaindata.ref_level
+                            if gaindata.ref_level is not None
+                            else "unknown"] += 1
+        if record.analyzed is not None:
+            self.counts["analyzed"] += 1
+            if self.first_analyzed is None:
+                self.first_analyzed = self.last_analyzed = record.analyzed
+            self.first_analyzed = min(self.first_analyzed, record.analyzed)
+            self.last_analyzed = max(self.last_analyzed, record.analyzed)
 
-    # load the cache, if desired
-    if not ignore_cache:
-        files = read_cache(cache_file)
+    def clipping_albums(self):
+        """Return ``(album_id, peak)`` tuples of the albums whose peak is at
+        or above full scale, the loudest first."""
+        return sorted(
+            ((album_id, peak) for album_id, peak in self.albums.items()
+             if peak is not None and peak >= 1.0),
+            key=lambda item: (-item[1], item[0]))
+
+    def loudness_histogram(self):
+        """Return ``(lower, upper, count)`` tuples, in dB, of all bins from
+        the quietest to the loudest track."""
+        if not self.loudness:
+            return []
+        return [(i * LOUDNESS_BIN, (i + 1) * LOUDNESS_BIN, self.loudness[i])
+                for i in range(min(self.loudness), max(self.loudness) + 1)]
+
+    def as_dict(self):
+        return {
+            "files": self.counts["files"],
+            "unprocessed": self.counts["unprocessed"],
+            "no_gain": self.counts["no_gain"],
+            "not_recorded": self.counts["not_recorded"],
+            "track_gain": self.counts["track_gain"],
+            "analyzed": self.counts["analyzed"],
+            "first_analyzed": self.first_analyzed,
+            "last_analyzed": self.last_analyzed,
+            "albums": len(self.albums),
+            "album_gain": sum(peak is not None
+                              for peak in self.albums.values()),
+            "track_peak_full_scale": self.counts["track_peak_full_scale"],
+            "album_peak_full_scale": [
+                {"album": album_id, "peak": peak}
+                for album_id, peak in self.clipping_albums()],
+            "ref_levels": dict(sorted(self.ref_levels.items())),
+            "loudness": [
+                {"from": lower, "to": upper, "tracks": count}
+                for lower, upper, count in self.loudness_histogram()],
+        }
+
+    def format(self):
+        def when(timestamp):
+            return time.strftime("%Y-%m-%d %H:%M:%S",
+                                 time.localtime(timestamp))
+
+        result = self.as_dict()
+        lines = [
+            "Files: %i" % result["files"],
+            "  not processed yet: %i" % result["unprocessed"],
+            "  processed, without Replay Gain information: %i" %
+            result["no_gain"],
+            "  processed, Replay Gain information not recorded: %i" %
+            result["not_recorded"],
+            "  with track gain: %i" % result["track_gain"],
+            "  analyzed by collectiongain: %i" % result["analyzed"],
+        ]
+        if result["analyzed"]:
+            lines.append("    between %s and %s" % (
+                when(result["first_analyzed"]),
+                when(result["last_analyzed"])))
+        lines += [
+            "Albums: %i" % result["albums"],
+            "  with album gain: %i" % result["album_gain"],
+            "Track peaks at or above full scale: %i" %
+            result["track_peak_full_scale"],
+            "Album peaks at or above full scale: %i" %
+            len(result["album_peak_full_scale"]),
+        ]
+        lines.extend("  %s: %+.2f dBFS" % (album_id, 20 * math.log10(peak))
+                     for album_id, peak in self.clipping_albums())
+        lines.append("Reference loudness:")
+        lines.extend(
+            "  %s: %i" % (level if level == "unknown" else level + " dB",
+                          count)
+            for level, count in result["ref_levels"].items())
+        histogram = self.loudness_histogram()
+        lines.append("Track loudness:")
+        most = max((count for _, _, count in histogram), default=0)
+        for lower, upper, count in histogram:
+            lines.append("  %5.1f - %5.1f dB: %6i %s" % (
+                lower, upper, count, "#" * math.ceil(40 * count / most)))
+        return "\n".join(lines)
+
+
+def report_cache(music_dir, shard=None, output_format="text"):
+    """Print a ``CacheReport`` of the cache of ``music_dir`` (or of one
+    shard of it) in ``output_format``, one of ``REPORT_FORMATS``. Neither
+    the music directory nor the files in it are accessed."""
+    cache_file, _ = cache_paths(music_dir, shard)
+    try:
+        # don't create an empty one
+        os.stat(cache_file)
+    except OSError as exc:
+        raise Error("No cache of %s: %s" % (music_dir, exc.strerror or exc))
+    report = CacheReport()
+    try:
+        for _, record in cache.read_items(cache_file):
+            report.add(record)
+    except (ValueError, sqlite3.Error) as exc:
+        raise Error("Can't read the cache of %s: %s" % (music_dir, exc))
+    if output_format == "json":
+        print(json.dumps(report.as_dict()))
     else:
-        files = {}
+        print(report.format())
 
-    print("Collecting files ...")
-    # whenever this part is stopped (KeyboardInterrupt/other exception), the
-    # cache is written to disk so all progress persists
+
+def start_watcher(music_dir, watch=True):
+    # an ``inotify.TreeWatcher`` of ``music_dir``, or a dummy one unless
+    # ``watch`` is true
+    if not watch:
+        return contextlib.nullcontext()
     try:
-        visited_cache = dict.fromkeys(iter(files.keys()), False)
-        collect_files(
-            music_dir,
-            files,
-            visited_cache,
-            rgio.BaseFormatsMap(mp3_format).is_supported
-        )
-        # clean cache
-        for filepath, visited in list(visited_cache.items()):
-            if not visited:
-                del visited_cache[filepath]
-                del files[filepath]
-        # hopefully gets rid of at least one huge data structure
-        del visited_cache
-
-        albums, single_tracks = transform_cache(files)
-
-        # gain everything that has survived the cleansing
-        do_gain_all(
-            music_dir, albums, single_tracks, files, ref_level, force, dry_run,
-            mp3_format, jobs)
-    finally:
-        write_cache(cache_file, files)
+        return inotify.TreeWatcher(music_dir)
+    except OSError as exc:
+        raise Error("Can't watch %s: %s" % (music_dir, exc))
+
 
+def do_worker(coordinator, authkey, music_dir, jobs=0):
+    """Analyze the jobs of the ``collectiongain`` coordinator listening on
+    ``coordinator``, a ``(host, port)`` tuple, with ``jobs`` processes.
+    ``music_dir`` is where the coordinator's music directory is mounted on
+    this host."""
+    try:
+        os.chdir(music_dir)
+    except OSError as exc:
+        raise Error("Can't change to %s: %s" % (music_dir, exc))
+    jobs = jobs or os.cpu_count() or 1
+    print("Working for %s:%i with %i processes ..." % (coordinator + (jobs,)))
+    # every process pulls jobs over a connection of its own
+    with util.start_process_pool(jobs) as pool:
+        workers = [pool.submit(run_worker, coordinator, authkey)
+                   for _ in range(jobs)]
+        try:
+            count = sum(worker.result() for worker in workers)
+        except (OSError, AuthenticationError) as exc:
+            raise Error("Can't work for %s:%i: %s" % (coordinator + (exc,)))
+    print("%i jobs done." % count)
     print("All finished.")
 
 
-class PositiveIntOrNone:
-    """A "type" for an argparse argument which can either be None (not present)
-    or a positive integer greater than 0.
-    """
-    def __init__(self, metavar: str):
-        self.metavar = metavar
+def do_collectiongain(music_dir, ref_level=89, force=False, dry_run=False,
+                      mp3_format=None, ignore_cache=False, jobs=0,
+                      atomic=False, fsync=False, sidecar_db=None,
+                      checkpoint_interval=0, fast_scan=False, stream=False,
+                      max_jobs_per_worker=None, max_worker_memory=None,
+                      read_jobs=None, write_jobs=None, shard=None,
+                      coordinator=None, authkey=None, watch=False,
+                      watch_delay=DEFAULT_WATCH_DELAY, stop=None,
+                      changes=None):
+    # With ``watch``, this runs until ``stop``, a ``threading.Event``, is set
+    # (if ever). With ``changes``, a list of paths, only those are processed
+    # instead of all of ``music_dir``, see ``change_list_jobs``.
+    cache_file, pickle_file = cache_paths(music_dir, shard)
+    if shard is not None:
+        print("Processing shard %i of %i, cached in %s" % (
+            shard[0], shard[1], cache_file))
+
+    print("Collecting files ...")
+    # Modifications of the cache are written in small transactions; whenever
+    # this part is stopped (KeyboardInterrupt/other exception), the remaining
+    # ones are written as well so all progress persists.
+    with cache.Cache(cache_file, pickle_file) as files, \
+            contextlib.ExitStack() as stack:
+        if ignore_cache:
+            files.clear()
+        is_supported = rgio.BaseFormatsMap(mp3_format).is_supported
+        if changes is not None:
+            # the rest of the cache isn't even looked at
+            dispatch = change_list_jobs(music_dir, files, is_supported,
+                                        changes, shard, force)
+        elif stream or watch:
+            files.begin_scan()
+            # Collect files and process albums at the same time. The analysis
+            # workers are forked before run_jobs starts any threads, so the
+            # workers reading tags are started by the dispatch thread, with
+            # the forkserver. Changes are watched for before the scan starts,
+            # so that none are missed.
+            watcher = stack.enter_context(start_watcher(music_dir, watch))
+            dispatch = stream_jobs(music_dir, files, is_supported,
+                                   fast_scan, jobs, shard=shard)
+            if watcher is not None:
+                dispatch = watch_jobs(music_dir, files, is_supported,
+                                      watcher, dispatch, shard,
+                                      watch_delay, stop)
+        else:
+            files.begin_scan()
+            collect_files(music_dir, files, is_supported, fast_scan, jobs)
+            # clean cache
+            files.purge_unvisited()
+
+            # gain everything that has survived the cleansing
+            albums, single_tracks = schedule.select_shard(
+                *transform_cache(files), shard)
+            dispatch = all_jobs(files, albums, single_tracks, jobs)
+
+        run_jobs(
+            music_dir, dispatch,
+            files, ref_level, force, dry_run, mp3_format, jobs,
+            atomic=atomic, fsync=fsync, sidecar_db=sidecar_db,
+            checkpoint_interval=checkpoint_interval,
+            max_jobs_per_worker=max_jobs_per_worker,
+            max_worker_memory=max_worker_memory,
+            read_jobs=read_jobs or rgio.DEFAULT_IO_JOBS,
+            write_jobs=write_jobs or 1, coordinator=coordinator,
+            authkey=authkey)
+
+    print("All finished.")
+
 
+class Shard:
+    """A "type" for an argparse argument of the form K/N, denoting the K-th
+    of N shards. Returns a ``(K, N)`` tuple.
+    """
     def __call__(self, value):
-        if value is None:
-            return None
+        try:
+            k, n = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise ArgumentError(
+                None, "SHARD must be of the form K/N, e.g. 1/3") from None
+        if not 1 <= k <= n:
+            raise ArgumentError(None, "K must be between 1 and N")
+        return k, n
 
+
+class Address:
+    """A "type" for an argparse argument of the form HOST:PORT. Returns a
+    ``(host, port)`` tuple.
+    """
+    def __call__(self, value):
+        host, sep, port = value.rpartition(":")
         try:
-            i = int(value)
-        except ValueError as e:
-            raise ArgumentError(None, str(e)) from None
-        else:
-            if i < 1:
-                raise ArgumentError(
-                    None, "{} must be at least 1".format(self.metavar)
-                )
-        return i
+            port = int(port)
+        except ValueError:
+            port = -1
+        if not sep or not 0 <= port < 2 ** 16:
+            raise ArgumentError(
+                None, "address must be of the form HOST:PORT") from None
+        # [::1]:PORT
+        return host.strip("[]"), port
 
 
 def collectiongain_parser():
@@ -345,9 +1194,165 @@ def collectiongain_parser():
     parser.add_argument(
         "-j", "--jobs",
         type=PositiveIntOrNone("JOBS"),
-        help="Specifies the number of jobs to run simultaneously. Must be >= "
-        "1. By default, this is set to the number of CPU cores in the system "
-        "to provide best performance.",
+        help="Specifies the number of jobs to run simultaneously, both when "
+        "reading the tags of new files and when calculating Replay Gain; see "
+        "also '--read-jobs' and '--write-jobs'. Must "
+        "be >= 1. By default, this is set to the number of CPU cores in the "
+        "system to provide best performance.",
+    )
+    parser.add_argument(
+        "--read-jobs",
+        type=PositiveIntOrNone("JOBS"),
+        dest="read_jobs",
+        metavar="JOBS",
+        help="The number of threads which check the tags of the files of "
+        "the jobs for Replay Gain information before the worker processes "
+        "analyze them. Defaults to %i." % rgio.DEFAULT_IO_JOBS,
+    )
+    parser.add_argument(
+        "--write-jobs",
+        type=PositiveIntOrNone("JOBS"),
+        dest="write_jobs",
+        metavar="JOBS",
+        help="The number of threads which write tags; each one writes the "
+        "files of a different album. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running after processing MUSIC_DIR like '--stream' does "
+        "and process albums as soon as files are added to or modified in "
+        "it. Needs Linux' inotify.",
+    )
+    parser.add_argument(
+        "--watch-delay",
+        type=NonNegativeFloat("SECONDS"),
+        dest="watch_delay",
+        default=DEFAULT_WATCH_DELAY,
+        metavar="SECONDS",
+        help="With '--watch', wait until no file of an album has changed for "
+        "SECONDS seconds before processing it. Defaults to %i." %
+        DEFAULT_WATCH_DELAY,
+    )
+    parser.add_argument(
+        "--files-from",
+        dest="files_from",
+        metavar="FILE",
+        help="Don't scan MUSIC_DIR, only process the files listed in FILE "
+        "('-' for standard input), one per line, e.g. those added by an "
+        "import. The other files of their albums are taken from the cache. "
+        "Paths are relative to MUSIC_DIR or absolute; directories stand for "
+        "the files below them, and files which don't exist anymore are "
+        "removed from the cache.",
+    )
+    parser.add_argument(
+        "-0", "--null",
+        action="store_true",
+        help="With '--files-from', the paths are separated by NUL "
+        "characters instead of newlines, like 'find -print0' writes them.",
+    )
+    parser.add_argument(
+        "--shard",
+        type=Shard(),
+        metavar="K/N",
+        help="Process only the K-th of N shards of the albums, e.g. to run "
+        "collectiongain on N hosts sharing the music directory. Albums are "
+        "assigned to shards by a hash of their album ID, so no coordination "
+        "is needed. Each shard keeps a cache of its own; see "
+        "'--merge-cache'.",
+    )
+    parser.add_argument(
+        "--merge-cache",
+        action="append",
+        dest="merge_cache",
+        metavar="CACHE_FILE",
+        help="Merge CACHE_FILE, e.g. the cache of a shard from another host, "
+        "into the cache of MUSIC_DIR instead of processing it. May be given "
+        "more than once.",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Print statistics of the Replay Gain information stored in the "
+        "cache of MUSIC_DIR instead of processing it, e.g. which albums "
+        "peak at or above full scale and how loud the tracks are. Neither "
+        "MUSIC_DIR nor the files in it are read.",
+    )
+    parser.add_argument(
+        "--report-format",
+        choices=REPORT_FORMATS,
+        default="text",
+        dest="report_format",
+        metavar="FORMAT",
+        help="With '--report', print the statistics as 'text' (the default) "
+        "or as a 'json' object.",
+    )
+    parser.add_argument(
+        "--coordinator",
+        type=Address(),
+        metavar="HOST:PORT",
+        help="Listen on HOST:PORT for workers on other hosts started with "
+        "'--worker' and let them calculate Replay Gain instead of local "
+        "processes. Idle workers fetch the next job, so faster hosts do more "
+        "of the work. Tags and the cache are read and written here. The "
+        "coordinator and its workers authenticate each other with the "
+        "secret in the %s environment variable." % AUTHKEY_VARIABLE,
+    )
+    parser.add_argument(
+        "--worker",
+        type=Address(),
+        metavar="HOST:PORT",
+        help="Work for the coordinator listening on HOST:PORT, with JOBS "
+        "processes, until it has no more jobs. MUSIC_DIR is where the "
+        "coordinator's music directory is mounted on this host.",
+    )
+    parser.add_argument(
+        "--max-jobs-per-worker",
+        type=PositiveIntOrNone("N"),
+        dest="max_jobs_per_worker",
+        metavar="N",
+        help="Replace the worker processes once one of them has run N jobs, "
+        "which frees memory leaked by decoders on long runs. Jobs handed to "
+        "the old workers already are still run by them. By default, workers "
+        "are never replaced.",
+    )
+    parser.add_argument(
+        "--max-worker-memory",
+        type=PositiveIntOrNone("MIB"),
+        dest="max_worker_memory",
+        metavar="MIB",
+        help="Replace the worker processes once one of them uses more than "
+        "MIB MiB of memory after a job. The peak memory usage of every "
+        "worker is reported at the end of a run either way.",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=NonNegativeFloat("SECONDS"),
+        dest="checkpoint_interval",
+        default=0,
+        metavar="SECONDS",
+        help="Write finished jobs to the cache at most once every SECONDS "
+        "seconds while the program runs, so that an aborted run can be "
+        "resumed. The cache is written when a job finishes after SECONDS "
+        "seconds have passed since it was last written. The default of 0 "
+        "writes every finished job right away.",
+    )
+    parser.add_argument(
+        "--fast-scan",
+        action="store_true",
+        dest="fast_scan",
+        help="Don't read directories which haven't changed since the last "
+        "run. This is much faster for large collections, but files which "
+        "have been modified in place (instead of being replaced) are only "
+        "noticed if their directory changed as well. Needs stable inode "
+        "numbers, which some network and FUSE file systems lack.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Start calculating Replay Gain while the music directory is "
+        "still being scanned: the albums in each directory directly below "
+        "MUSIC_DIR are processed as soon as that directory has been scanned.",
     )
     parser.add_argument(
         "music_dir",
@@ -356,14 +1361,49 @@ def collectiongain_parser():
     return parser
 
 
+def read_files_from(filename, null=False):
+    # the change list of --files-from
+    try:
+        if filename == "-":
+            return read_change_list(sys.stdin.buffer, null)
+        with open(filename, "rb") as stream:
+            return read_change_list(stream, null)
+    except OSError as exc:
+        raise Error("Can't read %s: %s" % (filename, exc.strerror or exc))
+
+
 def main():
-    init_gstreamer()
+    if gst_options_given():
+        init_gstreamer()
     parser = collectiongain_parser()
     opts = parser.parse_args()
 
     if opts.regain:
         opts.force = opts.ignore_cache = True
+    # secrets on the command line can be seen by other users
+    authkey = os.environ.get(AUTHKEY_VARIABLE, "").encode("utf-8")
+    if (opts.coordinator or opts.worker) and not authkey:
+        parser.error("%s must be set to the secret shared by the coordinator "
+                     "and its workers" % AUTHKEY_VARIABLE)
+    if opts.files_from is not None and (opts.watch or opts.ignore_cache):
+        parser.error("--files-from can't be combined with --watch, "
+                     "--ignore-cache or --regain")
+    if not (opts.merge_cache or opts.report):
+        # before any worker process is started
+        init_gstreamer()
     try:
+        changes = None
+        if opts.files_from is not None:
+            changes = read_files_from(opts.files_from, opts.null)
+        if opts.merge_cache:
+            merge_caches(opts.music_dir, opts.merge_cache)
+            return
+        if opts.report:
+            report_cache(opts.music_dir, opts.shard, opts.report_format)
+            return
+        if opts.worker:
+            do_worker(opts.worker, authkey, opts.music_dir, opts.jobs)
+            return
         do_collectiongain(
             opts.music_dir,
             opts.ref_level,
@@ -372,6 +1412,22 @@ def main():
             opts.mp3_format,
             opts.ignore_cache,
             opts.jobs,
+            opts.atomic,
+            opts.fsync,
+            opts.sidecar_db,
+            opts.checkpoint_interval,
+            opts.fast_scan,
+            opts.stream,
+            opts.max_jobs_per_worker,
+            opts.max_worker_memory,
+            opts.read_jobs,
+            opts.write_jobs,
+            opts.shard,
+            opts.coordinator,
+            authkey,
+            opts.watch,
+            opts.watch_delay,
+            changes=changes,
         )
     except Error as exc:
         print("")
@@ -34,8 +34,12 @@ class GainData:
      - ``gain``: the gain (in dB, relative to ``ref_level``)
      - ``peak``: the peak
      - ``ref_level``: the used reference level (in dB)
+     - ``gain_type``: whether this is track or album gain
     """
 
+    # there may be millions of these, e.g. in results passed between processes
+    __slots__ = ("gain", "peak", "ref_level", "gain_type")
+
     def __init__(self,
                  gain,
                  peak=1.0,
@@ -57,6 +61,11 @@ class GainData:
             self.gain, self.peak, self.ref_level, self.gain_type
         )
 
+    def __reduce__(self):
+        # much more compact than the default protocol for slotted classes
+        return self.__class__, (
+            self.gain, self.peak, self.ref_level, self.gain_type)
+
     def __eq__(self, other):
         return isinstance(other, GainData) and (
             self.gain == other.gain and
@@ -0,0 +1,535 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""The file cache of ``collectiongain``.
+
+The cache maps paths relative to the music directory to ``CacheEntry``
+records. It is stored in a SQLite database, so that it can be loaded lazily and
+updated incrementally instead of being read and written as a whole. It also
+keeps a ``DirRecord`` for every directory, which allows skipping unchanged
+directories when the music directory is scanned.
+"""
+
+import contextlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import urllib.parse
+from collections import namedtuple
+from collections.abc import MutableMapping
+
+from rgain3.lib import GainData
+from rgain3.lib.scan import DirRecord
+
+__all__ = ["CacheEntry", "Cache", "read_pickle_cache", "read_items"]
+
+CURRENT_CACHE_VERSION = 6
+
+# the version of the (legacy) pickled cache
+PICKLE_CACHE_VERSION = 1
+
+# ``mtime`` is the modification time in nanoseconds; together with ``size``
+# and ``inode`` it identifies the version of a file the entry is about.
+# ``length`` is the duration of the audio in seconds, if known.
+# ``track_gain`` and ``album_gain`` are the ``GainData`` of the file once it
+# has been processed, if it has any; ``analyzed`` is the time (in seconds
+# since the epoch) it was analyzed at, or None if the data was found in its
+# tags.
+CacheEntry = namedtuple(
+    "CacheEntry",
+    ["album_id", "mtime", "processed", "size", "inode", "length",
+     "track_gain", "album_gain", "analyzed"],
+    defaults=(None,) * 6)
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        path BLOB PRIMARY KEY,
+        dir BLOB NOT NULL,
+        album_id TEXT,
+        mtime INTEGER NOT NULL,
+        processed INTEGER NOT NULL,
+        size INTEGER,
+        inode INTEGER,
+        length REAL,
+        track_gain REAL,
+        track_peak REAL,
+        album_gain REAL,
+        album_peak REAL,
+        ref_level REAL,
+        analyzed REAL,
+        visited INTEGER NOT NULL DEFAULT 1
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS files_dir ON files (dir)",
+    "CREATE INDEX IF NOT EXISTS files_album ON files (album_id)",
+    """
+    CREATE TABLE IF NOT EXISTS dirs (
+        path BLOB PRIMARY KEY,
+        mtime INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        subdirs TEXT NOT NULL,
+        visited INTEGER NOT NULL DEFAULT 1
+    )
+    """,
+]
+
+# marks deleted rows among the dirty ones
+_DELETED = object()
+
+
+def _key(path):
+    # paths are stored as bytes, so that file names which aren't valid in the
+    # file system encoding survive the round trip
+    return os.fsencode(path)
+
+
+# the columns of the files table which make up a ``CacheEntry``
+_COLUMNS = ("album_id, mtime, processed, size, inode, length, track_gain, "
+            "track_peak, album_gain, album_peak, ref_level, analyzed")
+
+
+def _gain_data(gain, peak, ref_level):
+    if gain is None:
+        return None
+    return GainData(gain, peak, ref_level)
+
+
+def _entry(row):
+    (album_id, mtime, processed, size, inode, length, track_gain, track_peak,
+     album_gain, album_peak, ref_level, analyzed) = row
+    return CacheEntry(
+        album_id, mtime, bool(processed), size, inode, length,
+        _gain_data(track_gain, track_peak, ref_level),
+        _gain_data(album_gain, album_peak, ref_level),
+        analyzed)
+
+
+def _gain_columns(gaindata):
+    if gaindata is None:
+        return None, None
+    return gaindata.gain, gaindata.peak
+
+
+def _row(record):
+    # the inverse of ``_entry``; like in the sidecar database, there's only
+    # one reference level per file
+    gaindata = record.track_gain or record.album_gain
+    return (tuple(record[:6]) + _gain_columns(record.track_gain) +
+            _gain_columns(record.album_gain) +
+            (gaindata.ref_level if gaindata else None, record.analyzed))
+
+
+def entry_unchanged(record, st, check_inode=False):
+    """Check whether the file with the stat result ``st`` is still the one
+    that ``record`` was created for.
+
+    With ``check_inode``, a file which has been replaced by another one is
+    detected even if the modification time and size match. Inode numbers
+    aren't stable on some network and FUSE file systems though.
+    """
+    if record.size is None:
+        # entries migrated from older caches only know the modification time
+        # as a float, which is precise to about a microsecond
+        return abs(st.st_mtime_ns - record.mtime) < 1000
+    return (record.mtime == st.st_mtime_ns and
+            record.size == st.st_size and
+            (not check_inode or record.inode == st.st_ino))
+
+
+def cache_entry_valid(filepath, record):
+    return (
+        isinstance(filepath, str) and
+        hasattr(record, "__getitem__") and
+        hasattr(record, "__len__") and
+        len(record) == 3 and
+        (isinstance(record[0], str) or record[0] is None) and
+        (isinstance(record[1], int) or isinstance(record[1], float)) and
+        isinstance(record[2], bool))
+
+
+def read_items(cache_file):
+    """Iterate over the ``(filepath, record)`` pairs of the cache in
+    ``cache_file`` without modifying it in any way, unlike ``Cache``, which
+    drops caches of other versions.
+
+    Raises ``ValueError`` if the cache has another version, and
+    ``sqlite3.Error`` if it can't be read.
+    """
+    conn = sqlite3.connect(
+        "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(cache_file)),
+        uri=True)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != CURRENT_CACHE_VERSION:
+            raise ValueError(
+                "cache version %i is not supported (expected %i); run "
+                "collectiongain on the music directory to update it" % (
+                    version, CURRENT_CACHE_VERSION))
+        for row in conn.execute(
+                "SELECT path, %s FROM files ORDER BY path" % _COLUMNS):
+            yield os.fsdecode(row[0]), _entry(row[1:])
+    finally:
+        conn.close()
+
+
+def read_pickle_cache(cache_file):
+    """Read a cache file in the pickle format used up to rgain3 1.1.
+
+    Returns a dict of ``CacheEntry`` records.
+    """
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                cache = pickle.load(f)
+                if not isinstance(cache, tuple) or len(cache) != 2:
+                    print("Invalid cache, ignoring it")
+                    return {}
+                cache_version = cache[0]
+                if cache_version != PICKLE_CACHE_VERSION:
+                    print("Old cache format, ignoring it")
+                    return {}
+                files = cache[1]
+                if not isinstance(files, dict):
+                    print("Invalid cache, ignoring it")
+                    return {}
+                # remove fishy entries; mtimes were stored in seconds
+                return {
+                    filepath: CacheEntry(
+                        record[0], int(round(record[1] * 1e9)), record[2])
+                    for filepath, record in files.items()
+                    if cache_entry_valid(filepath, record)
+                }
+        except Exception as exc:
+            print(
+                "Error while reading the cache, continuing without it - %s" %
+                (exc,))
+    return {}
+
+
+class Cache(MutableMapping):
+    """A mapping of relative file paths to ``CacheEntry`` records, stored in
+    the SQLite database ``cache_file``.
+
+    Records are read from the database on access. Modifications are kept in
+    memory and written by ``flush``, which is called automatically once
+    ``batch_size`` records are dirty; every batch is committed in a
+    transaction of its own.
+
+    If ``cache_file`` doesn't exist yet but ``pickle_file`` does, the entries
+    of the latter are imported and the pickle file is removed.
+
+    The cache may be used from several threads.
+    """
+
+    def __init__(self, cache_file, pickle_file=None, batch_size=1000):
+        self.cache_file = cache_file
+        self.batch_size = batch_size
+        self._dirty = {}
+        self._dirty_dirs = {}
+        self._visited = []
+        self._visited_dirs = []
+        self._lock = threading.RLock()
+
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o755)
+        migrate = (pickle_file is not None and
+                   not os.path.exists(cache_file) and
+                   os.path.isfile(pickle_file))
+
+        self._conn = sqlite3.connect(cache_file, timeout=30,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._setup()
+
+        if migrate:
+            print("Migrating old cache ...")
+            self.update(read_pickle_cache(pickle_file))
+            self.flush()
+            os.remove(pickle_file)
+
+    def _setup(self):
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, CURRENT_CACHE_VERSION):
+            print("Old cache format, ignoring it")
+            self._conn.execute("DROP TABLE IF EXISTS files")
+            self._conn.execute("DROP TABLE IF EXISTS dirs")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        self._conn.execute("PRAGMA user_version = %i" % CURRENT_CACHE_VERSION)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        """Write all pending modifications and close the database."""
+        with self._lock:
+            if self._conn is not None:
+                self.flush()
+                self._conn.close()
+                self._conn = None
+
+    def __getitem__(self, filepath):
+        with self._lock:
+            record = self._dirty.get(filepath)
+            if record is None:
+                row = self._conn.execute(
+                    "SELECT %s FROM files WHERE path = ?" % _COLUMNS,
+                    (_key(filepath),)).fetchone()
+                if row is None:
+                    raise KeyError(filepath)
+                record = _entry(row)
+            if record is _DELETED:
+                raise KeyError(filepath)
+            return record
+
+    def __setitem__(self, filepath, record):
+        with self._lock:
+            self._dirty[filepath] = CacheEntry(*record)
+            if len(self._dirty) >= self.batch_size:
+                self.flush()
+
+    def __delitem__(self, filepath):
+        with self._lock:
+            # raises KeyError if there's no such entry
+            self[filepath]
+            self._dirty[filepath] = _DELETED
+
+    def __iter__(self):
+        for filepath, _ in self.items():
+            yield filepath
+
+    def __len__(self):
+        with self._lock:
+            self.flush()
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def items(self):
+        """Iterate over all ``(filepath, record)`` pairs.
+
+        Entries are read in chunks, ordered by path, so the cache may be
+        modified (e.g. by another thread) during the iteration.
+        """
+        return self._select("", ())
+
+    def visited_items(self, reldir=""):
+        """Iterate over the ``(filepath, record)`` pairs of the files in the
+        directory tree ``reldir`` (the whole cache by default) which have
+        been visited since ``begin_scan``."""
+        if not reldir:
+            return self._select(" AND visited", ())
+        lower = _key(os.path.join(reldir, ""))
+        upper = lower[:-1] + bytes([lower[-1] + 1])
+        return self._select(" AND visited AND path >= ? AND path < ?",
+                            (lower, upper))
+
+    def album_items(self, album_id):
+        """Iterate over the ``(filepath, record)`` pairs of the files of the
+        album ``album_id``."""
+        return self._select(" AND album_id = ?", (album_id,))
+
+    def remove_tree(self, relpath):
+        """Remove the entry of ``relpath`` and those of all files below it,
+        if it's a directory, along with their directory records."""
+        lower = _key(os.path.join(relpath, ""))
+        upper = lower[:-1] + bytes([lower[-1] + 1])
+        with self._lock:
+            self.flush()
+            with self._transaction():
+                for table in ("files", "dirs"):
+                    self._conn.execute(
+                        "DELETE FROM %s WHERE path = ? OR "
+                        "(path >= ? AND path < ?)" % table,
+                        (_key(relpath), lower, upper))
+
+    def _select(self, where, params):
+        with self._lock:
+            self.flush()
+        last = b""
+        while True:
+            with self._lock:
+                chunk = self._conn.execute(
+                    "SELECT path, %s FROM files WHERE path > ?" % _COLUMNS +
+                    where + " ORDER BY path LIMIT ?",
+                    (last,) + params + (self.batch_size,)).fetchall()
+            if not chunk:
+                return
+            for row in chunk:
+                yield os.fsdecode(row[0]), _entry(row[1:])
+            last = chunk[-1][0]
+
+    def clear(self):
+        with self._lock:
+            self._dirty.clear()
+            self._dirty_dirs.clear()
+            self._visited = []
+            self._visited_dirs = []
+            self._conn.execute("DELETE FROM files")
+            self._conn.execute("DELETE FROM dirs")
+
+    def flush(self):
+        """Write all modifications to the database."""
+        with self._lock:
+            dirty = list(self._dirty.items())
+            self._dirty.clear()
+            for batch in self._batches(dirty):
+                self._conn.executemany(
+                    "DELETE FROM files WHERE path = ?",
+                    [(_key(path),) for path, r in batch if r is _DELETED])
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO files "
+                    "VALUES (?, ?, %s, 1)" % ", ".join("?" * 12),
+                    [(_key(path), _key(os.path.dirname(path))) + _row(r)
+                     for path, r in batch if r is not _DELETED])
+
+            dirty = list(self._dirty_dirs.items())
+            self._dirty_dirs.clear()
+            for batch in self._batches(dirty):
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, 1)",
+                    [(_key(path), r.mtime, r.inode, json.dumps(r.subdirs))
+                     for path, r in batch])
+
+            visited, self._visited = self._visited, []
+            for batch in self._batches(visited):
+                self._conn.executemany(
+                    "UPDATE files SET visited = 1 WHERE path = ?",
+                    [(_key(path),) for path in batch])
+
+            visited, self._visited_dirs = self._visited_dirs, []
+            for batch in self._batches(visited):
+                params = [(_key(path),) for path in batch]
+                self._conn.executemany(
+                    "UPDATE dirs SET visited = 1 WHERE path = ?", params)
+                self._conn.executemany(
+                    "UPDATE files SET visited = 1 WHERE dir = ?", params)
+
+    def _batches(self, items):
+        # yield slices of ``items``, each within a transaction
+        for i in range(0, len(items), self.batch_size):
+            with self._transaction():
+                yield items[i:i + self.batch_size]
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    # Directory records, see ``scan.scan_tree``.
+    def get_dir(self, reldir):
+        with self._lock:
+            record = self._dirty_dirs.get(reldir)
+            if record is not None:
+                return record
+            row = self._conn.execute(
+                "SELECT mtime, inode, subdirs FROM dirs "
+                "WHERE path = ?", (_key(reldir),)).fetchone()
+        if row is None:
+            return None
+        return DirRecord(row[0], row[1], json.loads(row[2]))
+
+    def set_dir(self, reldir, record):
+        with self._lock:
+            self._dirty_dirs[reldir] = record
+            if len(self._dirty_dirs) >= self.batch_size:
+                self.flush()
+
+    # Tracking of files found in the music directory, to purge the entries of
+    # files which have been removed.
+    def begin_scan(self):
+        """Mark all entries as not visited."""
+        with self._lock:
+            self.flush()
+            with self._transaction():
+                self._conn.execute("UPDATE files SET visited = 0")
+                self._conn.execute("UPDATE dirs SET visited = 0")
+
+    def mark_visited(self, filepath):
+        """Mark the entry of ``filepath`` as visited; entries which are set
+        are marked as visited implicitly."""
+        with self._lock:
+            self._visited.append(filepath)
+            if len(self._visited) >= self.batch_size:
+                self.flush()
+
+    def mark_dir_visited(self, reldir):
+        """Mark the record of the directory ``reldir`` and the entries of all
+        files directly inside it as visited."""
+        with self._lock:
+            self._visited_dirs.append(reldir)
+            if len(self._visited_dirs) >= self.batch_size:
+                self.flush()
+
+    def purge_unvisited(self):
+        """Remove all entries and directory records which haven't been
+        visited since ``begin_scan``."""
+        with self._lock:
+            self.flush()
+            with self._transaction():
+                self._conn.execute("DELETE FROM files WHERE visited = 0")
+                self._conn.execute("DELETE FROM dirs WHERE visited = 0")
+
+    def merge(self, cache_file):
+        """Fold the entries and directory records of the cache in
+        ``cache_file`` into this one, e.g. those of a ``collectiongain`` run
+        on another host.
+
+        An entry marked as processed wins over one that isn't; otherwise, the
+        one with the more recent modification time is kept.
+        """
+        if not os.path.isfile(cache_file):
+            raise FileNotFoundError(cache_file)
+        other = sqlite3.connect(cache_file)
+        try:
+            version = other.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            other.close()
+        if version != CURRENT_CACHE_VERSION:
+            raise ValueError("%s: unsupported cache version %i" % (
+                cache_file, version))
+
+        with self._lock:
+            self.flush()
+            self._conn.execute("ATTACH DATABASE ? AS other", (cache_file,))
+            try:
+                with self._transaction():
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO files SELECT o.* "
+                        "FROM other.files AS o "
+                        "LEFT JOIN files AS f ON f.path = o.path "
+                        "WHERE f.path IS NULL OR o.processed > f.processed "
+                        "OR (o.processed = f.processed AND o.mtime > f.mtime)")
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO dirs SELECT o.* "
+                        "FROM other.dirs AS o "
+                        "LEFT JOIN dirs AS d ON d.path = o.path "
+                        "WHERE d.path IS NULL OR o.mtime > d.mtime")
+            finally:
+                self._conn.execute("DETACH DATABASE other")
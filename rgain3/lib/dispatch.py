@@ -0,0 +1,242 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Run many jobs on a process pool without queueing all of them at once."""
+
+import functools
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from rgain3.lib import util
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ["Dispatcher", "WorkerStats", "nonforking_context"]
+
+# default number of jobs in flight per worker process
+DEFAULT_JOBS_PER_WORKER = 2
+
+# What is known about a worker process after its last job: the number of jobs
+# it has run and its current and peak resident set size in bytes (None if
+# unknown).
+WorkerStats = namedtuple("WorkerStats", ["pid", "jobs", "rss", "peak_rss"])
+
+# the number of jobs run by this (worker) process
+_jobs_run = 0
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _current_rss():
+    try:
+        with open("/proc/self/statm") as fp:
+            pages = int(fp.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        # the peak is an upper bound at least
+        return _peak_rss()
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _run_job(func, args, max_jobs, max_rss):
+    # Runs in a worker process. Returns the result of the job, the worker's
+    # stats and whether it should be retired.
+    global _jobs_run
+    _jobs_run += 1
+    result = func(*args)
+    rss, peak = _current_rss(), _peak_rss()
+    if rss is not None and peak is not None:
+        # the peak isn't necessarily up to date
+        peak = max(rss, peak)
+    stats = WorkerStats(os.getpid(), _jobs_run, rss, peak)
+    retire = bool(
+        (max_jobs and _jobs_run >= max_jobs) or
+        (max_rss and stats.rss is not None and stats.rss > max_rss))
+    return result, stats, retire
+
+
+def nonforking_context():
+    """Return the multiprocessing context for pools started while other
+    threads are running, which rules out forking the driver process."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn")
+
+
+class Dispatcher:
+    """Run jobs on a pool of ``jobs`` worker processes (one per CPU core by
+    default).
+
+    Jobs are added with ``submit``, typically by a producer thread, and their
+    results are consumed with ``completed``. At most ``max_in_flight`` jobs
+    are submitted to the pool at any time; beyond that, ``submit`` blocks
+    until a completed job has been consumed. The arguments of all other jobs
+    therefore don't even exist yet, so memory usage stays flat however many
+    jobs there are.
+
+    If a worker process dies, the jobs in flight fail with
+    ``BrokenProcessPool`` and a new pool is started for the next ones.
+
+    Workers which have run ``max_jobs_per_worker`` jobs or whose resident set
+    size exceeds ``max_worker_rss`` bytes after a job are retired, e.g. to
+    get rid of memory leaked by decoders. Since a ``ProcessPoolExecutor``
+    can't replace single workers, a new pool takes over all further jobs
+    then, while the old one finishes those it has got already. Other
+    threads are running by the time a pool is replaced, for either reason,
+    so new pools are started with the "forkserver" (or "spawn") method
+    unless a non-forking ``mp_context`` is given; the same goes for the
+    first pool if workers are retired. Workers may therefore need an
+    ``initializer``; it is passed on to the ``ProcessPoolExecutor`` with
+    any other ``pool_kwargs``. ``worker_stats`` tells how much memory the
+    workers used.
+    """
+
+    def __init__(self, jobs=None, max_in_flight=None,
+                 max_jobs_per_worker=None, max_worker_rss=None,
+                 **pool_kwargs):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_in_flight = (
+            max_in_flight or self.jobs * DEFAULT_JOBS_PER_WORKER)
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_worker_rss = max_worker_rss
+        if ((max_jobs_per_worker or max_worker_rss) and
+                "mp_context" not in pool_kwargs):
+            pool_kwargs["mp_context"] = nonforking_context()
+        # the arguments of the pools replacing the first one
+        self._replacement_kwargs = dict(pool_kwargs)
+        context = pool_kwargs.get("mp_context")
+        if context is None or context.get_start_method() == "fork":
+            self._replacement_kwargs["mp_context"] = nonforking_context()
+        self._executor = util.start_process_pool(self.jobs, **pool_kwargs)
+        # whether a worker of the current pool is due to be retired
+        self._retire = False
+        self._stats = {}
+        self._slots = threading.Semaphore(self.max_in_flight)
+        self._completed = queue.Queue()
+        self._lock = threading.Lock()
+        self._submitted = 0
+        # the number of jobs consumed with ``completed``
+        self._received = 0
+        # whether the end marker put by ``close`` has been consumed
+        self._close_seen = False
+        self._closed = False
+        self._shut_down = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(cancel=exc_type is not None)
+
+    def _replace_pool(self):
+        # jobs already submitted to the old pool still run
+        self._executor.shutdown(wait=False)
+        self._executor = util.start_process_pool(
+            self.jobs, **self._replacement_kwargs)
+        self._retire = False
+
+    def submit(self, key, func, *args):
+        """Run ``func(*args)`` in a worker process; ``key`` identifies the job
+        in ``completed``."""
+        self._slots.acquire()
+        with self._lock:
+            if self._closed or self._shut_down:
+                self._slots.release()
+                raise RuntimeError("cannot submit jobs anymore")
+            if self._retire:
+                self._replace_pool()
+            job = (_run_job, func, args, self.max_jobs_per_worker,
+                   self.max_worker_rss)
+            try:
+                future = self._executor.submit(*job)
+            except BrokenProcessPool:
+                self._replace_pool()
+                future = self._executor.submit(*job)
+            self._submitted += 1
+            executor = self._executor
+        future.add_done_callback(
+            functools.partial(self._done, key, executor, Future()))
+
+    def _done(self, key, executor, result, future):
+        # ``result`` is the future handed out by ``completed``; it gets the
+        # result of the job itself
+        if future.cancelled():
+            result.cancel()
+        elif future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            value, stats, retire = future.result()
+            with self._lock:
+                self._stats[stats.pid] = stats
+                if retire and executor is self._executor:
+                    self._retire = True
+            result.set_result(value)
+        self._completed.put((key, result))
+
+    def worker_stats(self):
+        """Return a list of ``WorkerStats``, one for every worker process
+        which has finished a job, in order of process ID."""
+        with self._lock:
+            return sorted(self._stats.values())
+
+    def close(self):
+        """Signal that no more jobs will be submitted."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._completed.put(None)
+
+    def completed(self):
+        """Yield ``(key, future)`` for every job as soon as it's done, until
+        ``close`` has been called and all jobs are done.
+
+        It may be called again, e.g. after submitting more jobs; every job is
+        yielded only once.
+        """
+        while True:
+            with self._lock:
+                if self._close_seen and self._received == self._submitted:
+                    return
+            item = self._completed.get()
+            if item is None:
+                self._close_seen = True
+                continue
+            self._received += 1
+            self._slots.release()
+            yield item
+
+    def shutdown(self, cancel=False):
+        """Shut the pool down, waiting for running jobs unless ``cancel`` is
+        true. A producer blocked in ``submit`` is woken up."""
+        with self._lock:
+            self._shut_down = True
+        for _ in range(self.max_in_flight):
+            self._slots.release()
+        self._executor.shutdown(wait=not cancel, cancel_futures=cancel)
@@ -0,0 +1,146 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""A columnar, NumPy-backed container for large amounts of Replay Gain data.
+
+NumPy is an optional dependency; install ``rgain3[numpy]`` to use this module.
+"""
+
+from rgain3.lib import GainData, GainType
+from rgain3.lib.rgio import (
+    GAIN_EPSILON,
+    PEAK_EPSILON,
+    REF_LEVEL_EPSILON,
+    RVA2_GAIN_MAX,
+    RVA2_GAIN_MIN,
+    RVA2_PEAK_MAX,
+    RVA2_PEAK_MIN,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ["GainTable"]
+
+# gain types are stored as small integers; missing entries use -1
+_GAIN_TYPES = list(GainType)
+_MISSING = -1
+
+
+class GainTable:
+    """A table of Replay Gain data for a list of paths.
+
+    Instead of one ``GainData`` instance per path, the data is stored in
+    NumPy arrays: ``gain``, ``peak`` and ``ref_level`` (float64) and
+    ``gain_type`` (int8, an index into ``GainType`` or -1 if there's no gain
+    data for a path). ``paths`` maps a path to its row.
+    """
+
+    def __init__(self, paths, gain, peak, ref_level, gain_type):
+        if np is None:
+            raise ImportError("GainTable requires NumPy")
+        self.paths = {path: i for i, path in enumerate(paths)}
+        self.gain = np.asarray(gain, dtype=np.float64)
+        self.peak = np.asarray(peak, dtype=np.float64)
+        self.ref_level = np.asarray(ref_level, dtype=np.float64)
+        self.gain_type = np.asarray(gain_type, dtype=np.int8)
+
+    @classmethod
+    def from_gaindata(cls, items):
+        """Create a table from ``(path, GainData or None)`` pairs, e.g. the
+        ``items()`` of ``ReplayGain.track_data``."""
+        paths, rows = [], []
+        for path, gaindata in items:
+            paths.append(path)
+            if gaindata is None:
+                rows.append((np.nan, np.nan, np.nan, _MISSING))
+            else:
+                rows.append((
+                    gaindata.gain, gaindata.peak,
+                    np.nan if gaindata.ref_level is None
+                    else gaindata.ref_level,
+                    _GAIN_TYPES.index(gaindata.gain_type)))
+        columns = list(zip(*rows)) if rows else [()] * 4
+        return cls(paths, *columns)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __getitem__(self, path):
+        """Return the ``GainData`` of ``path`` or None."""
+        i = self.paths[path]
+        if self.gain_type[i] == _MISSING:
+            return None
+        ref_level = self.ref_level[i]
+        return GainData(
+            float(self.gain[i]), float(self.peak[i]),
+            None if np.isnan(ref_level) else float(ref_level),
+            _GAIN_TYPES[self.gain_type[i]])
+
+    def __getstate__(self):
+        # store the paths as a list, which pickles more compactly
+        paths = sorted(self.paths, key=self.paths.__getitem__)
+        return (paths, self.gain, self.peak, self.ref_level, self.gain_type)
+
+    def __setstate__(self, state):
+        paths, self.gain, self.peak, self.ref_level, self.gain_type = state
+        self.paths = {path: i for i, path in enumerate(paths)}
+
+    def take(self, paths):
+        """Return a new table with the rows of ``paths``, in that order."""
+        rows = np.fromiter((self.paths[p] for p in paths), dtype=np.intp)
+        return self.__class__(
+            paths, self.gain[rows], self.peak[rows], self.ref_level[rows],
+            self.gain_type[rows])
+
+    def almost_equal(self, other):
+        """Compare this table with ``other`` row by row.
+
+        Returns a boolean array which is equivalent to calling
+        ``rgio.gaindata_almost_equal`` for every row; ``other`` has to
+        contain the potentially clamped (legacy) values. Use ``take`` to align
+        tables with different paths first.
+        """
+        if len(self) != len(other):
+            raise ValueError("tables differ in length")
+        a_missing = self.gain_type == _MISSING
+        b_missing = other.gain_type == _MISSING
+
+        with np.errstate(invalid="ignore"):
+            gain = (
+                (np.abs(self.gain - other.gain) <= GAIN_EPSILON) |
+                (np.abs(np.clip(self.gain, RVA2_GAIN_MIN, RVA2_GAIN_MAX) -
+                        other.gain) <= GAIN_EPSILON))
+            peak = (
+                (np.abs(self.peak - other.peak) <= PEAK_EPSILON) |
+                (np.abs(np.clip(self.peak, RVA2_PEAK_MIN, RVA2_PEAK_MAX) -
+                        other.peak) <= PEAK_EPSILON))
+            a_ref_missing = np.isnan(self.ref_level)
+            b_ref_missing = np.isnan(other.ref_level)
+            ref_level = (
+                (a_ref_missing & b_ref_missing) |
+                (np.abs(self.ref_level - other.ref_level) <=
+                 REF_LEVEL_EPSILON))
+
+        return np.where(
+            a_missing | b_missing,
+            a_missing & b_missing,
+            gain & peak & ref_level)
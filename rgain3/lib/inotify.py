@@ -0,0 +1,213 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Watch directory trees for changed files with Linux' inotify API, see
+inotify(7)."""
+
+import ctypes
+import errno
+import os
+import select
+import struct
+from collections import namedtuple
+
+__all__ = ["CHANGED", "REMOVED", "RESCAN", "Change", "Inotify",
+           "TreeWatcher"]
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct("iIII")
+
+Event = namedtuple("Event", ["wd", "mask", "cookie", "name"])
+
+# the kinds of ``Change``
+CHANGED = "changed"
+REMOVED = "removed"
+RESCAN = "rescan"
+
+# ``relpath`` is relative to the top of the tree; it's "" for RESCAN.
+Change = namedtuple("Change", ["kind", "relpath"])
+
+
+def _libc():
+    libc = ctypes.CDLL(None, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError(errno.ENOSYS, "inotify is not available on this system")
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify:
+    """An inotify instance; see inotify(7) for the meaning of the masks."""
+
+    def __init__(self):
+        self._libc = _libc()
+        self._fd = _check(self._libc.inotify_init1(os.O_CLOEXEC))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def add_watch(self, path, mask):
+        """Watch ``path`` for the events in ``mask``; returns the watch
+        descriptor, which is the same for every path of a directory."""
+        return _check(self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd):
+        _check(self._libc.inotify_rm_watch(self._fd, wd))
+
+    def read(self, timeout=None):
+        """Wait up to ``timeout`` seconds (forever if None) for events and
+        return a list of them, which is empty if there were none."""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + size].rstrip(b"\0")
+            offset += size
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+
+class TreeWatcher:
+    """Watch the directory tree ``top`` for files which have been written,
+    moved or removed.
+
+    New directories are watched as well, and the files in them are reported
+    as changed. If the kernel drops events, a ``RESCAN`` change tells that
+    the whole tree needs to be scanned again.
+    """
+
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+    def __init__(self, top):
+        self.top = top
+        self._inotify = Inotify()
+        # the directory of every watch descriptor
+        self._dirs = {}
+        try:
+            self._add_tree("")
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self._inotify.close()
+
+    def _add_tree(self, reldir):
+        # Watch ``reldir`` and all directories below it; returns the files
+        # in them.
+        found = []
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.top, reldir)):
+            try:
+                wd = self._inotify.add_watch(dirpath, self.MASK)
+            except FileNotFoundError:
+                # removed in the meantime
+                dirnames[:] = []
+                continue
+            except OSError as exc:
+                if exc.errno == errno.ENOSPC:
+                    raise OSError(exc.errno, "too many directories to watch, "
+                                  "see fs.inotify.max_user_watches") from None
+                raise
+            dirrel = os.path.relpath(dirpath, self.top)
+            dirrel = "" if dirrel == os.curdir else dirrel
+            self._dirs[wd] = dirrel
+            found.extend(os.path.join(dirrel, name) for name in filenames)
+        return found
+
+    def _drop_tree(self, reldir):
+        # Stop watching the tree ``reldir``, which has been moved away.
+        prefix = os.path.join(reldir, "")
+        for wd, dirrel in list(self._dirs.items()):
+            if dirrel == reldir or dirrel.startswith(prefix):
+                del self._dirs[wd]
+                try:
+                    self._inotify.rm_watch(wd)
+                except OSError:
+                    # the kernel has removed it already
+                    pass
+
+    def changes(self, timeout=None):
+        """Wait up to ``timeout`` seconds (forever if None) for events and
+        return a list of ``Change`` tuples, which may be empty."""
+        changes = []
+        for event in self._inotify.read(timeout):
+            if event.mask & IN_Q_OVERFLOW:
+                changes.append(Change(RESCAN, ""))
+                continue
+            if event.mask & IN_IGNORED:
+                self._dirs.pop(event.wd, None)
+                continue
+            reldir = self._dirs.get(event.wd)
+            if reldir is None:
+                continue
+            relpath = os.path.join(reldir, event.name)
+            if event.mask & IN_ISDIR:
+                if event.mask & (IN_CREATE | IN_MOVED_TO):
+                    changes.extend(
+                        Change(CHANGED, path)
+                        for path in self._add_tree(relpath))
+                elif event.mask & (IN_MOVED_FROM | IN_DELETE):
+                    self._drop_tree(relpath)
+                    changes.append(Change(REMOVED, relpath))
+            elif event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changes.append(Change(CHANGED, relpath))
+            elif event.mask & (IN_MOVED_FROM | IN_DELETE):
+                changes.append(Change(REMOVED, relpath))
+        return changes
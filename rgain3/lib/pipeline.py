@@ -0,0 +1,132 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Stages to overlap the analysis of audio files with tag I/O."""
+
+import queue
+import threading
+
+from rgain3.lib.rgio import AtomicWriteError
+
+__all__ = ["TagWriter", "write_album"]
+
+# default number of albums that may wait for the writer stage
+DEFAULT_WRITE_DEPTH = 4
+
+
+def write_album(formats_map, items, atomic=False, fsync=False):
+    """Write ``(filename, trackgain, albumgain)`` tuples of one album and
+    return the list of ``TagResult`` instances of the failed files.
+
+    With ``atomic`` (or ``fsync``), either all or none of the files are
+    modified, see ``BaseFormatsMap.write_album_gain``.
+    """
+    if atomic or fsync:
+        try:
+            formats_map.write_album_gain(items, fsync)
+        except AtomicWriteError as exc:
+            return exc.errors
+        return []
+    return [
+        result for result in formats_map.write_gain_many(items)
+        if result.error is not None
+    ]
+
+
+class TagWriter:
+    """Write Replay Gain information to files in background threads.
+
+    Albums are handed over with ``submit`` and written one after another by a
+    separate thread, so that the caller can go on analyzing the next album in
+    the meantime. With ``threads`` > 1, that many albums are written at the
+    same time, in no particular order. At most ``depth`` albums are queued;
+    once the queue is full, ``submit`` blocks until the writer has caught up.
+
+    If a ``done`` callback is passed to ``submit``, it is called from the
+    writer thread with the list of ``TagResult`` instances of the failed files
+    (empty on success). Otherwise, the first error is re-raised by the next
+    call to ``submit`` or ``close``. The same applies to exceptions raised by
+    a ``done`` callback.
+    """
+
+    def __init__(self, formats_map, depth=DEFAULT_WRITE_DEPTH, atomic=False,
+                 fsync=False, threads=1):
+        self.formats_map = formats_map
+        self.atomic = atomic
+        self.fsync = fsync
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._error = None
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True)
+            for _ in range(max(1, threads))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't mask the original exception
+            self._shutdown()
+
+    def submit(self, items, done=None):
+        """Queue ``(filename, trackgain, albumgain)`` tuples of one album."""
+        self._raise_error()
+        self._queue.put((list(items), done))
+
+    def close(self):
+        """Wait for all queued albums to be written."""
+        self._shutdown()
+        self._raise_error()
+
+    def _shutdown(self):
+        alive = [thread for thread in self._threads if thread.is_alive()]
+        for _ in alive:
+            self._queue.put(None)
+        for thread in alive:
+            thread.join()
+
+    def _raise_error(self):
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _set_error(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            items, done = task
+            try:
+                errors = write_album(self.formats_map, items, self.atomic,
+                                     self.fsync)
+                if done is not None:
+                    done(errors)
+                elif errors:
+                    self._set_error(errors[0].error)
+            except BaseException as exc:
+                self._set_error(exc)
@@ -0,0 +1,329 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Run jobs on worker processes on other hosts, connected over TCP."""
+
+import collections
+import functools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+__all__ = ["RemoteDispatcher", "WorkerLost", "run_worker"]
+
+# jobs submitted but not consumed yet, unless the caller says otherwise
+DEFAULT_MAX_IN_FLIGHT = 64
+# how long a worker keeps trying to reach the coordinator, in seconds
+DEFAULT_CONNECT_TIMEOUT = 60
+# how often a worker tells the coordinator it's alive while it runs a job,
+# and how long the coordinator waits for any message from it, in seconds
+DEFAULT_HEARTBEAT_INTERVAL = 10
+DEFAULT_WORKER_TIMEOUT = 60
+
+# sent by workers instead of a reply while they're running a job
+_HEARTBEAT = "alive"
+
+
+class WorkerLost(Exception):
+    """The connection to the worker running a job was lost."""
+
+
+class RemoteDispatcher:
+    """Run jobs on worker processes which connect to ``address``, a
+    ``(host, port)`` tuple, and authenticate with ``authkey``; see
+    ``run_worker``. Port 0 picks a free port, which ``address`` tells then.
+
+    It has the same interface as ``dispatch.Dispatcher``. Every worker
+    connection pulls one job at a time, so faster hosts simply get more of
+    them. Functions and arguments are pickled, so the workers must run the
+    same version of this package, and everyone who knows ``authkey`` can run
+    code on them.
+
+    A worker is lost if its connection breaks or nothing (not even a
+    heartbeat) has been heard from it for ``worker_timeout`` seconds. Its
+    job is handed to another worker then; only if no other worker is
+    connected, it fails with ``WorkerLost``. Jobs wait for as long as no
+    worker is connected, and idle workers stay connected until all jobs are
+    done, in case one of them has to be run again.
+    """
+
+    def __init__(self, address, authkey, max_in_flight=None,
+                 worker_timeout=DEFAULT_WORKER_TIMEOUT):
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._authkey = authkey
+        self.max_in_flight = max_in_flight or DEFAULT_MAX_IN_FLIGHT
+        self.worker_timeout = worker_timeout
+        self._slots = threading.Semaphore(self.max_in_flight)
+        # ``(func, args, future)`` for jobs waiting for a worker, guarded by
+        # ``_lock`` along with the number of jobs handed to workers and the
+        # number of connected workers
+        self._pending = collections.deque()
+        self._running = 0
+        self._workers = 0
+        self._completed = queue.Queue()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._submitted = 0
+        self._received = 0
+        self._close_seen = False
+        self._closed = False
+        self._shut_down = False
+        self._threads = set()
+        self._accepter = threading.Thread(target=self._accept, daemon=True)
+        self._accepter.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(cancel=exc_type is not None)
+
+    def submit(self, key, func, *args):
+        """Run ``func(*args)`` on a worker; ``key`` identifies the job in
+        ``completed``."""
+        self._slots.acquire()
+        future = Future()
+        future.add_done_callback(functools.partial(self._done, key))
+        with self._lock:
+            if self._closed or self._shut_down:
+                self._slots.release()
+                raise RuntimeError("cannot submit jobs anymore")
+            self._submitted += 1
+            self._pending.append((func, args, future))
+            self._changed.notify()
+
+    def _done(self, key, future):
+        self._completed.put((key, future))
+
+    def worker_stats(self):
+        """Workers on other hosts don't report their memory usage."""
+        return []
+
+    def close(self):
+        """Signal that no more jobs will be submitted."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._completed.put(None)
+                # workers stop once all jobs are done
+                self._changed.notify_all()
+
+    def completed(self):
+        """Yield ``(key, future)`` for every job as soon as it's done, until
+        ``close`` has been called and all jobs are done."""
+        while True:
+            with self._lock:
+                if self._close_seen and self._received == self._submitted:
+                    return
+            item = self._completed.get()
+            if item is None:
+                self._close_seen = True
+                continue
+            self._received += 1
+            self._slots.release()
+            yield item
+
+    def shutdown(self, cancel=False):
+        """Stop listening and tell the workers to quit once they're done,
+        waiting for running jobs unless ``cancel`` is true. Jobs which no
+        worker has got yet are cancelled."""
+        with self._lock:
+            if self._shut_down:
+                return
+            self._shut_down = True
+            pending = list(self._pending)
+            self._pending.clear()
+            self._changed.notify_all()
+        for _ in range(self.max_in_flight):
+            self._slots.release()
+        # wake up the accepting thread
+        try:
+            Client(self.address, authkey=self._authkey).close()
+        except OSError:
+            pass
+        self._accepter.join()
+        self._listener.close()
+        for _, _, future in pending:
+            # jobs of lost workers are running already
+            if not future.cancel():
+                future.set_exception(WorkerLost("shut down"))
+        if not cancel:
+            with self._lock:
+                threads = list(self._threads)
+            for thread in threads:
+                thread.join()
+
+    def _accept(self):
+        while not self._shut_down:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue
+            if self._shut_down:
+                conn.close()
+                break
+            thread = threading.Thread(target=self._serve, args=(conn,),
+                                      daemon=True)
+            with self._lock:
+                self._threads.add(thread)
+            thread.start()
+
+    def _next_job(self):
+        # The next ``(func, args, future)`` for a worker, or None once there
+        # are no more. Idle workers wait while other workers run jobs, which
+        # may come back if those are lost.
+        with self._lock:
+            while True:
+                if self._shut_down:
+                    return None
+                if self._pending:
+                    item = self._pending.popleft()
+                    future = item[2]
+                    # jobs of lost workers are running already
+                    if future.running() or \
+                            future.set_running_or_notify_cancel():
+                        self._running += 1
+                        return item
+                elif self._closed and not self._running:
+                    return None
+                else:
+                    self._changed.wait()
+
+    def _receive(self, conn):
+        # the reply to a job, skipping heartbeats
+        while True:
+            if not conn.poll(self.worker_timeout):
+                raise WorkerLost("no message from worker for %g seconds" %
+                                 self.worker_timeout)
+            message = conn.recv()
+            if message != _HEARTBEAT:
+                return message
+
+    def _lost(self, item, exc):
+        # hand the job of a lost worker to another one, if there is any
+        with self._lock:
+            self._running -= 1
+            # this worker is still counted
+            retry = self._workers > 1 and not self._shut_down
+            if retry:
+                self._pending.appendleft(item)
+            self._changed.notify_all()
+        if not retry:
+            item[2].set_exception(
+                WorkerLost("lost connection to worker: %r" % exc))
+
+    def _serve(self, conn):
+        # hand out jobs to one worker connection until there are no more
+        with self._lock:
+            self._workers += 1
+        try:
+            with conn:
+                while True:
+                    item = self._next_job()
+                    if item is None:
+                        try:
+                            conn.send(None)
+                        except OSError:
+                            pass
+                        return
+                    func, args, future = item
+                    try:
+                        conn.send((func, args))
+                        ok, value = self._receive(conn)
+                    except (OSError, EOFError, WorkerLost) as exc:
+                        self._lost(item, exc)
+                        return
+                    with self._lock:
+                        self._running -= 1
+                        self._changed.notify_all()
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+        finally:
+            with self._lock:
+                self._workers -= 1
+                self._changed.notify_all()
+
+
+def _send_heartbeats(send, done, interval):
+    while not done.wait(interval):
+        try:
+            send(_HEARTBEAT)
+        except OSError:
+            return
+
+
+def run_worker(address, authkey, timeout=DEFAULT_CONNECT_TIMEOUT,
+               heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+    """Connect to the ``RemoteDispatcher`` at ``address`` and run the jobs it
+    hands out, one at a time, until it has no more.
+
+    The connection is retried for ``timeout`` seconds if the coordinator
+    isn't listening yet. While a job runs, a heartbeat is sent every
+    ``heartbeat_interval`` seconds. Returns the number of jobs run.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+        except (EOFError, ConnectionResetError):
+            # the coordinator is shutting down
+            return 0
+
+    lock = threading.Lock()
+
+    def send(message):
+        with lock:
+            conn.send(message)
+
+    count = 0
+    with conn:
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                return count
+            if job is None:
+                return count
+            func, args = job
+            done = threading.Event()
+            heartbeats = threading.Thread(
+                target=_send_heartbeats, args=(send, done, heartbeat_interval),
+                daemon=True)
+            heartbeats.start()
+            try:
+                reply = (True, func(*args))
+            except Exception as exc:
+                reply = (False, exc)
+            finally:
+                done.set()
+                heartbeats.join()
+            try:
+                send(reply)
+            except Exception:
+                # e.g. an exception which can't be pickled
+                send((False, RuntimeError(repr(reply[1]))))
+            count += 1
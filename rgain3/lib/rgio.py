@@ -15,7 +15,13 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import abc
+import errno
+import glob
+import os
+import shutil
+import tempfile
 import warnings
+from collections import namedtuple
 
 import mutagen
 from mutagen.easyid3 import EasyID3
@@ -25,6 +31,7 @@ from mutagen.id3._util import ID3NoHeaderError
 from rgain3.lib import GainData
 from rgain3.lib.util import (
     almost_equal,
+    bounded_map,
     extension_for_file,
     parse_db,
     parse_peak,
@@ -324,6 +331,113 @@ class UnknownFiletype(Exception):
     pass
 
 
+# result of a bulk tag operation; ``result`` is a ``(trackdata, albumdata)``
+# tuple for reads and None for writes, ``error`` is the exception raised for
+# that file, if any
+TagResult = namedtuple("TagResult", ["filename", "result", "error"])
+
+# default number of threads used for bulk tag I/O; tag reading and writing is
+# dominated by I/O latency, so this may well exceed the number of CPU cores
+DEFAULT_IO_JOBS = 8
+
+
+class AtomicWriteError(Exception):
+    """Writing the gain of an album failed and no file was modified.
+
+    ``errors`` is a list of ``TagResult`` instances of the failed files.
+    """
+    def __init__(self, errors):
+        super().__init__("; ".join(
+            "{}: {}".format(r.filename, r.error) for r in errors))
+        self.errors = errors
+
+
+# marks the temporary copies (and backups) made by ``write_album_gain``
+STAGED_MARKER = ".rgain3-tmp"
+
+
+def is_staged_file(filename):
+    """Check whether ``filename`` is a temporary copy or backup made by
+    ``BaseFormatsMap.write_album_gain``, e.g. one left over by a crash."""
+    basename = os.path.basename(filename)
+    return basename.startswith(".") and STAGED_MARKER in basename
+
+
+# the errors of ``os.link`` on file systems without hard links
+_NO_LINK_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV}
+
+
+def _remove_leftovers(filename):
+    # Clean up after an earlier run that crashed while writing ``filename``.
+    # If it crashed while the copies of an album replaced the originals, the
+    # album may be half updated; the backups of the files which have been
+    # replaced already are still there, so they are restored first. Backups
+    # are only complete files, and the copies are simply discarded.
+    dirname, basename = os.path.split(filename)
+    pattern = glob.escape(os.path.join(dirname, ".%s." % basename))
+    for backup in glob.glob(pattern + "*" + STAGED_MARKER + "*.orig"):
+        os.replace(backup, filename)
+    _discard(glob.glob(pattern + "*" + STAGED_MARKER + "*"))
+
+
+def _backup_file(filename, backup):
+    # A second link to the original is enough for a backup. File systems
+    # without hard links (e.g. vfat or many SMB and FUSE mounts) get a copy,
+    # which only takes the name of the backup once it's complete.
+    try:
+        os.link(filename, backup)
+    except OSError as exc:
+        if exc.errno not in _NO_LINK_ERRNOS:
+            raise
+        partial = backup + ".part"
+        try:
+            shutil.copy2(filename, partial)
+            os.replace(partial, backup)
+        except BaseException:
+            _discard([partial])
+            raise
+
+
+def _stage_file(filename):
+    # Create a copy of ``filename`` next to it, so that it can later replace
+    # the original with an atomic rename. The extension is kept to allow
+    # guessing the file type of the copy.
+    _remove_leftovers(filename)
+    dirname, basename = os.path.split(filename)
+    fd, staged = tempfile.mkstemp(
+        prefix=".%s." % basename,
+        suffix="%s%s" % (STAGED_MARKER, os.path.splitext(basename)[1]),
+        dir=dirname or ".")
+    os.close(fd)
+    try:
+        shutil.copy2(filename, staged)
+        st = os.stat(filename)
+        try:
+            os.chown(staged, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+    except BaseException:
+        os.unlink(staged)
+        raise
+    return staged
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _discard(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
 class BaseFormatsMap:
     _simplereaderwriter = SimpleTagReaderWriter()
     _mp4readerwriter = MP4TagReaderWriter()
@@ -375,8 +489,95 @@ class BaseFormatsMap:
             return self.BASE_MAP[ext]
         raise UnknownFiletype(ext)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        """Release the resources held by this map, if any."""
+        pass
+
     def read_gain(self, filename):
         return self.accessor(filename).read_gain(filename)
 
     def write_gain(self, filename, trackgain, albumgain):
         self.accessor(filename).write_gain(filename, trackgain, albumgain)
+
+    def read_gain_many(self, filenames, jobs=DEFAULT_IO_JOBS, ordered=True):
+        """Read Replay Gain data from many files using a bounded thread pool.
+
+        Yields a ``TagResult`` for every file name, either in the order of
+        ``filenames`` or, if ``ordered`` is False, as soon as it is available.
+        Errors are not raised but returned in the ``error`` field.
+        """
+        for filename, result, exc in bounded_map(
+                self.read_gain, filenames, jobs, ordered):
+            yield TagResult(filename, result, exc)
+
+    def write_gain_many(self, items, jobs=DEFAULT_IO_JOBS, ordered=True):
+        """Write Replay Gain data to many files using a bounded thread pool.
+
+        ``items`` is an iterable of ``(filename, trackgain, albumgain)``
+        tuples. Yields a ``TagResult`` for every item, see ``read_gain_many``.
+        """
+        def write(item):
+            self.write_gain(*item)
+
+        for item, _, exc in bounded_map(write, items, jobs, ordered):
+            yield TagResult(item[0], None, exc)
+
+    def write_album_gain(self, items, fsync=False, jobs=DEFAULT_IO_JOBS):
+        """Write Replay Gain data to all files of an album at once.
+
+        ``items`` is an iterable of ``(filename, trackgain, albumgain)``
+        tuples. The tags are written to temporary copies of the files first;
+        only if all of them were written successfully, the copies replace the
+        original files. Otherwise, the copies are discarded and an
+        ``AtomicWriteError`` is raised. If ``fsync`` is True, the written data
+        is flushed to disk once for the whole album before it is committed.
+        """
+        items = list(items)
+        staged = {}
+
+        def stage(item):
+            filename, trackgain, albumgain = item
+            accessor = self.accessor(filename)
+            staged[filename] = _stage_file(filename)
+            accessor.write_gain(staged[filename], trackgain, albumgain)
+            if fsync:
+                _fsync_path(staged[filename])
+
+        errors = [
+            TagResult(item[0], None, exc)
+            for item, _, exc in bounded_map(stage, items, jobs)
+            if exc is not None
+        ]
+        if errors:
+            _discard(staged.values())
+            raise AtomicWriteError(errors)
+
+        # Keep backups of the originals, so that everything can be rolled
+        # back if one of the renames fails (or the next write of the files
+        # can, if this process dies in the middle of the renames).
+        backups = {}
+        committed = []
+        try:
+            for filename, _, _ in items:
+                backup = staged[filename] + ".orig"
+                _backup_file(filename, backup)
+                backups[filename] = backup
+                os.replace(staged[filename], filename)
+                committed.append(filename)
+        except OSError as exc:
+            for restored in committed:
+                os.replace(backups.pop(restored), restored)
+            _discard(backups.values())
+            _discard(staged[f] for f in staged if f not in committed)
+            raise AtomicWriteError([TagResult(filename, None, exc)])
+        _discard(backups.values())
+
+        if fsync:
+            for dirname in {os.path.dirname(f) or "." for f, _, _ in items}:
+                _fsync_path(dirname)
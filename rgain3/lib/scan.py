@@ -0,0 +1,160 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Walk large directory trees, e.g. on network storage, quickly."""
+
+import os
+import stat
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+__all__ = ["DirRecord", "ScanEntry", "SkippedDir", "SubtreeDone", "scan_tree"]
+
+# default number of directories which are read at the same time
+DEFAULT_SCAN_JOBS = 8
+
+# ``relpath`` is relative to the scanned directory, ``stat`` is the result of
+# ``os.stat`` for ``path``
+ScanEntry = namedtuple("ScanEntry", ["relpath", "path", "stat"])
+
+# What is known about a directory after reading it: its modification time (in
+# nanoseconds) and inode and the names of its subdirectories.
+DirRecord = namedtuple("DirRecord", ["mtime", "inode", "subdirs"])
+
+# a directory which hasn't been read because it didn't change, see
+# ``scan_tree``
+SkippedDir = namedtuple("SkippedDir", ["reldir"])
+
+# yielded once a directory and all of its subdirectories have been scanned
+SubtreeDone = namedtuple("SubtreeDone", ["reldir"])
+
+
+def _unchanged(record, st):
+    return (record is not None and
+            record.mtime == st.st_mtime_ns and
+            record.inode == st.st_ino)
+
+
+def _stat_subdirs(path, reldir, names):
+    # re-stat the subdirectories of a skipped directory
+    subdirs = []
+    for name in names:
+        subpath = os.path.join(path, name)
+        try:
+            st = os.lstat(subpath)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            subdirs.append((subpath, os.path.join(reldir, name), st))
+    return subdirs
+
+
+def _scan_dir(path, reldir, dir_stat, dirs, fast):
+    if fast:
+        record = dirs.get_dir(reldir)
+        if _unchanged(record, dir_stat):
+            return ([SkippedDir(reldir)],
+                    _stat_subdirs(path, reldir, record.subdirs), None)
+
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                relpath = os.path.join(reldir, entry.name)
+                try:
+                    # Neither of these needs a system call on most platforms
+                    # and file systems. Just like os.walk, don't follow
+                    # symbolic links to directories.
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((
+                            entry.path, relpath,
+                            entry.stat(follow_symlinks=False)))
+                    elif entry.is_file():
+                        # stat() is cached by the entry, so that's the only
+                        # stat call for this file
+                        files.append(
+                            ScanEntry(relpath, entry.path, entry.stat()))
+                except OSError:
+                    # e.g. a file removed since the directory was read
+                    pass
+    except OSError:
+        # like os.walk, ignore directories which can't be read
+        return [], [], None
+    record = DirRecord(
+        dir_stat.st_mtime_ns, dir_stat.st_ino,
+        sorted(os.path.basename(subdir[1]) for subdir in subdirs))
+    return files, subdirs, record
+
+
+def scan_tree(root, jobs=DEFAULT_SCAN_JOBS, dirs=None, fast=False,
+              subtrees=False):
+    """Find all files in the directory tree ``root``.
+
+    Yields a ``ScanEntry`` for every regular file (or symbolic link to one).
+    Directories are read by a pool of ``jobs`` threads, so the entries of
+    different subtrees are yielded in no particular order. Unreadable
+    directories are skipped.
+
+    ``dirs`` is an object with ``get_dir(reldir)`` and
+    ``set_dir(reldir, record)`` methods, e.g. a ``cache.Cache``. If given,
+    the ``DirRecord`` of every directory that has been read is stored with
+    ``set_dir`` once all of its files have been yielded. With ``fast``, a
+    directory whose modification time and inode match its stored record isn't
+    read at all; instead, a ``SkippedDir`` is yielded and only its known
+    subdirectories are descended into. Note that this misses files that have
+    been modified in place, since that doesn't change the directory.
+
+    With ``subtrees``, a ``SubtreeDone`` is yielded for every directory once
+    the entries of the directory itself and of all its subdirectories have
+    been yielded; the one for ``root`` (with ``reldir`` "") comes last.
+    """
+    if fast and dirs is None:
+        raise ValueError("fast scanning needs directory records")
+    try:
+        root_stat = os.stat(root)
+    except OSError:
+        return
+
+    # the number of directories in each subtree which haven't been read yet
+    remaining = {"": 1}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        pending = {
+            executor.submit(_scan_dir, root, "", root_stat, dirs, fast): ""
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                reldir = pending.pop(future)
+                entries, subdirs, record = future.result()
+                for path, subreldir, st in subdirs:
+                    subfuture = executor.submit(
+                        _scan_dir, path, subreldir, st, dirs, fast)
+                    pending[subfuture] = subreldir
+                    remaining[subreldir] = 1
+                remaining[reldir] += len(subdirs)
+                yield from entries
+                if dirs is not None and record is not None:
+                    dirs.set_dir(reldir, record)
+
+                # this directory is done; so may be its ancestors
+                while reldir is not None:
+                    remaining[reldir] -= 1
+                    if remaining[reldir]:
+                        break
+                    del remaining[reldir]
+                    if subtrees:
+                        yield SubtreeDone(reldir)
+                    reldir = os.path.dirname(reldir) if reldir else None
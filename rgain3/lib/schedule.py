@@ -0,0 +1,133 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Plan the jobs of a ``collectiongain`` run by their estimated cost."""
+
+import hashlib
+import heapq
+import math
+
+__all__ = ["estimate_costs", "in_shard", "plan_jobs", "select_shard"]
+
+# assumed for files whose length isn't known: the bit rate in bytes per
+# second (about 256 kbit/s) and the length of a track in seconds
+DEFAULT_BYTE_RATE = 32000
+DEFAULT_LENGTH = 240.0
+
+# single tracks are split into chunks so that there are about this many jobs
+# per worker, which leaves some room for balancing
+JOBS_PER_WORKER = 4
+
+
+def estimate_costs(records):
+    """Estimate the time it takes to analyze each file.
+
+    ``records`` are ``(path, length, size)`` tuples; ``length`` (in seconds)
+    and ``size`` (in bytes) may be None. Returns a dict mapping paths to their
+    cost, which is the length of the audio; if that isn't known, it's
+    estimated from the file size and the average bit rate of the others.
+    """
+    costs = {}
+    # the sizes of the files whose length isn't known
+    unknown = {}
+    known_length = known_size = 0
+    for path, length, size in records:
+        if length:
+            costs[path] = length
+            if size:
+                known_length += length
+                known_size += size
+        elif size:
+            unknown[path] = size
+        else:
+            costs[path] = DEFAULT_LENGTH
+
+    if known_size:
+        seconds_per_byte = known_length / known_size
+    else:
+        seconds_per_byte = 1 / DEFAULT_BYTE_RATE
+    for path, size in unknown.items():
+        costs[path] = size * seconds_per_byte
+    return costs
+
+
+def plan_jobs(albums, single_tracks, costs, jobs):
+    """Return the ``(tracks, album_id)`` jobs for ``albums`` (a dict of
+    album IDs and their tracks) and ``single_tracks``, longest first.
+
+    Single tracks are distributed over chunks of roughly equal ``costs``,
+    sized so that there are a few jobs for each of the ``jobs`` workers, so
+    that the last jobs to finish are short ones.
+    """
+    def track_cost(path):
+        return costs.get(path, DEFAULT_LENGTH)
+
+    def cost(tracks):
+        return sum(map(track_cost, tracks))
+
+    planned = [
+        (cost(tracks), tracks, album_id)
+        for album_id, tracks in albums.items()
+    ]
+    if single_tracks:
+        singles_cost = cost(single_tracks)
+        target = (sum(c for c, _, _ in planned) + singles_cost) / (
+            max(1, jobs) * JOBS_PER_WORKER)
+        num_chunks = 1
+        if target > 0:
+            num_chunks = max(1, min(
+                len(single_tracks), math.ceil(singles_cost / target)))
+
+        # longest processing time first: each track goes to the chunk with
+        # the lowest cost so far
+        chunks = [(0.0, i, []) for i in range(num_chunks)]
+        for path in sorted(single_tracks, key=track_cost, reverse=True):
+            chunk_cost, i, tracks = heapq.heappop(chunks)
+            tracks.append(path)
+            heapq.heappush(chunks, (chunk_cost + track_cost(path), i, tracks))
+        planned.extend(
+            (chunk_cost, sorted(tracks), None)
+            for chunk_cost, _, tracks in chunks)
+
+    planned.sort(key=lambda job: -job[0])
+    return [(tracks, album_id) for _, tracks, album_id in planned]
+
+
+def in_shard(key, shard):
+    """Check whether the job ``key``, e.g. an album ID, belongs to ``shard``,
+    a ``(k, n)`` tuple denoting the k-th of n shards (counting from 1).
+
+    The result only depends on ``key``, so every host running a shard of the
+    same music directory picks its jobs without asking the others.
+    """
+    k, n = shard
+    digest = hashlib.md5(key.encode("utf-8", "surrogateescape")).digest()
+    return int.from_bytes(digest[:8], "big") % n == k - 1
+
+
+def select_shard(albums, single_tracks, shard):
+    """Return the ``(albums, single_tracks)`` of ``shard``, see ``in_shard``.
+
+    Albums are assigned by their ID, single tracks by their path. A
+    ``shard`` of None selects everything.
+    """
+    if shard is None:
+        return albums, single_tracks
+    return (
+        {album_id: tracks for album_id, tracks in albums.items()
+         if in_shard(album_id, shard)},
+        [path for path in single_tracks if in_shard(path, shard)],
+    )
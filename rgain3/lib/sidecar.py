@@ -0,0 +1,213 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Store Replay Gain information in a local SQLite database instead of the
+audio files themselves, e.g. for libraries on read-only storage.
+"""
+
+import os
+import sqlite3
+import threading
+
+from rgain3.lib import GainData
+from rgain3.lib.rgio import (
+    AtomicWriteError,
+    BaseFormatsMap,
+    BaseTagReaderWriter,
+    TagResult,
+)
+
+__all__ = ["SQLiteTagReaderWriter", "SidecarFormatsMap"]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS gain (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    track_gain REAL,
+    track_peak REAL,
+    album_gain REAL,
+    album_peak REAL,
+    ref_level REAL
+)
+"""
+
+
+class SQLiteTagReaderWriter(BaseTagReaderWriter):
+    """Read and write Replay Gain data from/to a SQLite database.
+
+    Entries are keyed by the absolute path of a file. Its size and
+    modification time serve as content identity: once the file is modified,
+    the stored data is considered stale and no gain data is returned for it.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._generation = 0
+
+    def _connection(self):
+        # connections may neither be shared between threads nor survive a
+        # fork, so there's one per thread and process
+        key = (os.getpid(), self._generation)
+        if getattr(self._local, "key", None) != key:
+            dirname = os.path.dirname(os.path.abspath(self.database))
+            os.makedirs(dirname, exist_ok=True)
+            # ``close`` may be called from another thread than the one that
+            # opened the connection
+            conn = sqlite3.connect(self.database, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(_SCHEMA)
+            with self._lock:
+                self._connections.append((key[0], conn))
+            self._local.conn = conn
+            self._local.key = key
+        return self._local.conn
+
+    def close(self):
+        """Close the connections of all threads of this process.
+
+        Must not be called while other threads are still using this instance.
+        It can be used again afterwards, new connections are opened as
+        needed.
+        """
+        pid = os.getpid()
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        for owner, conn in connections:
+            # connections inherited from the parent process belong to it
+            if owner == pid:
+                conn.close()
+
+    def _lookup(self, conn, path, st):
+        row = conn.execute(
+            "SELECT size, mtime_ns, track_gain, track_peak, album_gain, "
+            "album_peak, ref_level FROM gain WHERE path = ?",
+            (path,)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            return None
+        return row[2:]
+
+    def read_gain(self, filename):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        row = self._lookup(self._connection(), path, st)
+        if row is None:
+            return None, None
+        track_gain, track_peak, album_gain, album_peak, ref_level = row
+        trackdata = albumdata = None
+        if track_gain is not None:
+            trackdata = GainData(track_gain, track_peak)
+        if album_gain is not None:
+            albumdata = GainData(album_gain, album_peak)
+        if ref_level is not None:
+            for gaindata in (trackdata, albumdata):
+                if gaindata:
+                    gaindata.ref_level = ref_level
+        return trackdata, albumdata
+
+    def write_gain(self, filename, track_gain, album_gain):
+        self.write_gain_many([(filename, track_gain, album_gain)])
+
+    def write_gain_many(self, items):
+        """Write ``(filename, trackgain, albumgain)`` tuples in a single
+        transaction, i.e. either all or none of them are stored."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for filename, track_gain, album_gain in items:
+                self._write(conn, filename, track_gain, album_gain)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _write(self, conn, filename, track_gain, album_gain):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        # like tags, values which aren't given are left alone
+        row = list(self._lookup(conn, path, st) or (None,) * 5)
+        if track_gain:
+            row[0:2] = track_gain.gain, track_gain.peak
+            row[4] = track_gain.ref_level
+        if album_gain:
+            row[2:4] = album_gain.gain, album_gain.peak
+        conn.execute(
+            "INSERT OR REPLACE INTO gain VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [path, st.st_size, st.st_mtime_ns] + row)
+
+
+class SidecarFormatsMap(BaseFormatsMap):
+    """A formats map that stores Replay Gain information of all supported
+    files in the SQLite database ``database``.
+    """
+
+    def __init__(self, database, mp3_format=None, more_mappings=None):
+        super().__init__(mp3_format, more_mappings)
+        self.sidecar = SQLiteTagReaderWriter(database)
+
+    def accessor(self, filename):
+        # raises UnknownFiletype for unsupported files
+        super().accessor(filename)
+        return self.sidecar
+
+    def close(self):
+        self.sidecar.close()
+
+    def write_gain(self, filename, trackgain, albumgain):
+        self.accessor(filename)
+        self.sidecar.write_gain(filename, trackgain, albumgain)
+
+    def write_gain_many(self, items, jobs=None, ordered=True):
+        # There's nothing to gain from threads here: all supported files are
+        # written in a single transaction on one connection.
+        items = list(items)
+        errors = {}
+        for filename, _, _ in items:
+            try:
+                self.accessor(filename)
+            except Exception as exc:
+                errors[filename] = exc
+        try:
+            self.sidecar.write_gain_many(
+                item for item in items if item[0] not in errors)
+        except Exception as exc:
+            for filename, _, _ in items:
+                errors.setdefault(filename, exc)
+        for filename, _, _ in items:
+            yield TagResult(filename, None, errors.get(filename))
+
+    def write_album_gain(self, items, fsync=False, jobs=None):
+        # Only the database is modified, so a single transaction makes this
+        # atomic and SQLite takes care of durability.
+        items = list(items)
+        for filename, _, _ in items:
+            try:
+                self.accessor(filename)
+            except Exception as exc:
+                raise AtomicWriteError([TagResult(filename, None, exc)])
+        try:
+            self.sidecar.write_gain_many(items)
+        except Exception as exc:
+            raise AtomicWriteError(
+                [TagResult(filename, None, exc) for filename, _, _ in items])
@@ -14,11 +14,19 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import collections
 import contextlib
 import logging
 import os
 import sys
-from typing import Optional, Union
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Callable, Iterable, Iterator, Optional, Tuple, Union
 
 import filetype
 
@@ -97,8 +105,71 @@ def extension_for_file(filepath: str) -> str:
     This method raises a FileNotFoundError in case the file at the given path
     does not exist.
     """
-    # raise FileNotFoundError if file does not exist
-    os.stat(filepath)
-
+    # guessing opens the file, which raises FileNotFoundError if it does not
+    # exist; there's no need for another stat call
     kind = filetype.guess(filepath)
     return kind.extension if kind else os.path.splitext(filepath)[1].lower()[1:]
+
+
+def start_process_pool(jobs: int, **kwargs) -> ProcessPoolExecutor:
+    """Create a ``ProcessPoolExecutor`` with ``jobs`` workers and start them
+    right away.
+
+    Worker processes are forked on demand otherwise, possibly while other
+    threads (e.g. of a thread pool) are running, which isn't safe.
+    """
+    executor = ProcessPoolExecutor(max(1, jobs), **kwargs)
+    executor.submit(int).result()
+    return executor
+
+
+def bounded_map(
+    func: Callable,
+    items: Iterable,
+    jobs: int,
+    ordered: bool = True,
+    executor: Optional[Executor] = None,
+) -> Iterator[Tuple[object, object, Optional[BaseException]]]:
+    """Apply ``func`` to every element of ``items`` on a pool of ``jobs``
+    threads, or on ``executor`` (e.g. a process pool with ``jobs`` workers)
+    if given.
+
+    At most ``2 * jobs`` calls are pending at any time, so ``items`` may be an
+    arbitrarily long (lazy) iterable. The function yields ``(item, result,
+    exc)`` tuples, either in input order (``ordered=True``) or as soon as each
+    call completes. Exceptions raised by ``func`` are not propagated but
+    returned as ``exc`` (in which case ``result`` is None).
+    """
+    def unpack(item, future):
+        exc = future.exception()
+        if exc is not None:
+            return item, None, exc
+        return item, future.result(), None
+
+    limit = max(1, jobs) * 2
+    if executor is None:
+        pool = ThreadPoolExecutor(max_workers=max(1, jobs))
+    else:
+        # the caller shuts its own executor down
+        pool = contextlib.nullcontext(executor)
+    with pool as executor:
+        if ordered:
+            pending = collections.deque()
+            for item in items:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= limit:
+                    yield unpack(*pending.popleft())
+            while pending:
+                yield unpack(*pending.popleft())
+        else:
+            pending = {}
+            for item in items:
+                pending[executor.submit(func, item)] = item
+                if len(pending) >= limit:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield unpack(pending.pop(future), future)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield unpack(pending.pop(future), future)
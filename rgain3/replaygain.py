@@ -14,16 +14,46 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+import collections
+import contextlib
+import csv
+import io
+import json
+import os
 import sys
+import threading
 
-from gi.repository import GLib
+import mutagen
 
-from rgain3 import Error, common_parser, init_gstreamer
-from rgain3.lib import rgcalc, rgio, util
+from rgain3 import (
+    Error,
+    PositiveIntOrNone,
+    common_parser,
+    get_formats_map,
+    gst_options_given,
+    init_gstreamer,
+)
+from rgain3.lib import albumid, pipeline, rgio, util
+from rgain3.lib.dispatch import Dispatcher
+
+# the choices of --group-by
+GROUP_BY = ("none", "dir", "album")
+# the output formats of --show
+SHOW_FORMATS = ("text", "jsonl", "csv")
+
+
+def _exc_info(exc):
+    # bulk tag operations hand us exceptions outside of an exception handler
+    return type(exc), exc, exc.__traceback__
 
 
 # calculate the gain for the given files
-def calculate_gain(files, ref_level):
+def calculate_gain(files, ref_level, on_track=None):
+    # GStreamer is only loaded for the analysis, see ``init_gstreamer``
+    from gi.repository import GLib
+
+    from rgain3.lib import rgcalc
+
     exc_slot = [None]
 
     # handlers
@@ -38,6 +68,8 @@ def calculate_gain(files, ref_level):
             print("%.2f dB" % (gaindata.gain,))
         else:
             print("done")
+        if on_track is not None:
+            on_track(filename, gaindata)
 
     def on_error(evsrc, exc):
         exc_slot[0] = exc
@@ -58,58 +90,77 @@ def calculate_gain(files, ref_level):
     return rg.track_data, rg.album_data
 
 
-# TODO: this looks like it can be fairly easily refactored into smaller pieces,
-# when there is decent coverage.
-def do_gain(files, ref_level=89, force=False, dry_run=False, album=True,  # noqa
-            mp3_format=None):
+def check_gain(formats_map, files, album=True, file=None, on_gain=None):
+    """Return those of ``files`` which need (re)calculation of Replay Gain.
+
+    The findings are printed to ``file`` (standard output by default).
+    ``on_gain`` is called with the file name and the ``(trackdata,
+    albumdata)`` tuple read from every file.
+    """
+    print("Checking for Replay Gain information ...", file=file)
+    newfiles = []
+    for filename, gain, exc in formats_map.read_gain_many(files):
+        print("  %s:" % filename, end='', file=file)
+        if exc is not None:
+            raise Error("%s: %s" % (filename, exc), _exc_info(exc))
+        else:
+            if on_gain is not None:
+                on_gain(filename, gain)
+            trackdata, albumdata = gain
+            if trackdata and albumdata:
+                print("track and album", file=file)
+            elif not trackdata and albumdata:
+                print("album only", file=file)
+                newfiles.append(filename)
+            elif trackdata and not albumdata:
+                print("track only", file=file)
+                if album:
+                    newfiles.append(filename)
+            else:
+                print("none", file=file)
+                newfiles.append(filename)
+
+    if not album or not len(newfiles):
+        return newfiles
+    # album gain can only be calculated from all tracks of the album
+    return files
 
-    formats_map = rgio.BaseFormatsMap(mp3_format)
 
+def select_files(formats_map, files, force=False, album=True, file=None,
+                 on_gain=None):
+    """Return those of ``files`` which are supported and, unless ``force`` is
+    true, need (re)calculation of Replay Gain, see ``check_gain``."""
     newfiles = []
     for filename in files:
         if not formats_map.is_supported(filename):
-            print("%s: not supported, ignoring it" % filename)
+            print("%s: not supported, ignoring it" % filename, file=file)
         else:
             newfiles.append(filename)
-    files = newfiles
 
     if not force:
-        print("Checking for Replay Gain information ...")
-        newfiles = []
-        for filename in files:
-            print("  %s:" % filename, end='')
-            try:
-                trackdata, albumdata = formats_map.read_gain(filename)
-            except Exception as exc:
-                raise Error("%s: %s" % (filename, exc))
-            else:
-                if trackdata and albumdata:
-                    print("track and album")
-                elif not trackdata and albumdata:
-                    print("album only")
-                    newfiles.append(filename)
-                elif trackdata and not albumdata:
-                    print("track only")
-                    if album:
-                        newfiles.append(filename)
-                else:
-                    print("none")
-                    newfiles.append(filename)
+        newfiles = check_gain(formats_map, newfiles, album, file, on_gain)
+    return newfiles
 
-        if not album:
-            files = newfiles
-        elif not len(newfiles):
-            files = newfiles
 
+def analyze_gain(formats_map, files, ref_level=89, force=False, album=True,
+                 on_track=None):
+    """Calculate Replay Gain for those of ``files`` which need it.
+
+    Returns a ``(tracks_data, albumdata)`` tuple, where ``albumdata`` is None
+    if ``album`` is False, or None if there is nothing to do. Nothing is
+    written to the files; ``on_track`` is called with the file name and the
+    track gain as soon as a track has been analyzed.
+    """
+    files = select_files(formats_map, files, force, album)
     if not files:
         # no files left
         print("Nothing to do.")
-        return 0
+        return None
 
     # calculate gain
     print("Calculating Replay Gain information ...")
     try:
-        tracks_data, albumdata = calculate_gain(files, ref_level)
+        tracks_data, albumdata = calculate_gain(files, ref_level, on_track)
         if album:
             print("  Album gain: %.2f dB" % (albumdata.gain,))
     except Exception as exc:
@@ -117,53 +168,366 @@ def do_gain(files, ref_level=89, force=False, dry_run=False, album=True,  # noqa
 
     if not album:
         albumdata = None
-
-    # write gain
-    if not dry_run:
-        print("Writing Replay Gain information to files ...")
-        for filename, trackdata in tracks_data.items():
-            print("  %s:" % filename, end='')
-            try:
-                formats_map.write_gain(filename, trackdata, albumdata)
-            except Exception as exc:
-                raise Error("%s: %s" % (filename, exc))
-            else:
-                print("done")
+    return tracks_data, albumdata
+
+
+def do_gain(files, ref_level=89, force=False, dry_run=False, album=True,
+            mp3_format=None, atomic=False, fsync=False, sidecar_db=None):
+
+    with get_formats_map(mp3_format, sidecar_db) as formats_map:
+        if dry_run or album:
+            result = analyze_gain(formats_map, files, ref_level, force, album)
+            if result is None:
+                return 0
+            tracks_data, albumdata = result
+            if not dry_run:
+                print("Writing Replay Gain information to files ...")
+                items = [(filename, trackdata, albumdata)
+                         for filename, trackdata in tracks_data.items()]
+                report_written(
+                    items,
+                    pipeline.write_album(formats_map, items, atomic, fsync),
+                    atomic or fsync)
+        else:
+            # Without album gain, every track can be written while the next one
+            # is being analyzed. Unlike with album gain, the tracks analyzed
+            # before an error are written.
+            failures = []
+            with pipeline.TagWriter(formats_map, atomic=atomic,
+                                    fsync=fsync) as writer:
+                result = analyze_gain(
+                    formats_map, files, ref_level, force, album,
+                    lambda filename, trackdata: writer.submit(
+                        [(filename, trackdata, None)], failures.extend))
+            if result is None:
+                return 0
+            print("Writing Replay Gain information to files ...")
+            report_written(
+                [(filename, trackdata, None)
+                 for filename, trackdata in result[0].items()],
+                failures, False)
 
     print("Done")
 
 
-# a simple Replay Gain dump
-def show_rgain_info(filenames, mp3_format=None):
-    formats_map = rgio.BaseFormatsMap(mp3_format)
-
-    for filename in filenames:
-        print(filename)
-        try:
-            trackdata, albumdata = formats_map.read_gain(filename)
-        except Exception as exc:
-            print("  <Error reading Replay Gain: %r>" % (exc,))
-            continue
-
-        if not trackdata and not albumdata:
-            print("  <No Replay Gain information>")
-
-        if trackdata and trackdata.ref_level:
-            ref_level = trackdata.ref_level
-        elif albumdata and albumdata.ref_level:
-            ref_level = albumdata.ref_level
+def report_written(items, failures, atomic=False):
+    failed = {result.filename for result in failures}
+    for filename, _, _ in items:
+        print("  %s:" % filename, end='')
+        if filename in failed:
+            print("failed")
+        elif failures and atomic:
+            print("not modified")
         else:
-            ref_level = None
+            print("done")
+    if failures:
+        filename, _, exc = failures[0]
+        raise Error("%s: %s" % (filename, exc), _exc_info(exc))
+
+
+def _records(stream, separator):
+    # The records in ``stream``, as soon as each one is complete; a pipe is
+    # read as far as it has been written.
+    rest = b""
+    while True:
+        chunk = stream.read1(64 * 1024)
+        if not chunk:
+            break
+        *records, rest = (rest + chunk).split(separator)
+        yield from records
+    if rest:
+        yield rest
+
+
+def read_jobs(stream, null=False, album=True):
+    """Yield the jobs listed in ``stream``, a binary file, as lists of file
+    names.
+
+    Every record (a line or, if ``null`` is true, a string terminated by a
+    NUL character) is a file name; an empty record ends an album. Without
+    ``album``, every file is a job of its own.
+    """
+    separator = b"\0" if null else b"\n"
+    files = []
+    for record in _records(stream, separator):
+        if not record:
+            if files:
+                yield files
+            files = []
+        elif album:
+            files.append(os.fsdecode(record))
+        else:
+            yield [os.fsdecode(record)]
+    if files:
+        yield files
+
+
+def _album_key(filename):
+    # the album ID of ``filename``, or the file name itself if it has none
+    tags = mutagen.File(filename)
+    return (tags is not None and albumid.get_album_id(tags)) or filename
+
+
+def group_files(files, group_by="none"):
+    """Split ``files`` into albums, returned as a list of lists of file names
+    in the order they first appear in: ``"none"`` keeps them together,
+    ``"dir"`` groups them by directory and ``"album"`` by the album ID in
+    their tags, see ``albumid.get_album_id``. Files without an album ID (or
+    whose tags can't be read) are albums of their own.
+    """
+    if group_by == "none":
+        return [list(files)]
+    if group_by == "dir":
+        keys = [os.path.dirname(os.path.abspath(f)) for f in files]
+    else:
+        keys = [
+            filename if exc is not None else key
+            for filename, key, exc in util.bounded_map(
+                _album_key, files, rgio.DEFAULT_IO_JOBS)
+        ]
+    groups = {}
+    for filename, key in zip(files, keys):
+        groups.setdefault(key, []).append(filename)
+    return list(groups.values())
+
+
+def gain_job(files, *args):
+    # Runs in a worker process; ``args`` are those of ``do_gain``. Returns
+    # the output of ``do_gain`` and its error message, if any.
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            do_gain(files, *args)
+    except Exception as exc:
+        return output.getvalue(), str(exc) or repr(exc)
+    return output.getvalue(), None
 
-        if ref_level is not None:
-            print("  Reference loudness %i dB" % ref_level)
 
-        if trackdata:
-            print("  Track gain %.2f dB" % trackdata.gain)
-            print("  Track peak %.8f" % trackdata.peak)
-        if albumdata:
-            print("  Album gain %.2f dB" % albumdata.gain)
-            print("  Album peak %.8f" % albumdata.peak)
+def do_gain_jobs(file_jobs, ref_level=89, force=False, dry_run=False,
+                 album=True, mp3_format=None, atomic=False, fsync=False,
+                 sidecar_db=None, jobs=0):
+    """Run ``do_gain`` for every list of files in ``file_jobs``, an iterable
+    which may still be growing (e.g. ``read_jobs`` of a pipe), on ``jobs``
+    worker processes (one per CPU core by default).
+
+    The output of every job is printed as a whole once it's done. Returns
+    the number of failed jobs.
+    """
+    feed_error = []
+    failed = 0
+    done = 0
+
+    def feed():
+        try:
+            for files in file_jobs:
+                try:
+                    dispatcher.submit(files, gain_job, files, ref_level,
+                                      force, dry_run, album, mp3_format,
+                                      atomic, fsync, sidecar_db)
+                except RuntimeError:
+                    # shut down after an interruption
+                    return
+        except BaseException as exc:
+            feed_error.append(exc)
+        finally:
+            dispatcher.close()
+
+    with Dispatcher(jobs) as dispatcher:
+        threading.Thread(target=feed, daemon=True).start()
+        for files, future in dispatcher.completed():
+            try:
+                output, error = future.result()
+            except Exception as exc:
+                # e.g. the worker process died
+                output, error = "", "%s: %s" % (", ".join(files), exc)
+            done += 1
+            print(output, end="", flush=True)
+            if error is not None:
+                failed += 1
+                print(error, file=sys.stderr, flush=True)
+    if feed_error:
+        exc = feed_error[0]
+        raise Error("Can't read the jobs: %s" % exc, _exc_info(exc))
+    print("%i jobs done, %i failed." % (done, failed))
+    return failed
+
+
+def gain_json(gaindata):
+    """Return ``gaindata`` as a dict which can be serialised to JSON, or None
+    if it's None."""
+    if gaindata is None:
+        return None
+    return {"gain": gaindata.gain, "peak": gaindata.peak,
+            "ref_level": gaindata.ref_level}
+
+
+def _print_gain_text(filename, gain, exc):
+    # a simple Replay Gain dump
+    print(filename)
+    if exc is not None:
+        print("  <Error reading Replay Gain: %r>" % (exc,))
+        return
+    trackdata, albumdata = gain
+
+    if not trackdata and not albumdata:
+        print("  <No Replay Gain information>")
+
+    if trackdata and trackdata.ref_level:
+        ref_level = trackdata.ref_level
+    elif albumdata and albumdata.ref_level:
+        ref_level = albumdata.ref_level
+    else:
+        ref_level = None
+
+    if ref_level is not None:
+        print("  Reference loudness %i dB" % ref_level)
+
+    if trackdata:
+        print("  Track gain %.2f dB" % trackdata.gain)
+        print("  Track peak %.8f" % trackdata.peak)
+    if albumdata:
+        print("  Album gain %.2f dB" % albumdata.gain)
+        print("  Album peak %.8f" % albumdata.peak)
+
+
+def _print_gain_jsonl(filename, gain, exc):
+    trackdata, albumdata = gain or (None, None)
+    print(json.dumps({
+        "file": filename,
+        "track": gain_json(trackdata),
+        "album": gain_json(albumdata),
+        "error": None if exc is None else str(exc),
+    }))
+
+
+# the columns of ``--show --format=csv``
+CSV_FIELDS = ("file", "ref_level", "track_gain", "track_peak", "album_gain",
+              "album_peak", "error")
+
+
+def _csv_row(filename, gain, exc):
+    trackdata, albumdata = gain or (None, None)
+    gaindata = trackdata or albumdata
+    row = [filename, "" if gaindata is None else "%g" % gaindata.ref_level]
+    for gaindata in (trackdata, albumdata):
+        row.extend(["", ""] if gaindata is None else
+                   ["%.2f" % gaindata.gain, "%.8f" % gaindata.peak])
+    row.append("" if exc is None else str(exc))
+    return row
+
+
+def _clips(gaindata):
+    # whether playing the audio with ``gaindata`` applied exceeds full scale
+    return gaindata.peak * 10 ** (gaindata.gain / 20) > 1.0
+
+
+# the counts of a ``GainSummary`` and their descriptions
+SUMMARY_FIELDS = {
+    "files": "Files",
+    "unreadable": "  unreadable",
+    "no_gain": "  without Replay Gain information",
+    "track_only": "  with track gain only",
+    "album_only": "  with album gain only",
+    "track_and_album": "  with track and album gain",
+    "track_peak_full_scale": "Track peaks at or above full scale",
+    "album_peak_full_scale": "Album peaks at or above full scale",
+    "track_gain_clips": "Tracks clipping with track gain applied",
+    "album_gain_clips": "Tracks clipping with album gain applied",
+}
+
+
+class GainSummary:
+    """Counts of the Replay Gain information of any number of files, which
+    are added one at a time with ``add``; nothing else is kept."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        # the number of files with every reference loudness, as a string
+        self.ref_levels = collections.Counter()
+
+    def add(self, gain, exc=None):
+        """Count the ``(trackdata, albumdata)`` tuple ``gain`` of a file, or
+        the error ``exc`` reading it."""
+        self.counts["files"] += 1
+        if exc is not None:
+            self.counts["unreadable"] += 1
+            return
+        trackdata, albumdata = gain
+        self.counts[{
+            (False, False): "no_gain",
+            (True, False): "track_only",
+            (False, True): "album_only",
+            (True, True): "track_and_album",
+        }[(trackdata is not None, albumdata is not None)]] += 1
+        for name, gaindata in (("track", trackdata), ("album", albumdata)):
+            if gaindata is None:
+                continue
+            if gaindata.peak >= 1.0:
+                self.counts[name + "_peak_full_scale"] += 1
+            if _clips(gaindata):
+                self.counts[name + "_gain_clips"] += 1
+        gaindata = trackdata or albumdata
+        if gaindata is not None:
+            # tags store it as a float or an integer
+            self.ref_levels["%g" % gaindata.ref_level
+                            if gaindata.ref_level is not None
+                            else "unknown"] += 1
+
+    def as_dict(self):
+        result = {key: self.counts[key] for key in SUMMARY_FIELDS}
+        result["ref_levels"] = dict(sorted(self.ref_levels.items()))
+        return result
+
+    def rows(self):
+        """Return the counts as a flat list of ``(name, count)`` tuples."""
+        return [(key, self.counts[key]) for key in SUMMARY_FIELDS] + [
+            ("ref_level_" + level, count)
+            for level, count in sorted(self.ref_levels.items())]
+
+    def format(self):
+        lines = ["%s: %i" % (SUMMARY_FIELDS[key], self.counts[key])
+                 for key in SUMMARY_FIELDS]
+        lines.append("Reference loudness:")
+        lines.extend(
+            "  %s: %i" % (level if level == "unknown" else level + " dB",
+                          count)
+            for level, count in sorted(self.ref_levels.items()))
+        return "\n".join(lines)
+
+
+def show_rgain_info(filenames, mp3_format=None, sidecar_db=None,
+                    output_format="text", summary=False,
+                    jobs=rgio.DEFAULT_IO_JOBS):
+    """Print the Replay Gain information of ``filenames``, which may be a
+    lazy iterable, in ``output_format`` (one of ``SHOW_FORMATS``), or just a
+    ``GainSummary`` of it if ``summary`` is true.
+
+    The tags are read by ``jobs`` threads. Except for the text format, files
+    are printed in the order they have been read in.
+    """
+    ordered = output_format == "text" and not summary
+    with get_formats_map(mp3_format, sidecar_db) as formats_map:
+        results = formats_map.read_gain_many(filenames, jobs, ordered)
+        if summary:
+            stats = GainSummary()
+            for _, gain, exc in results:
+                stats.add(gain, exc)
+            if output_format == "jsonl":
+                print(json.dumps(stats.as_dict()))
+            elif output_format == "csv":
+                csv.writer(sys.stdout).writerows(stats.rows())
+            else:
+                print(stats.format())
+        elif output_format == "csv":
+            writer = csv.writer(sys.stdout)
+            writer.writerow(CSV_FIELDS)
+            for result in results:
+                writer.writerow(_csv_row(*result))
+        else:
+            print_result = (_print_gain_jsonl if output_format == "jsonl"
+                            else _print_gain_text)
+            for result in results:
+                print_result(*result)
 
 
 def rgain_parser():
@@ -180,46 +544,141 @@ def rgain_parser():
         "--no-album",
         action="store_false",
         dest="album",
-        help="Don't write any album gain information.",
+        help="Don't write any album gain information. Each track is written "
+        "as soon as it has been analyzed, so if an error occurs, the tracks "
+        "before it have been modified already.",
     )
     parser.add_argument(
         "--show",
         action="store_true",
         help="Don't calculate anything, simply show Replay Gain information "
         "for the specified files. In this mode, all other options save for "
-        "'--mp3-format' are ignored, for they would make no sense.",
+        "'--mp3-format', '--sidecar-db', '--from-stdin', '--jobs', '--format' "
+        "and '--summary' are ignored, for they would make no sense.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=SHOW_FORMATS,
+        default="text",
+        dest="output_format",
+        help="With '--show', print the information as text meant for "
+        "humans, as one JSON object per file ('jsonl') or as CSV with a "
+        "header line. Except for 'text', files are printed in the order "
+        "they have been read in. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="With '--show', only print how many files lack Replay Gain "
+        "information, have clipping peaks or use which reference loudness, "
+        "in '--format'. Memory usage doesn't grow with the number of files.",
+    )
+    parser.add_argument(
+        "--from-stdin",
+        action="store_true",
+        dest="from_stdin",
+        help="Read the files from standard input instead, one per line, as "
+        "they are written; an empty line ends an album. The albums are "
+        "processed by '--jobs' worker processes, and the output of each is "
+        "printed once it's done.",
+    )
+    parser.add_argument(
+        "-0", "--null",
+        action="store_true",
+        help="With '--from-stdin', the files are terminated by NUL "
+        "characters instead of newlines, and an empty string (i.e. two NUL "
+        "characters in a row) ends an album.",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=PositiveIntOrNone("JOBS"),
+        metavar="JOBS",
+        help="Process JOBS albums (see '--group-by') or, with '--no-album', "
+        "tracks at the same time, each in a worker process of its own. The "
+        "output of every album or track is printed once it's done. With "
+        "'--from-stdin' or '--group-by', this defaults to the number of CPU "
+        "cores. With '--show', JOBS threads read the tags (default: %i)." %
+        rgio.DEFAULT_IO_JOBS,
+    )
+    parser.add_argument(
+        "--group-by",
+        choices=GROUP_BY,
+        default="none",
+        dest="group_by",
+        help="How the AUDIO_FILEs are split into albums: 'none' makes them "
+        "one album, 'dir' makes an album of the files in every directory "
+        "and 'album' one of the files with the same album tags (files "
+        "without any are albums of their own). Default: %(default)s.",
     )
     parser.add_argument(
         "audio_file",
-        nargs="+",
+        nargs="*",
         metavar="AUDIO_FILE",
     )
     return parser
 
 
+def _show_files(opts):
+    # the files of --show
+    if not opts.from_stdin:
+        return opts.audio_file
+    return (filename for files in read_jobs(sys.stdin.buffer, opts.null, False)
+            for filename in files)
+
+
+def _gain_jobs(opts):
+    # the jobs of --from-stdin, --jobs or --group-by, and the number of
+    # worker processes for them
+    if opts.from_stdin:
+        return read_jobs(sys.stdin.buffer, opts.null, opts.album), opts.jobs
+    if not opts.album:
+        file_jobs = [[filename] for filename in opts.audio_file]
+    else:
+        file_jobs = group_files(opts.audio_file, opts.group_by)
+    # no idle workers
+    return file_jobs, min(opts.jobs or os.cpu_count() or 1, len(file_jobs))
+
+
 def main():
-    init_gstreamer()
+    if gst_options_given():
+        init_gstreamer()
     parser = rgain_parser()
     opts = parser.parse_args()
+    if opts.from_stdin and opts.audio_file:
+        parser.error("--from-stdin can't be combined with AUDIO_FILEs")
+    if not opts.from_stdin and not opts.audio_file:
+        parser.error("no AUDIO_FILE given")
+    if opts.from_stdin and opts.group_by != "none":
+        parser.error("--from-stdin can't be combined with --group-by")
+    if not opts.show and (opts.summary or opts.output_format != "text"):
+        parser.error("--format and --summary need --show")
 
     if opts.show:
-        show_rgain_info(opts.audio_file, opts.mp3_format)
-    else:
         try:
-            do_gain(
-                opts.audio_file,
-                opts.ref_level,
-                opts.force,
-                opts.dry_run,
-                opts.album,
-                opts.mp3_format,
-            )
-        except Error as exc:
-            print("")
-            print(str(exc), file=sys.stderr)
-            sys.exit(1)
+            show_rgain_info(_show_files(opts), opts.mp3_format,
+                            opts.sidecar_db, opts.output_format, opts.summary,
+                            opts.jobs or rgio.DEFAULT_IO_JOBS)
         except KeyboardInterrupt:
             print("Interrupted.")
+        return
+
+    # before any worker process is forked
+    init_gstreamer()
+    gain_args = (opts.ref_level, opts.force, opts.dry_run, opts.album,
+                 opts.mp3_format, opts.atomic, opts.fsync, opts.sidecar_db)
+    try:
+        if opts.from_stdin or opts.jobs or opts.group_by != "none":
+            file_jobs, jobs = _gain_jobs(opts)
+            if do_gain_jobs(file_jobs, *gain_args, jobs):
+                sys.exit(1)
+        else:
+            do_gain(opts.audio_file, *gain_args)
+    except Error as exc:
+        print("")
+        print(str(exc), file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("Interrupted.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""A thin client of replaygaind.
+
+It only needs the standard library, so that it starts quickly; the daemon
+does all the work.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+
+def fallback_socket_dir():
+    """The directory of the default socket if ``$XDG_RUNTIME_DIR`` isn't
+    set. Its name is predictable, so the daemon only uses it if it's a
+    directory of this user's own which nobody else may write to."""
+    return os.path.join(tempfile.gettempdir(), "replaygaind-%i" % os.getuid())
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "replaygaind.sock")
+    return os.path.join(fallback_socket_dir(), "replaygaind.sock")
+
+
+def check_owner(path):
+    """Raise ``PermissionError`` unless ``path`` is owned by this user, so
+    that requests aren't sent to a socket (or a directory) set up by someone
+    else."""
+    if os.stat(path).st_uid != os.getuid():
+        raise PermissionError(
+            errno.EPERM, "owned by another user", path)
+
+
+class Client:
+    """A connection to the replaygaind listening on ``socket_path``."""
+
+    def __init__(self, socket_path=None):
+        socket_path = socket_path or default_socket_path()
+        check_owner(socket_path)
+        self._sock = socket.socket(socket.AF_UNIX)
+        try:
+            self._sock.connect(socket_path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile("rwb")
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def request(self, op, **params):
+        """Send a request and wait for its response, which is returned as a
+        dict with ``ok`` and either ``result`` or ``error``."""
+        self._next_id += 1
+        request = dict(params, id=self._next_id, op=op)
+        self._file.write((json.dumps(request) + "\n").encode("utf-8"))
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("the daemon closed the connection")
+        return json.loads(line)
+
+
+def format_result(result):
+    lines = []
+    for filename, trackdata in result["tracks"].items():
+        lines.append(filename)
+        lines.append("  Track gain %.2f dB" % trackdata["gain"])
+        lines.append("  Track peak %.8f" % trackdata["peak"])
+        if filename in result["failed"]:
+            lines.append("  Writing failed: %s" % result["failed"][filename])
+    if result["album"] is not None:
+        lines.append("Album gain %.2f dB" % result["album"]["gain"])
+        lines.append("Album peak %.8f" % result["album"]["peak"])
+    if not result["tracks"]:
+        lines.append("Nothing to do.")
+    return "\n".join(lines)
+
+
+def replaygainctl_parser():
+    parser = ArgumentParser(
+        description="Calculate Replay Gain for AUDIO_FILEs (one album, by "
+        "default) with a running 'replaygaind' and write it to the files.",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "-s", "--socket",
+        default=default_socket_path(),
+        metavar="PATH",
+        help="The UNIX socket of the daemon (default: %(default)s).",
+    )
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        help="Recalculate Replay Gain even if the files already contain "
+        "gain information.",
+    )
+    parser.add_argument(
+        "-d", "--dry-run",
+        action="store_true",
+        dest="dry_run",
+        help="Only calculate Replay Gain, don't write it to the files.",
+    )
+    parser.add_argument(
+        "--no-album",
+        action="store_false",
+        dest="album",
+        help="Don't calculate album gain.",
+    )
+    parser.add_argument(
+        "-r", "--reference-loudness",
+        type=int,
+        dest="ref_level",
+        metavar="REF",
+        help="Set the reference loudness to REF dB (default: the one of the "
+        "daemon).",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="Print the response of the daemon as it is.",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Show how busy the daemon is instead.",
+    )
+    parser.add_argument(
+        "audio_file",
+        nargs="*",
+        metavar="AUDIO_FILE",
+    )
+    return parser
+
+
+def main():
+    parser = replaygainctl_parser()
+    opts = parser.parse_args()
+    if not opts.status and not opts.audio_file:
+        parser.error("no AUDIO_FILE given")
+
+    if opts.status:
+        op, params = "status", {}
+    else:
+        op = "analyze" if opts.dry_run else "gain"
+        params = dict(
+            files=[os.path.abspath(f) for f in opts.audio_file],
+            album=opts.album, force=opts.force)
+        if opts.ref_level is not None:
+            params["ref_level"] = opts.ref_level
+    try:
+        with Client(opts.socket) as client:
+            response = client.request(op, **params)
+    except OSError as exc:
+        print("Can't talk to replaygaind on %s: %s" % (opts.socket, exc),
+              file=sys.stderr)
+        sys.exit(2)
+
+    if opts.json:
+        print(json.dumps(response))
+    elif response["ok"] and opts.status:
+        print("%(pending)i requests pending, %(jobs)i workers, "
+              "%(served)i requests served" % response["result"])
+    elif response["ok"]:
+        print(format_result(response["result"]))
+    if not response["ok"]:
+        print(response["error"], file=sys.stderr)
+        sys.exit(1)
+    if not opts.status and response["result"]["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
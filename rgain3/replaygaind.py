@@ -0,0 +1,348 @@
+# Copyright (c) 2009-2015 Felix Krull <f_krull@gmx.de>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""A daemon calculating Replay Gain on behalf of other programs.
+
+Requests are JSON objects sent over a UNIX socket, one per line; every one
+gets a response line with the same ``id``, see the replaygaind(1) man page.
+Several requests may be sent over one connection without waiting for the
+responses, which may come in any order.
+"""
+
+import contextlib
+import errno
+import io
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+
+from rgain3 import (
+    PositiveIntOrNone,
+    common_parser,
+    get_formats_map,
+    gst_options_given,
+    init_gstreamer,
+)
+from rgain3.lib import pipeline
+from rgain3.lib.dispatch import Dispatcher
+from rgain3.replaygain import analyze_gain, gain_json
+from rgain3.replaygainctl import default_socket_path, fallback_socket_dir
+
+# the operations a request may ask for
+OPERATIONS = ("analyze", "gain", "ping", "status")
+
+# requests waiting for a worker, beyond those being processed
+DEFAULT_MAX_QUEUED = 64
+
+
+def run_request(op, files, ref_level=89, album=True, force=False,
+                mp3_format=None, sidecar_db=None, atomic=False, fsync=False):
+    # Runs in a worker process. Returns the result of an "analyze" or "gain"
+    # request, or raises RuntimeError; other exceptions might not survive
+    # the trip back to the daemon.
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), \
+                get_formats_map(mp3_format, sidecar_db) as formats_map:
+            result = analyze_gain(formats_map, files, ref_level, force, album)
+            failures = []
+            if result is not None and op == "gain":
+                tracks_data, albumdata = result
+                failures = pipeline.write_album(
+                    formats_map,
+                    [(filename, trackdata, albumdata)
+                     for filename, trackdata in tracks_data.items()],
+                    atomic, fsync)
+    except Exception as exc:
+        raise RuntimeError(str(exc) or repr(exc)) from None
+
+    tracks_data, albumdata = result or ({}, None)
+    failed = {r.filename: str(r.error) for r in failures}
+    return {
+        "tracks": {filename: gain_json(trackdata)
+                   for filename, trackdata in tracks_data.items()},
+        "album": gain_json(albumdata),
+        "written": [filename for filename in tracks_data
+                    if op == "gain" and filename not in failed],
+        "failed": failed,
+    }
+
+
+def parse_request(line):
+    """Parse and check a request line; returns the request as a dict or
+    raises ValueError."""
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError("a request must be a JSON object")
+    op = request.get("op")
+    if op not in OPERATIONS:
+        raise ValueError("op must be one of %s" % ", ".join(OPERATIONS))
+    if op in ("analyze", "gain"):
+        files = request.get("files")
+        if (not isinstance(files, list) or not files or
+                not all(isinstance(f, str) for f in files)):
+            raise ValueError("files must be a non-empty list of file names")
+        if not all(os.path.isabs(f) for f in files):
+            raise ValueError("file names must be absolute")
+        if not isinstance(request.get("ref_level", 89), int):
+            raise ValueError("ref_level must be an integer")
+    return request
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # One connection; requests are read one line at a time, and responses
+    # are written as soon as they're ready.
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+
+    def respond(self, request_id, result=None, error=None):
+        if error is None:
+            response = {"id": request_id, "ok": True, "result": result}
+        else:
+            response = {"id": request_id, "ok": False, "error": error}
+        data = (json.dumps(response) + "\n").encode("utf-8")
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                # the client has gone away, and the connection may have been
+                # closed already
+                pass
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = parse_request(line)
+            except ValueError as exc:
+                self.respond(None, error="invalid request: %s" % exc)
+                continue
+            self.server.daemon.handle(self, request)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """Serve requests on the UNIX socket ``socket_path`` with the workers of
+    ``dispatcher``, a ``dispatch.Dispatcher``.
+
+    Requests beyond the ``dispatcher.jobs`` being processed wait in a queue
+    of at most ``max_queued`` requests; further ones are turned down right
+    away, so that the client may try again later. ``ref_level`` is used for
+    requests which don't specify one.
+    """
+
+    def __init__(self, socket_path, dispatcher, max_queued=DEFAULT_MAX_QUEUED,
+                 ref_level=89, mp3_format=None, sidecar_db=None,
+                 atomic=False, fsync=False):
+        self.socket_path = socket_path
+        self.dispatcher = dispatcher
+        self.max_queued = max_queued
+        self.ref_level = ref_level
+        self._job_args = (mp3_format, sidecar_db, atomic, fsync)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._served = 0
+
+        _make_socket_dir(socket_path)
+        _remove_stale_socket(socket_path)
+        # only this user may talk to the daemon
+        old_umask = os.umask(0o177)
+        try:
+            self.server = _Server(socket_path, _Handler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon = self
+        self._responder = threading.Thread(target=self._respond, daemon=True)
+        self._responder.start()
+
+    def handle(self, connection, request):
+        request_id = request.get("id")
+        op = request["op"]
+        if op == "ping":
+            connection.respond(request_id, "pong")
+            return
+        if op == "status":
+            with self._lock:
+                connection.respond(request_id, {
+                    "jobs": self.dispatcher.jobs,
+                    "pending": self._pending,
+                    "max_queued": self.max_queued,
+                    "served": self._served,
+                })
+            return
+
+        with self._lock:
+            if self._pending >= self.dispatcher.jobs + self.max_queued:
+                connection.respond(request_id, error="queue full")
+                return
+            self._pending += 1
+        self.dispatcher.submit(
+            (connection, request_id), run_request, op, request["files"],
+            request.get("ref_level", self.ref_level),
+            bool(request.get("album", True)),
+            bool(request.get("force", False)), *self._job_args)
+
+    def _respond(self):
+        for (connection, request_id), future in self.dispatcher.completed():
+            with self._lock:
+                self._pending -= 1
+                self._served += 1
+            try:
+                result = future.result()
+            except Exception as exc:
+                # e.g. the worker process died
+                connection.respond(request_id, error=str(exc) or repr(exc))
+            else:
+                connection.respond(request_id, result)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stop serving; requests which are still being processed are
+        dropped. Must not be called from a request handler."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.dispatcher.close()
+        self.dispatcher.shutdown(cancel=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.socket_path)
+
+
+def _make_socket_dir(socket_path):
+    # Anybody may create the fallback directory in the shared temporary
+    # directory before us, and then replace the socket.
+    directory = os.path.dirname(socket_path)
+    if directory != fallback_socket_dir():
+        return
+    with contextlib.suppress(FileExistsError):
+        os.mkdir(directory, 0o700)
+    st = os.lstat(directory)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        raise PermissionError(
+            errno.EPERM, "not a private directory of this user", directory)
+
+
+def _remove_stale_socket(socket_path):
+    # The socket of a daemon which didn't exit cleanly is left behind.
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise OSError(errno.EADDRINUSE, "another daemon is listening")
+
+
+def replaygaind_parser():
+    parser = common_parser(
+        description="Calculate Replay Gain on behalf of other programs, "
+        "which send their requests over a UNIX socket, e.g. with "
+        "'replaygainctl'. The worker processes are started once, so "
+        "requests don't pay for starting Python and GStreamer."
+    )
+    parser.add_argument(
+        "-s", "--socket",
+        default=default_socket_path(),
+        metavar="PATH",
+        help="Listen on the UNIX socket PATH (default: %(default)s). Only "
+        "the user running the daemon may connect to it.",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=PositiveIntOrNone("JOBS"),
+        metavar="JOBS",
+        help="The number of requests processed at the same time, each by a "
+        "worker process of its own. Defaults to the number of CPU cores.",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        dest="max_queued",
+        default=DEFAULT_MAX_QUEUED,
+        metavar="N",
+        help="The number of requests which may wait for a worker; further "
+        "ones are turned down with a 'queue full' error (default: "
+        "%(default)s).",
+    )
+    return parser
+
+
+def main():
+    if gst_options_given():
+        init_gstreamer()
+    parser = replaygaind_parser()
+    opts = parser.parse_args()
+    if opts.max_queued < 0:
+        parser.error("N must not be negative")
+    # whether to force the calculation or to write tags is up to every
+    # request
+    for name in ("force", "dry_run"):
+        if getattr(opts, name):
+            parser.error("--%s is a per-request option" %
+                         name.replace("_", "-"))
+
+    init_gstreamer()
+    # Workers replacing crashed ones aren't forked from this process, which
+    # runs several threads.
+    dispatcher = Dispatcher(
+        opts.jobs, max_in_flight=(opts.jobs or os.cpu_count() or 1) +
+        opts.max_queued, mp_context=multiprocessing.get_context("forkserver"),
+        initializer=init_gstreamer)
+    try:
+        daemon = Daemon(opts.socket, dispatcher, opts.max_queued,
+                        opts.ref_level, opts.mp3_format, opts.sidecar_db,
+                        opts.atomic, opts.fsync)
+    except OSError as exc:
+        dispatcher.shutdown(cancel=True)
+        print("Can't listen on %s: %s" % (opts.socket, exc.strerror or exc),
+              file=sys.stderr)
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, _terminate)
+    print("Listening on %s with %i workers ..." % (
+        opts.socket, dispatcher.jobs))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+    print("Stopped.")
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    main()
@@ -116,6 +116,7 @@ try:
         "rst_manpages": [
             ("man/replaygain.rst", "replaygain.1"),
             ("man/collectiongain.rst", "collectiongain.1"),
+            ("man/replaygaind.rst", "replaygaind.1"),
         ],
         "rst_manpages_update_info": True,
         "rst_manpages_version": str(__version__),
@@ -161,10 +162,13 @@ setup(
         "console_scripts": [
             "collectiongain = rgain3.collectiongain:main",
             "replaygain = rgain3.replaygain:main",
+            "replaygaind = rgain3.replaygaind:main",
+            "replaygainctl = rgain3.replaygainctl:main",
         ]
     },
     install_requires=requirements("requirements.txt"),
     extras_require={
+        "numpy": ["numpy"],
         "test": ["tox>=3.14,<4.0"] + requirements("test-requirements.txt")
     },
     python_requires=">=3.10",
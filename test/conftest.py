@@ -0,0 +1,37 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+DATA_PATH = Path(__file__).parent / "data"
+
+
+@pytest.fixture
+def copy_audio(tmpdir):
+    """Copy a test file to the given paths below ``tmpdir``.
+
+    Returns a function that takes the relative paths and, optionally, the
+    name of the file in ``test/data`` to copy (``no-tags.flac`` by default);
+    it returns the absolute paths of the copies.
+    """
+    def copy(*relpaths, source="no-tags.flac"):
+        paths = []
+        for relpath in relpaths:
+            path = str(tmpdir / relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copy(str(DATA_PATH / source), path)
+            paths.append(path)
+        return paths
+
+    return copy
+
+
+@pytest.fixture
+def album_copies(copy_audio):
+    """Return a function that creates ``count`` copies of ``no-tags.flac``
+    named ``track0.flac``, ``track1.flac`` etc. in ``tmpdir``."""
+    def copies(count):
+        return copy_audio(*("track{}.flac".format(i) for i in range(count)))
+
+    return copies
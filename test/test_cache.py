@@ -0,0 +1,238 @@
+import os
+import pickle
+import sqlite3
+
+import pytest
+
+from rgain3.lib import GainData
+from rgain3.lib.cache import (
+    Cache,
+    CacheEntry,
+    entry_unchanged,
+    read_pickle_cache,
+)
+from rgain3.lib.scan import DirRecord
+
+
+@pytest.fixture
+def cache_file(tmpdir):
+    return str(tmpdir / "cache" / "collectiongain-cache.sqlite")
+
+
+def test_mapping(cache_file):
+    with Cache(cache_file, batch_size=2) as cache:
+        assert len(cache) == 0
+        cache["a.flac"] = ("Album", 1, False, 10, 100)
+        cache["b.flac"] = ("Album", 2, True, 20, 200)
+        cache["c.flac"] = (None, 3, False, 30, 300)
+        assert cache["a.flac"] == CacheEntry("Album", 1, False, 10, 100)
+        assert cache["b.flac"].processed is True
+        assert len(cache) == 3
+
+        del cache["c.flac"]
+        assert "c.flac" not in cache
+        with pytest.raises(KeyError):
+            del cache["c.flac"]
+        assert sorted(cache) == ["a.flac", "b.flac"]
+
+    with Cache(cache_file) as cache:
+        assert dict(cache.items()) == {
+            "a.flac": CacheEntry("Album", 1, False, 10, 100),
+            "b.flac": CacheEntry("Album", 2, True, 20, 200),
+        }
+
+
+def test_gain_data(cache_file):
+    entry = CacheEntry("Album", 1, True, 10, 100, 180.5,
+                       GainData(-3.5, 0.9, 83), GainData(-4.0, 1.2, 83),
+                       1700000000.5)
+    with Cache(cache_file) as cache:
+        cache["a.flac"] = entry
+        cache["b.flac"] = entry._replace(album_gain=None, analyzed=None)
+        cache["c.flac"] = ("Album", 1, False)
+
+    with Cache(cache_file) as cache:
+        assert cache["a.flac"] == entry
+        assert cache["b.flac"].track_gain == GainData(-3.5, 0.9, 83)
+        assert cache["b.flac"].album_gain is None
+        assert cache["b.flac"].analyzed is None
+        assert cache["c.flac"].track_gain is None
+
+
+def test_flush_in_batches(cache_file):
+    cache = Cache(cache_file, batch_size=10)
+    for i in range(25):
+        cache["%i.flac" % i] = (None, i, False)
+
+    # two full batches have been written to disk already
+    conn = sqlite3.connect(cache_file)
+    assert conn.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 20
+    cache.close()
+    assert conn.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 25
+
+
+def test_purge_unvisited(cache_file):
+    with Cache(cache_file) as cache:
+        cache.update({
+            "a.flac": (None, 1, True),
+            "b.flac": (None, 1, True),
+        })
+        cache.begin_scan()
+        cache.mark_visited("a.flac")
+        cache["c.flac"] = (None, 1, False)
+        cache.purge_unvisited()
+        assert sorted(cache) == ["a.flac", "c.flac"]
+
+
+def test_clear(cache_file):
+    with Cache(cache_file) as cache:
+        cache["a.flac"] = (None, 1, True)
+        cache.flush()
+        cache["b.flac"] = (None, 1, True)
+        cache.clear()
+        assert len(cache) == 0
+
+
+def test_undecodable_paths(cache_file):
+    path = os.fsdecode(b"album/\xff.flac")
+    with Cache(cache_file) as cache:
+        cache[path] = (None, 1, True)
+    with Cache(cache_file) as cache:
+        assert list(cache) == [path]
+
+
+def test_dirs(cache_file):
+    record = DirRecord(1, 2, ["cd1", "cd2"])
+    with Cache(cache_file) as cache:
+        assert cache.get_dir("album") is None
+        cache.set_dir("album", record)
+        cache.set_dir("other", record)
+        cache["album/1.flac"] = (None, 1, True)
+        cache["album/cd1/1.flac"] = (None, 1, True)
+        assert cache.get_dir("album") == record
+
+        cache.begin_scan()
+        assert cache.get_dir("album") == record
+        # files in subdirectories are visited with their own directory
+        cache.mark_dir_visited("album")
+        cache.purge_unvisited()
+        assert list(cache) == ["album/1.flac"]
+        assert cache.get_dir("other") is None
+
+    with Cache(cache_file) as cache:
+        assert cache.get_dir("album") == record
+
+
+def test_migrate_pickle_cache(tmpdir, cache_file):
+    pickle_file = str(tmpdir / "collectiongain-cache")
+    files = {
+        "a.flac": ("Album", 1.0, True),
+        "b.flac": (None, 2, False),
+        "fishy.flac": ("Album", "not a number", True),
+    }
+    with open(pickle_file, "wb") as f:
+        pickle.dump((1, files), f, 2)
+
+    with Cache(cache_file, pickle_file) as cache:
+        assert dict(cache.items()) == {
+            # mtimes are converted to nanoseconds
+            "a.flac": CacheEntry("Album", 1000000000, True),
+            "b.flac": CacheEntry(None, 2000000000, False),
+        }
+    assert not os.path.exists(pickle_file)
+
+
+def test_read_pickle_cache_invalid(tmpdir):
+    pickle_file = str(tmpdir / "collectiongain-cache")
+    with open(pickle_file, "wb") as f:
+        pickle.dump((0, {}), f, 2)
+    assert read_pickle_cache(pickle_file) == {}
+    assert read_pickle_cache(str(tmpdir / "missing")) == {}
+
+
+def test_old_version_is_dropped(cache_file):
+    os.makedirs(os.path.dirname(cache_file))
+    conn = sqlite3.connect(cache_file)
+    conn.execute("CREATE TABLE files (path TEXT PRIMARY KEY, album_id TEXT)")
+    conn.execute("INSERT INTO files VALUES ('a.flac', 'Album')")
+    conn.execute("PRAGMA user_version = 2")
+    conn.commit()
+    conn.close()
+
+    with Cache(cache_file) as cache:
+        assert len(cache) == 0
+        cache["a.flac"] = ("Album", 1, True, 1, 1)
+
+
+def test_visited_items(cache_file):
+    with Cache(cache_file, batch_size=2) as cache:
+        for path in ["a/1.flac", "a/b/2.flac", "ab/3.flac", "c.flac"]:
+            cache[path] = (None, 1, False)
+        cache.begin_scan()
+        for path in ["a/1.flac", "ab/3.flac", "c.flac"]:
+            cache.mark_visited(path)
+        assert [path for path, _ in cache.visited_items("a")] == ["a/1.flac"]
+        assert [path for path, _ in cache.visited_items()] == [
+            "a/1.flac", "ab/3.flac", "c.flac"]
+
+        # the cache may be modified while iterating
+        for path, record in cache.items():
+            cache[path] = record._replace(processed=True)
+        assert all(record.processed for _, record in cache.items())
+
+
+def test_album_items_and_remove_tree(cache_file):
+    with Cache(cache_file) as cache:
+        cache["a/1.flac"] = ("x", 1, False)
+        cache["a/b/2.flac"] = ("x", 1, True)
+        cache["ab/3.flac"] = ("y", 1, False)
+        cache["a.flac"] = ("x", 1, False)
+        cache.set_dir("a/b", DirRecord(1, 2, []))
+        assert [path for path, _ in cache.album_items("x")] == [
+            "a.flac", "a/1.flac", "a/b/2.flac"]
+
+        cache.remove_tree("a")
+        assert sorted(cache) == ["a.flac", "ab/3.flac"]
+        assert cache.get_dir("a/b") is None
+        cache.remove_tree("a.flac")
+        assert list(cache) == ["ab/3.flac"]
+
+
+def test_entry_unchanged():
+    st = os.stat_result((0o100644, 7, 0, 1, 0, 0, 10, 0, 0, 0),
+                        {"st_mtime_ns": 5})
+    assert entry_unchanged(CacheEntry(None, 5, True, 10, 7), st)
+    assert not entry_unchanged(CacheEntry(None, 6, True, 10, 7), st)
+    assert not entry_unchanged(CacheEntry(None, 5, True, 11, 7), st)
+    # inode numbers are only compared on request
+    assert entry_unchanged(CacheEntry(None, 5, True, 10, 8), st)
+    assert not entry_unchanged(CacheEntry(None, 5, True, 10, 8), st,
+                               check_inode=True)
+    # entries of old caches only know the modification time
+    assert entry_unchanged(CacheEntry(None, 5.0, True), st)
+
+
+def test_merge(tmpdir, cache_file):
+    other_file = str(tmpdir / "other.sqlite")
+    with Cache(other_file) as other:
+        other["a.flac"] = ("A", 2, True)
+        other["b.flac"] = ("B", 2, False)
+        other["c.flac"] = ("C", 1, False)
+        other["new.flac"] = ("A", 1, False)
+        other.set_dir("", DirRecord(5, 1, []))
+
+    with Cache(cache_file) as cache:
+        cache["a.flac"] = ("A", 1, False)
+        cache["b.flac"] = ("B", 1, True)
+        cache["c.flac"] = ("C", 2, False)
+        cache.set_dir("", DirRecord(4, 1, ["a"]))
+        cache.merge(other_file)
+        # processed entries win, otherwise the most recent ones
+        assert cache["a.flac"] == CacheEntry("A", 2, True)
+        assert cache["b.flac"] == CacheEntry("B", 1, True)
+        assert cache["c.flac"] == CacheEntry("C", 2, False)
+        assert cache["new.flac"] == CacheEntry("A", 1, False)
+        assert cache.get_dir("") == DirRecord(5, 1, [])
+
+        with pytest.raises(FileNotFoundError):
+            cache.merge(str(tmpdir / "missing.sqlite"))
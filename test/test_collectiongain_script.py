@@ -1,8 +1,30 @@
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
 from argparse import ArgumentError
 
+import mutagen
 import pytest
 
-from rgain3.collectiongain import PositiveIntOrNone
+from rgain3 import collectiongain
+from rgain3.collectiongain import (
+    Address,
+    NonNegativeFloat,
+    PositiveIntOrNone,
+    Shard,
+    transform_cache,
+)
+from rgain3.lib import GainData, GainType, inotify, rgio, util
+from rgain3.lib.cache import Cache, CacheEntry
 
 
 @pytest.mark.parametrize("i,o", [(None, None), ("1", 1), ("42", 42)])
@@ -20,9 +42,597 @@ def test_positiveintornone_error(i):
     assert exc_info.value.message == err_msg
 
 
+@pytest.mark.parametrize("i,o", [
+    ("localhost:8000", ("localhost", 8000)),
+    (":8000", ("", 8000)),
+    ("[::1]:8000", ("::1", 8000)),
+])
+def test_address_success(i, o):
+    assert Address()(i) == o
+
+
+@pytest.mark.parametrize("i", ["localhost", "localhost:http", "host:70000"])
+def test_address_error(i):
+    with pytest.raises(ArgumentError):
+        Address()(i)
+
+
+@pytest.mark.parametrize("i,o", [("1/3", (1, 3)), ("3/3", (3, 3))])
+def test_shard_success(i, o):
+    assert Shard()(i) == o
+
+
+@pytest.mark.parametrize("i", ["1", "0/3", "4/3", "a/b", "1/2/3"])
+def test_shard_error(i):
+    with pytest.raises(ArgumentError):
+        Shard()(i)
+
+
 def test_positiveintornone_zero():
     T = PositiveIntOrNone("jobs")
     with pytest.raises(ArgumentError) as exc_info:
         T(0)
     err_msg = "jobs must be at least 1"
     assert exc_info.value.message == err_msg
+
+
+@pytest.mark.parametrize("i,o", [("0", 0.0), ("2.5", 2.5)])
+def test_nonnegativefloat_success(i, o):
+    assert NonNegativeFloat("SECONDS")(i) == o
+
+
+@pytest.mark.parametrize("i", ["-1", "nan", "inf"])
+def test_nonnegativefloat_error(i):
+    with pytest.raises(ArgumentError) as exc_info:
+        NonNegativeFloat("SECONDS")(i)
+    assert exc_info.value.message == "SECONDS must be a number of at least 0"
+
+
+@pytest.mark.parametrize("option", ["checkpoint-interval", "watch-delay"])
+def test_seconds_negative(option, capsys):
+    with pytest.raises(SystemExit):
+        collectiongain.collectiongain_parser().parse_args(
+            ["--%s=-5" % option, "music"])
+    assert "SECONDS must be a number of at least 0" in capsys.readouterr().err
+
+
+def test_transform_cache():
+    files = {
+        "a/1.flac": CacheEntry("A", 1, True),
+        "a/2.flac": CacheEntry("A", 1, False),
+        "b/1.flac": CacheEntry("B", 1, True),
+        "b/2.flac": CacheEntry("B", 1, True),
+        "single1.flac": CacheEntry(None, 1, False),
+        "single2.flac": CacheEntry(None, 1, True),
+    }
+    albums, single_tracks = transform_cache(files)
+    assert albums == {"A": ["a/1.flac", "a/2.flac"]}
+    assert single_tracks == ["single1.flac"]
+
+    # only the files of the jobs are looked up
+    costs = collectiongain.job_costs(files, albums, single_tracks)
+    assert sorted(costs) == ["a/1.flac", "a/2.flac", "single1.flac"]
+
+
+def _fake_analyze_gain(formats_map, files, ref_level=89, force=False,
+                       album=True, on_track=None):
+    return (
+        {f: GainData(-1.0, 0.5, ref_level, GainType.TP_TRACK) for f in files},
+        GainData(-2.0, 0.5, ref_level, GainType.TP_ALBUM) if album else None,
+    )
+
+
+@pytest.fixture
+def music_dir(tmpdir, copy_audio):
+    copy_audio(*(
+        "music/{}/{}.flac".format(album, i)
+        for album in ["a", "b", "c"] for i in range(2)))
+    return str(tmpdir / "music")
+
+
+def test_do_gain_all_checkpoints(monkeypatch, tmpdir, music_dir):
+    monkeypatch.setattr(collectiongain, "analyze_gain", _fake_analyze_gain)
+    cache_file = str(tmpdir / "cache.sqlite")
+    albums = {
+        album: ["{}/0.flac".format(album), "{}/1.flac".format(album)]
+        for album in ["a", "b", "c"]
+    }
+
+    with Cache(cache_file) as files:
+        for album_files in albums.values():
+            for path in album_files:
+                files[path] = (None, 0, False)
+        files.flush()
+
+        flushes = []
+        flush = files.flush
+
+        def spy():
+            conn = sqlite3.connect(cache_file)
+            flushes.append(conn.execute(
+                "SELECT COUNT(*) FROM files WHERE processed").fetchone()[0])
+            flush()
+
+        monkeypatch.setattr(files, "flush", spy)
+        collectiongain.do_gain_all(music_dir, albums, [], files, jobs=1)
+        processed = sqlite3.connect(cache_file).execute(
+            "SELECT COUNT(*) FROM files WHERE processed").fetchone()[0]
+
+    # every finished job has been committed right away, not only on close
+    assert flushes[-4:] == [0, 2, 4, 6]
+    assert processed == 6
+
+
+def _collect(music_dir, files, fast=False):
+    collectiongain.collect_files(
+        music_dir, files, lambda path: path.endswith(".flac"), fast)
+
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_collect_files(tmpdir, music_dir, fast):
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        _collect(music_dir, files, fast)
+        assert len(files) == 6
+        record = files["a/0.flac"]
+        path = os.path.join(music_dir, "a", "0.flac")
+        st = os.stat(path)
+        assert record == CacheEntry(
+            None, st.st_mtime_ns, False, st.st_size, st.st_ino,
+            mutagen.File(path).info.length)
+        files.update(
+            (path, r._replace(processed=True)) for path, r in files.items())
+
+        # replacing a file is noticed, even with an older modification time
+        os.utime(os.path.join(music_dir, "b", "0.flac"), ns=(0, 0))
+        shutil.copy(os.path.join(music_dir, "b", "0.flac"),
+                    os.path.join(music_dir, "b", "new.flac"))
+        os.replace(os.path.join(music_dir, "b", "new.flac"),
+                   os.path.join(music_dir, "b", "0.flac"))
+        files.begin_scan()
+        _collect(music_dir, files, fast)
+        files.purge_unvisited()
+        assert len(files) == 6
+        assert [p for p, r in files.items() if not r.processed] == [
+            "b/0.flac"]
+
+
+def test_collect_files_legacy_entries(tmpdir, music_dir):
+    path = os.path.join(music_dir, "a", "0.flac")
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        # entries of old caches only have a (rounded) float mtime
+        mtime = int(round(os.path.getmtime(path) * 1e9))
+        files["a/0.flac"] = CacheEntry("A", mtime, True)
+        _collect(music_dir, files)
+        st = os.stat(path)
+        assert files["a/0.flac"] == CacheEntry(
+            "A", st.st_mtime_ns, True, st.st_size, st.st_ino)
+
+        # tags are read again once a file changes, which updates the length
+        os.utime(path, ns=(0, 0))
+        _collect(music_dir, files)
+        assert files["a/0.flac"].length == mutagen.File(path).info.length
+
+
+def test_collect_files_unreadable(tmpdir, music_dir, capsys):
+    with open(os.path.join(music_dir, "broken.flac"), "wb") as f:
+        f.write(b"not really a flac file")
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        collectiongain.collect_files(
+            music_dir, files, lambda path: path.endswith(".flac"), jobs=2)
+        assert sorted(files) == [
+            "a/0.flac", "a/1.flac", "b/0.flac", "b/1.flac", "c/0.flac",
+            "c/1.flac",
+        ]
+    out = capsys.readouterr().out
+    assert "broken.flac |IGNORED" in out
+    assert out.count("<single track>") == 6
+
+
+@pytest.fixture
+def stream_dir(tmpdir, copy_audio):
+    layout = {
+        "x/album/1.flac": "album-tag.flac",
+        "x/album/2.flac": "album-tag.flac",
+        "x/span.flac": "mb-album-id.flac",
+        "y/1.flac": "no-tags.flac",
+        "y/2.flac": "no-tags.flac",
+        "y/span.flac": "mb-album-id.flac",
+        "z.flac": "no-tags.flac",
+    }
+    for path, source in layout.items():
+        copy_audio("music/" + path, source=source)
+    return str(tmpdir / "music")
+
+
+def test_stream_jobs(tmpdir, stream_dir):
+    submitted = []
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        files.begin_scan()
+        dispatch = collectiongain.stream_jobs(
+            stream_dir, files, lambda path: path.endswith(".flac"), jobs=2)
+        dispatch(lambda tracks, album_id: submitted.append(
+            (sorted(tracks), album_id)))
+        album_id = files["x/album/1.flac"].album_id
+        span_id = files["x/span.flac"].album_id
+
+    assert [job for job in submitted if job[1] == album_id] == [
+        (["x/album/1.flac", "x/album/2.flac"], album_id)]
+    singles = [path for tracks, key in submitted if key is None
+               for path in tracks]
+    assert sorted(singles) == ["y/1.flac", "y/2.flac", "z.flac"]
+    # the album in both directories is submitted again once it's complete
+    span_jobs = [tracks for tracks, key in submitted if key == span_id]
+    assert span_jobs[-1] == ["x/span.flac", "y/span.flac"]
+    assert len(span_jobs) == 2
+
+
+def test_stream_jobs_executor(monkeypatch, tmpdir, stream_dir):
+    with util.start_process_pool(2) as executor:
+        # no workers may be started while other threads are running
+        monkeypatch.setattr(util, "start_process_pool", None)
+        with Cache(str(tmpdir / "cache.sqlite")) as files:
+            files.begin_scan()
+            dispatch = collectiongain.stream_jobs(
+                stream_dir, files, lambda path: path.endswith(".flac"),
+                jobs=2, executor=executor)
+            dispatch(lambda tracks, album_id: None)
+            assert len(files) == 7
+
+
+def test_do_collectiongain_stream(monkeypatch, tmpdir, stream_dir, capsys):
+    monkeypatch.setattr(collectiongain, "analyze_gain", _fake_analyze_gain)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    start_process_pool = util.start_process_pool
+    forked = []
+
+    def spy(jobs, **kwargs):
+        context = kwargs.get("mp_context") or multiprocessing.get_context()
+        if context.get_start_method() == "fork":
+            forked.append(threading.active_count())
+        return start_process_pool(jobs, **kwargs)
+
+    monkeypatch.setattr(util, "start_process_pool", spy)
+    collectiongain.do_collectiongain(stream_dir, jobs=2, stream=True)
+    # no workers are forked while other threads are running
+    assert forked == [1]
+    assert "Peak memory usage of the worker processes:" in (
+        capsys.readouterr().out)
+
+    cache_files = list((tmpdir / ".cache").listdir("*.sqlite"))
+    with Cache(str(cache_files[0])) as files:
+        assert len(files) == 7
+        assert all(record.processed for _, record in files.items())
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_do_collectiongain_coordinator(monkeypatch, tmpdir, stream_dir,
+                                       stream):
+    monkeypatch.setattr(collectiongain, "analyze_gain", _fake_analyze_gain)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    # the workers have the music directory mounted somewhere else
+    mount = str(tmpdir / "mount")
+    shutil.copytree(stream_dir, mount)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        address = sock.getsockname()
+    worker = multiprocessing.get_context("fork").Process(
+        target=collectiongain.do_worker, args=(address, b"secret", mount, 1))
+    worker.start()
+    collectiongain.do_collectiongain(stream_dir, jobs=1, stream=stream,
+                                     coordinator=address, authkey=b"secret")
+    worker.join(10)
+    assert worker.exitcode == 0
+
+    with Cache(collectiongain.cache_paths(stream_dir)[0]) as files:
+        assert len(files) == 7
+        assert all(record.processed for _, record in files.items())
+    # the tags are written by the coordinator
+    path = os.path.join("x", "album", "1.flac")
+    assert "replaygain_track_gain" in mutagen.File(
+        os.path.join(stream_dir, path))
+    assert "replaygain_track_gain" not in mutagen.File(
+        os.path.join(mount, path))
+
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"),
+                                reason="inotify is Linux only")
+
+
+@linux_only
+def test_watch_jobs(tmpdir, copy_audio):
+    music_dir = str(tmpdir / "music")
+    os.makedirs(music_dir)
+    submitted = queue.Queue()
+    stop = threading.Event()
+    with Cache(str(tmpdir / "cache.sqlite")) as files, \
+            inotify.TreeWatcher(music_dir) as watcher:
+        dispatch = collectiongain.watch_jobs(
+            music_dir, files, lambda path: path.endswith(".flac"), watcher,
+            lambda submit: submitted.put("all"), delay=0.3, stop=stop)
+        thread = threading.Thread(target=dispatch, args=(
+            lambda tracks, album_id: submitted.put((sorted(tracks),
+                                                    album_id)),))
+        thread.start()
+        try:
+            assert submitted.get(timeout=5) == "all"
+            copy_audio("music/new/1.flac", "music/new/2.flac",
+                       source="album-tag.flac")
+            copy_audio("music/single.flac", "music/new/cover.jpg")
+            # one job for the album once it has settled, one for the track
+            jobs = [submitted.get(timeout=5), submitted.get(timeout=5)]
+            assert (["single.flac"], None) in jobs
+            album_id = files["new/1.flac"].album_id
+            assert (["new/1.flac", "new/2.flac"], album_id) in jobs
+
+            # tags written by collectiongain itself don't count as changes
+            for path in ("new/1.flac", "new/2.flac"):
+                with open(os.path.join(music_dir, path), "ab") as f:
+                    f.write(b"\0")
+            collectiongain.update_cache(
+                files, music_dir, ["new/1.flac", "new/2.flac"], album_id,
+                {"new/1.flac", "new/2.flac"})
+            os.remove(os.path.join(music_dir, "single.flac"))
+            time.sleep(1)
+            assert submitted.empty()
+            assert sorted(files) == ["new/1.flac", "new/2.flac"]
+        finally:
+            stop.set()
+            thread.join()
+
+
+@linux_only
+def test_do_collectiongain_watch(monkeypatch, tmpdir, stream_dir, copy_audio):
+    monkeypatch.setattr(collectiongain, "analyze_gain", _fake_analyze_gain)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=collectiongain.do_collectiongain, args=(stream_dir,),
+        kwargs=dict(jobs=1, watch=True, watch_delay=0.2, stop=stop))
+    thread.start()
+    try:
+        cache_file = collectiongain.cache_paths(stream_dir)[0]
+        new = copy_audio("music/x/new.flac")[0]
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if os.path.exists(cache_file):
+                with Cache(cache_file) as files:
+                    record = files.get("x/new.flac")
+                    if record is not None and record.processed:
+                        break
+            time.sleep(0.1)
+        else:
+            pytest.fail("x/new.flac hasn't been processed")
+        assert "replaygain_track_gain" in mutagen.File(new)
+    finally:
+        stop.set()
+        thread.join()
+
+    with Cache(cache_file) as files:
+        assert len(files) == 8
+        assert all(record.processed for _, record in files.items())
+
+
+def test_collect_files_skips_staged_files(tmpdir, music_dir):
+    shutil.copy(os.path.join(music_dir, "a", "0.flac"),
+                os.path.join(music_dir, "a", ".0.flac.x1.rgain3-tmp.flac"))
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        _collect(music_dir, files)
+        assert len(files) == 6
+        assert not any(".rgain3-tmp" in path for path in files)
+
+
+def test_do_gain_all_failed_jobs_are_retried(monkeypatch, tmpdir, music_dir):
+    def analyze_gain(formats_map, files, *args, **kwargs):
+        if any("/b/" in f for f in files):
+            raise RuntimeError("decoding failed")
+        return _fake_analyze_gain(formats_map, files, *args, **kwargs)
+
+    monkeypatch.setattr(collectiongain, "analyze_gain", analyze_gain)
+    albums = {
+        album: ["{}/0.flac".format(album), "{}/1.flac".format(album)]
+        for album in ["a", "b"]
+    }
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        for album_id, album_files in albums.items():
+            for path in album_files:
+                files[path] = (album_id, 0, False)
+        collectiongain.do_gain_all(music_dir, albums, [], files, jobs=1)
+        assert files["a/0.flac"].processed
+        assert not files["b/0.flac"].processed
+        assert transform_cache(files)[0] == {"b": albums["b"]}
+
+
+def test_do_gain_all_skips_tagged_files(monkeypatch, tmpdir, music_dir,
+                                        capsys):
+    def analyze_gain(formats_map, files, *args, **kwargs):
+        raise RuntimeError("analyzed %s" % files)
+
+    albums = {"a": ["a/0.flac", "a/1.flac"], "b": ["b/0.flac", "b/1.flac"]}
+    formats_map = rgio.BaseFormatsMap()
+    for path in albums["a"]:
+        formats_map.write_gain(os.path.join(music_dir, path),
+                               GainData(-1.0), GainData(-2.0))
+    monkeypatch.setattr(collectiongain, "analyze_gain", analyze_gain)
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        for album_id, album_files in albums.items():
+            for path in album_files:
+                files[path] = (album_id, 0, False)
+        collectiongain.do_gain_all(music_dir, albums, [], files, jobs=1,
+                                   read_jobs=2, write_jobs=2)
+        # the tags have been checked by the driver, so only the files
+        # without Replay Gain information got to the workers
+        assert files["a/0.flac"].processed
+        assert not files["b/0.flac"].processed
+        # the gain found in the tags is cached as well
+        assert files["a/0.flac"].track_gain == GainData(-1.0)
+        assert files["a/0.flac"].album_gain == GainData(-2.0)
+        assert files["a/0.flac"].analyzed is None
+    assert "1 successful, 1 failed." in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_do_collectiongain_shards(monkeypatch, tmpdir, stream_dir, stream):
+    monkeypatch.setattr(collectiongain, "analyze_gain", _fake_analyze_gain)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    shard_files = []
+    for k in (1, 2):
+        collectiongain.do_collectiongain(stream_dir, jobs=1, stream=stream,
+                                         shard=(k, 2))
+        shard_files.append(collectiongain.cache_paths(stream_dir, (k, 2))[0])
+        with Cache(shard_files[-1]) as files:
+            # every shard knows all files, but only processes its own
+            assert len(files) == 7
+            processed = sum(record.processed for _, record in files.items())
+            assert 0 < processed < 7
+
+    collectiongain.merge_caches(stream_dir, shard_files)
+    with Cache(collectiongain.cache_paths(stream_dir)[0]) as files:
+        assert all(record.processed for _, record in files.items())
+
+
+def test_cache_report():
+    report = collectiongain.CacheReport()
+    for record in [
+        CacheEntry("A", 1, True, track_gain=GainData(-2.2, 0.5),
+                   album_gain=GainData(-3.0, 1.1), analyzed=200.0),
+        CacheEntry("A", 1, True, track_gain=GainData(-3.6, 1.1),
+                   album_gain=GainData(-3.0, 1.1), analyzed=100.0),
+        CacheEntry("B", 1, True, track_gain=GainData(5.0, 0.2, 83)),
+        CacheEntry("B", 1, False),
+        CacheEntry(None, 1, True),
+        CacheEntry(None, 1, True, analyzed=150.0),
+    ]:
+        report.add(record)
+    result = report.as_dict()
+    assert result["files"] == 6
+    assert result["unprocessed"] == 1
+    assert result["no_gain"] == 1
+    assert result["not_recorded"] == 1
+    assert result["analyzed"] == 3
+    assert (result["first_analyzed"], result["last_analyzed"]) == (100, 200)
+    assert (result["albums"], result["album_gain"]) == (2, 1)
+    assert result["track_peak_full_scale"] == 1
+    assert result["album_peak_full_scale"] == [{"album": "A", "peak": 1.1}]
+    assert result["ref_levels"] == {"83": 1, "89": 2}
+    # 78, 91.2 and 92.6 dB
+    assert [(bin["from"], bin["tracks"]) for bin in result["loudness"]] == [
+        (float(i), {78: 1, 91: 1, 92: 1}.get(i, 0)) for i in range(78, 93)]
+    text = report.format()
+    assert "  A: +0.83 dBFS" in text
+    assert "   91.0 -  92.0 dB:      1 " in text
+
+
+def test_report_cache(monkeypatch, tmpdir, stream_dir, capsys):
+    monkeypatch.setattr(collectiongain, "analyze_gain", _fake_analyze_gain)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    with pytest.raises(collectiongain.Error):
+        collectiongain.report_cache(stream_dir)
+
+    before = time.time()
+    collectiongain.do_collectiongain(stream_dir, jobs=1)
+    with Cache(collectiongain.cache_paths(stream_dir)[0]) as files:
+        record = files["x/album/1.flac"]
+        # like tags, the cache doesn't keep the type of the gain
+        assert record.track_gain == GainData(-1.0, 0.5)
+        assert record.album_gain == GainData(-2.0, 0.5)
+        assert before <= record.analyzed <= time.time()
+    capsys.readouterr()
+
+    # the report doesn't need the music directory
+    shutil.rmtree(stream_dir)
+    collectiongain.report_cache(stream_dir, output_format="json")
+    result = json.loads(capsys.readouterr().out)
+    assert result["files"] == result["track_gain"] == result["analyzed"] == 7
+    assert result["album_peak_full_scale"] == []
+    assert result["ref_levels"] == {"89": 7}
+    assert result["loudness"] == [{"from": 90.0, "to": 91.0, "tracks": 7}]
+
+
+def test_report_cache_old_version(monkeypatch, tmpdir, capsys):
+    monkeypatch.setenv("HOME", str(tmpdir))
+    cache_file = collectiongain.cache_paths("music")[0]
+    os.makedirs(os.path.dirname(cache_file))
+    conn = sqlite3.connect(cache_file)
+    conn.execute("CREATE TABLE files (path BLOB PRIMARY KEY)")
+    conn.execute("INSERT INTO files VALUES (x'00')")
+    conn.execute("PRAGMA user_version = 5")
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(collectiongain.Error) as exc_info:
+        collectiongain.report_cache("music")
+    assert "cache version 5 is not supported" in str(exc_info.value)
+    # the cache is left alone
+    conn = sqlite3.connect(cache_file)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 5
+    assert conn.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 1
+    conn.close()
+
+
+def test_report_migrated_pickle_cache(monkeypatch, tmpdir, capsys):
+    monkeypatch.setenv("HOME", str(tmpdir))
+    cache_file, pickle_file = collectiongain.cache_paths("music")
+    os.makedirs(os.path.dirname(pickle_file))
+    with open(pickle_file, "wb") as f:
+        pickle.dump((1, {
+            "a/1.flac": ("A", 1.0, True),
+            "a/2.flac": ("A", 1.0, True),
+            "b.flac": (None, 1.0, False),
+        }), f, 2)
+    Cache(cache_file, pickle_file).close()
+    capsys.readouterr()
+
+    collectiongain.report_cache("music", output_format="json")
+    result = json.loads(capsys.readouterr().out)
+    assert result["files"] == 3
+    assert result["unprocessed"] == 1
+    # the gain of the processed files is unknown, not missing
+    assert result["not_recorded"] == 2
+    assert result["no_gain"] == 0
+
+
+@pytest.mark.parametrize("data,null,paths", [
+    (b"a/1.flac\nb/2.flac\n", False, ["a/1.flac", "b/2.flac"]),
+    (b"a/with\nnewline.flac\0b.flac\0", True,
+     ["a/with\nnewline.flac", "b.flac"]),
+])
+def test_read_change_list(data, null, paths):
+    assert collectiongain.read_change_list(io.BytesIO(data), null) == paths
+
+
+def test_change_list_jobs(tmpdir, stream_dir):
+    submitted = []
+    with Cache(str(tmpdir / "cache.sqlite")) as files:
+        files["gone/old.flac"] = CacheEntry(None, 0, True)
+        files["x/album/2.flac"] = CacheEntry("Test Album", 0, True)
+        dispatch = collectiongain.change_list_jobs(
+            stream_dir, files, lambda path: path.endswith(".flac"),
+            [os.path.join(stream_dir, "x/album/1.flac"), "y", "gone",
+             "../elsewhere.flac"])
+        dispatch(lambda tracks, album_id: submitted.append(
+            (sorted(tracks), album_id)))
+        span_id = files["y/span.flac"].album_id
+        # only the listed files have been read
+        assert sorted(files) == ["x/album/1.flac", "x/album/2.flac",
+                                 "y/1.flac", "y/2.flac", "y/span.flac"]
+
+    # the album is submitted with its other file from the cache
+    assert sorted(submitted, key=str) == sorted([
+        (["x/album/1.flac", "x/album/2.flac"], "Test Album"),
+        (["y/span.flac"], span_id),
+        (["y/1.flac"], None),
+        (["y/2.flac"], None),
+    ], key=str)
+
+
+def test_do_collectiongain_changes(monkeypatch, tmpdir, stream_dir):
+    monkeypatch.setattr(collectiongain, "analyze_gain", _fake_analyze_gain)
+    monkeypatch.setenv("HOME", str(tmpdir))
+    collectiongain.do_collectiongain(stream_dir, jobs=1,
+                                     changes=["x/album", "z.flac"])
+    with Cache(collectiongain.cache_paths(stream_dir)[0]) as files:
+        assert sorted(files) == ["x/album/1.flac", "x/album/2.flac",
+                                 "z.flac"]
+        assert all(record.processed for _, record in files.items())
+    assert "replaygain_track_gain" in mutagen.File(
+        os.path.join(stream_dir, "z.flac"))
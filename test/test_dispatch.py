@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from rgain3.lib.dispatch import Dispatcher
+
+
+def _square(i):
+    return i * i
+
+
+def _die():
+    os._exit(1)
+
+
+def _produce(dispatcher, items, func=_square):
+    def run():
+        try:
+            for i in items:
+                dispatcher.submit(i, func, i)
+        except RuntimeError:
+            # the dispatcher has been shut down
+            pass
+        finally:
+            dispatcher.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_dispatcher():
+    with Dispatcher(jobs=2) as dispatcher:
+        _produce(dispatcher, range(50))
+        results = {key: future.result()
+                   for key, future in dispatcher.completed()}
+    assert results == {i: i * i for i in range(50)}
+
+
+def test_dispatcher_no_jobs():
+    with Dispatcher(jobs=1) as dispatcher:
+        dispatcher.close()
+        assert list(dispatcher.completed()) == []
+
+
+def test_dispatcher_backpressure():
+    submitted = []
+
+    def items():
+        for i in range(20):
+            submitted.append(i)
+            yield i
+
+    with Dispatcher(jobs=1, max_in_flight=3) as dispatcher:
+        _produce(dispatcher, items())
+        completed = dispatcher.completed()
+        next(completed)
+        time.sleep(0.2)
+        # one job consumed, three in flight, one waiting for a free slot
+        assert len(submitted) == 5
+        assert len(list(completed)) == 19
+
+
+def test_dispatcher_broken_pool():
+    with Dispatcher(jobs=1) as dispatcher:
+        dispatcher.submit("die", _die)
+        key, future = next(dispatcher.completed())
+        assert key == "die"
+        with pytest.raises(BrokenProcessPool):
+            future.result()
+        # a new pool takes over
+        dispatcher.submit(3, _square, 3)
+        dispatcher.close()
+        assert [f.result() for _, f in dispatcher.completed()] == [9]
+
+
+@pytest.mark.skipif(
+    "forkserver" not in multiprocessing.get_all_start_methods(),
+    reason="needs the forkserver start method")
+def test_dispatcher_broken_pool_not_forked():
+    with Dispatcher(jobs=1, max_in_flight=1) as dispatcher:
+        dispatcher.submit("parent", os.getppid)
+        assert next(dispatcher.completed())[1].result() == os.getpid()
+        dispatcher.submit("die", _die)
+        next(dispatcher.completed())
+        # other threads are running by now, so the new pool isn't forked
+        # from this process
+        dispatcher.submit("parent", os.getppid)
+        assert next(dispatcher.completed())[1].result() != os.getpid()
+
+
+def test_dispatcher_shutdown_wakes_producer():
+    dispatcher = Dispatcher(jobs=1, max_in_flight=1)
+    thread = _produce(dispatcher, range(10))
+    time.sleep(0.1)
+    dispatcher.shutdown(cancel=True)
+    thread.join(5)
+    assert not thread.is_alive()
+    with pytest.raises(RuntimeError):
+        dispatcher.submit(1, _square, 1)
+
+
+def _pids(dispatcher, count):
+    pids = []
+    for i in range(count):
+        dispatcher.submit(i, os.getpid)
+        _, future = next(dispatcher.completed())
+        pids.append(future.result())
+    return pids
+
+
+def test_dispatcher_max_jobs_per_worker():
+    with Dispatcher(jobs=1, max_in_flight=1,
+                    max_jobs_per_worker=2) as dispatcher:
+        pids = _pids(dispatcher, 6)
+        dispatcher.close()
+        stats = dispatcher.worker_stats()
+    assert pids[0] == pids[1] != pids[2] == pids[3] != pids[4] == pids[5]
+    assert [s.pid for s in stats] == sorted(set(pids))
+    assert [s.jobs for s in stats] == [2, 2, 2]
+
+
+def test_dispatcher_max_worker_rss():
+    # every worker exceeds that
+    with Dispatcher(jobs=1, max_in_flight=1, max_worker_rss=1) as dispatcher:
+        pids = _pids(dispatcher, 3)
+        dispatcher.close()
+        stats = dispatcher.worker_stats()
+    assert len(set(pids)) == 3
+    assert all(s.peak_rss >= s.rss > 1 for s in stats)
+
+
+def test_dispatcher_job_error():
+    with Dispatcher(jobs=1) as dispatcher:
+        dispatcher.submit("error", _square, None)
+        dispatcher.close()
+        (key, future), = dispatcher.completed()
+    with pytest.raises(TypeError):
+        future.result()
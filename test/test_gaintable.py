@@ -0,0 +1,74 @@
+import pickle
+import random
+
+import pytest
+
+from rgain3.lib import GainData, GainType
+from rgain3.lib.rgio import clamp_gain_data, gaindata_almost_equal
+
+np = pytest.importorskip("numpy")
+
+from rgain3.lib.gaintable import GainTable  # noqa isort:skip
+
+
+def _random_gaindata(rnd):
+    if rnd.random() < 0.1:
+        return None
+    return GainData(
+        rnd.uniform(-80, 80), rnd.uniform(0, 2.5), rnd.choice([83, 89]),
+        rnd.choice(list(GainType)))
+
+
+def test_roundtrip():
+    items = [
+        ("a.flac", GainData(-1.5, 0.5, 89, GainType.TP_TRACK)),
+        ("b.flac", None),
+        ("c.flac", GainData(3.0, 1.2, 83, GainType.TP_ALBUM)),
+    ]
+    table = GainTable.from_gaindata(items)
+    assert len(table) == 3
+    assert "b.flac" in table
+    for path, gaindata in items:
+        assert table[path] == gaindata
+
+    copy = pickle.loads(pickle.dumps(table))
+    for path, gaindata in items:
+        assert copy[path] == gaindata
+
+    taken = table.take(["c.flac", "a.flac"])
+    assert len(taken) == 2
+    assert taken["c.flac"] == items[2][1]
+
+
+def test_almost_equal_matches_scalar_version():
+    rnd = random.Random(42)
+    a_items, b_items = [], []
+    for i in range(500):
+        a = _random_gaindata(rnd)
+        choice = rnd.random()
+        if a is None or choice < 0.3:
+            b = _random_gaindata(rnd)
+        elif choice < 0.6:
+            # legacy values are clamped
+            b = clamp_gain_data(a)
+        else:
+            b = GainData(a.gain + rnd.uniform(-0.2, 0.2),
+                         a.peak + rnd.uniform(-0.002, 0.002),
+                         a.ref_level)
+        a_items.append((str(i), a))
+        b_items.append((str(i), b))
+
+    result = GainTable.from_gaindata(a_items).almost_equal(
+        GainTable.from_gaindata(b_items))
+    expected = [
+        gaindata_almost_equal(a, b)
+        for (_, a), (_, b) in zip(a_items, b_items)
+    ]
+    assert result.tolist() == expected
+
+
+def test_almost_equal_length_mismatch():
+    a = GainTable.from_gaindata([("a", None)])
+    b = GainTable.from_gaindata([])
+    with pytest.raises(ValueError):
+        a.almost_equal(b)
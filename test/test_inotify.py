@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+from rgain3.lib.inotify import CHANGED, REMOVED, Change, TreeWatcher
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"),
+                                reason="inotify is Linux only")
+
+
+def _changes(watcher, count):
+    # the events of a few file operations may arrive in several reads
+    changes = []
+    while len(changes) < count:
+        new = watcher.changes(5)
+        assert new, "timed out with %r" % changes
+        changes.extend(new)
+    return changes
+
+
+def _write(path, data=b"x"):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_tree_watcher(tmpdir):
+    top = str(tmpdir / "music")
+    os.makedirs(os.path.join(top, "a", "b"))
+    outside = str(tmpdir / "outside")
+    os.makedirs(os.path.join(outside, "c"))
+    _write(os.path.join(outside, "c", "1.flac"))
+
+    with TreeWatcher(top) as watcher:
+        # files in subdirectories are written...
+        _write(os.path.join(top, "a", "b", "1.flac"))
+        assert _changes(watcher, 1) == [Change(CHANGED, "a/b/1.flac")]
+        os.rename(os.path.join(top, "a", "b", "1.flac"),
+                  os.path.join(top, "a", "2.flac"))
+        assert _changes(watcher, 2) == [
+            Change(REMOVED, "a/b/1.flac"), Change(CHANGED, "a/2.flac")]
+
+        # ... whole directories are moved in, along with their files...
+        shutil.move(outside, os.path.join(top, "new"))
+        assert _changes(watcher, 1) == [Change(CHANGED, "new/c/1.flac")]
+        _write(os.path.join(top, "new", "c", "2.flac"))
+        assert _changes(watcher, 1) == [Change(CHANGED, "new/c/2.flac")]
+
+        # ... or moved away and removed
+        shutil.move(os.path.join(top, "new"), outside)
+        assert _changes(watcher, 1) == [Change(REMOVED, "new")]
+        _write(os.path.join(outside, "c", "3.flac"))
+        os.remove(os.path.join(top, "a", "2.flac"))
+        assert _changes(watcher, 1) == [Change(REMOVED, "a/2.flac")]
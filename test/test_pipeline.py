@@ -0,0 +1,76 @@
+
+import pytest
+
+from rgain3.lib import GainData
+from rgain3.lib.pipeline import TagWriter, write_album
+from rgain3.lib.rgio import BaseFormatsMap
+
+
+@pytest.mark.parametrize("atomic", [False, True])
+def test_write_album(tmpdir, album_copies, atomic):
+    format_map = BaseFormatsMap()
+    filenames = album_copies(2)
+    missing = str(tmpdir / "missing.flac")
+    items = [(f, GainData(-1.0), GainData(-2.0)) for f in filenames]
+
+    assert write_album(format_map, items, atomic) == []
+    errors = write_album(
+        format_map, items + [(missing, GainData(-1.0), None)], atomic)
+    assert [r.filename for r in errors] == [missing]
+    assert isinstance(errors[0].error, FileNotFoundError)
+
+
+def test_tag_writer(album_copies):
+    format_map = BaseFormatsMap()
+    filenames = album_copies(4)
+    done = []
+
+    with TagWriter(format_map, depth=1) as writer:
+        for i, filename in enumerate(filenames):
+            writer.submit(
+                [(filename, GainData(-i), GainData(-5.0))],
+                lambda errors, filename=filename: done.append(
+                    (filename, errors)))
+
+    # albums are written in order
+    assert done == [(filename, []) for filename in filenames]
+    for i, result in enumerate(format_map.read_gain_many(filenames)):
+        trackdata, albumdata = result.result
+        assert trackdata.gain == -i
+        assert albumdata.gain == -5.0
+
+
+def test_tag_writer_error(tmpdir):
+    format_map = BaseFormatsMap()
+    missing = str(tmpdir / "missing.flac")
+    writer = TagWriter(format_map)
+    writer.submit([(missing, GainData(-1.0), None)])
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+
+
+def test_tag_writer_callback_error(album_copies):
+    format_map = BaseFormatsMap()
+    filenames = album_copies(1)
+
+    def done(errors):
+        raise RuntimeError("callback failed")
+
+    writer = TagWriter(format_map)
+    writer.submit([(filenames[0], GainData(-1.0), None)], done)
+    with pytest.raises(RuntimeError, match="callback failed"):
+        writer.close()
+
+
+def test_tag_writer_threads(album_copies):
+    format_map = BaseFormatsMap()
+    filenames = album_copies(6)
+    done = []
+
+    with TagWriter(format_map, depth=2, threads=3) as writer:
+        for filename in filenames:
+            writer.submit([(filename, GainData(-1.0), None)],
+                          lambda errors, filename=filename: done.append(
+                              (filename, errors)))
+
+    assert sorted(done) == [(filename, []) for filename in filenames]
@@ -0,0 +1,146 @@
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import pytest
+
+from rgain3.lib.remote import RemoteDispatcher, WorkerLost, run_worker
+
+AUTHKEY = b"secret"
+
+
+def _square(i):
+    return i * i
+
+
+def _fail():
+    raise ValueError("nope")
+
+
+def _start_workers(address, n, authkey=AUTHKEY):
+    # threads stand in for the worker processes on other hosts
+    counts = []
+    threads = [threading.Thread(
+        target=lambda: counts.append(run_worker(address, authkey, 5)),
+        daemon=True) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads, counts
+
+
+def test_remote_dispatcher():
+    with RemoteDispatcher(("127.0.0.1", 0), AUTHKEY) as dispatcher:
+        threads, counts = _start_workers(dispatcher.address, 3)
+        for i in range(30):
+            dispatcher.submit(i, _square, i)
+        dispatcher.close()
+        results = {key: future.result()
+                   for key, future in dispatcher.completed()}
+        for thread in threads:
+            thread.join(5)
+    assert results == {i: i * i for i in range(30)}
+    # every worker was told to stop, and all jobs ran exactly once
+    assert len(counts) == 3
+    assert sum(counts) == 30
+
+
+def test_remote_dispatcher_job_error():
+    with RemoteDispatcher(("127.0.0.1", 0), AUTHKEY) as dispatcher:
+        _start_workers(dispatcher.address, 1)
+        dispatcher.submit("fail", _fail)
+        dispatcher.submit("square", _square, 2)
+        dispatcher.close()
+        results = dict(dispatcher.completed())
+    with pytest.raises(ValueError, match="nope"):
+        results["fail"].result()
+    assert results["square"].result() == 4
+
+
+def test_remote_dispatcher_worker_lost():
+    with RemoteDispatcher(("127.0.0.1", 0), AUTHKEY) as dispatcher:
+        # a worker process dying takes its connection down
+        dispatcher.submit("die", os._exit, 1)
+        worker = multiprocessing.get_context("fork").Process(
+            target=run_worker, args=(dispatcher.address, AUTHKEY, 5))
+        worker.start()
+        key, future = next(dispatcher.completed())
+        worker.join()
+        assert key == "die"
+        with pytest.raises(WorkerLost):
+            future.result()
+        # another worker takes over
+        _start_workers(dispatcher.address, 1)
+        dispatcher.submit(3, _square, 3)
+        dispatcher.close()
+        assert [f.result() for _, f in dispatcher.completed()] == [9]
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def _die_in_child(pid, started, go):
+    # dies once ``go`` exists, unless it runs in the process ``pid``
+    if os.getpid() == pid:
+        return "survived"
+    open(started, "w").close()
+    _wait_for(lambda: os.path.exists(go))
+    os._exit(1)
+
+
+def test_remote_dispatcher_worker_lost_mid_job(tmpdir):
+    started, go = str(tmpdir / "started"), str(tmpdir / "go")
+    with RemoteDispatcher(("127.0.0.1", 0), AUTHKEY) as dispatcher:
+        dispatcher.submit("job", _die_in_child, os.getpid(), started, go)
+        worker = multiprocessing.get_context("fork").Process(
+            target=run_worker, args=(dispatcher.address, AUTHKEY, 5))
+        worker.start()
+        _wait_for(lambda: os.path.exists(started))
+        _start_workers(dispatcher.address, 1)
+        _wait_for(lambda: dispatcher._workers == 2)
+        # the job of the worker which died goes to the other one
+        open(go, "w").close()
+        worker.join()
+        dispatcher.close()
+        (key, future), = dispatcher.completed()
+    assert future.result() == "survived"
+
+
+def test_remote_dispatcher_worker_timeout():
+    with RemoteDispatcher(("127.0.0.1", 0), AUTHKEY,
+                          worker_timeout=0.5) as dispatcher:
+        # a worker which hangs without sending heartbeats
+        hung = Client(dispatcher.address, authkey=AUTHKEY)
+        dispatcher.submit(3, _square, 3)
+        assert hung.recv() == (_square, (3,))
+        _start_workers(dispatcher.address, 1)
+        dispatcher.close()
+        assert [f.result() for _, f in dispatcher.completed()] == [9]
+        hung.close()
+
+
+def test_run_worker_heartbeats():
+    with RemoteDispatcher(("127.0.0.1", 0), AUTHKEY,
+                          worker_timeout=0.2) as dispatcher:
+        threading.Thread(
+            target=run_worker, args=(dispatcher.address, AUTHKEY, 5, 0.05),
+            daemon=True).start()
+        # the job takes longer than the timeout
+        dispatcher.submit("sleep", time.sleep, 0.6)
+        dispatcher.close()
+        (key, future), = dispatcher.completed()
+    assert future.result() is None
+
+
+def test_run_worker_wrong_authkey():
+    with RemoteDispatcher(("127.0.0.1", 0), AUTHKEY) as dispatcher:
+        with pytest.raises(AuthenticationError):
+            run_worker(dispatcher.address, b"wrong", 5)
+        dispatcher.close()
+        assert list(dispatcher.completed()) == []
@@ -0,0 +1,230 @@
+import csv
+import io
+import json
+
+import pytest
+
+from rgain3 import Error, replaygain
+from rgain3.lib import GainData, GainType
+from rgain3.lib.rgio import BaseFormatsMap, TagResult
+
+
+def _fake_calculate_gain(fail_at=None):
+    calls = []
+
+    def calculate_gain(files, ref_level, on_track=None):
+        calls.append(list(files))
+        tracks_data = {}
+        for i, filename in enumerate(files):
+            if i == fail_at:
+                raise RuntimeError("decoding failed")
+            tracks_data[filename] = GainData(
+                -1.0 - i, 0.5, ref_level, GainType.TP_TRACK)
+            if on_track is not None:
+                on_track(filename, tracks_data[filename])
+        return tracks_data, GainData(-4.0, 0.75, ref_level,
+                                     GainType.TP_ALBUM)
+
+    calculate_gain.calls = calls
+    return calculate_gain
+
+
+def _read(filenames):
+    return [r.result for r in BaseFormatsMap().read_gain_many(filenames)]
+
+
+@pytest.mark.parametrize("atomic", [False, True])
+def test_do_gain_album(monkeypatch, album_copies, atomic):
+    fake = _fake_calculate_gain()
+    monkeypatch.setattr(replaygain, "calculate_gain", fake)
+    filenames = album_copies(3)
+
+    replaygain.do_gain(filenames, atomic=atomic)
+    for i, (trackdata, albumdata) in enumerate(_read(filenames)):
+        assert trackdata.gain == -1.0 - i
+        assert albumdata.gain == -4.0
+
+    # everything is up to date now
+    replaygain.do_gain(filenames)
+    assert len(fake.calls) == 1
+
+
+def test_do_gain_dry_run(monkeypatch, album_copies):
+    monkeypatch.setattr(replaygain, "calculate_gain", _fake_calculate_gain())
+    filenames = album_copies(2)
+    replaygain.do_gain(filenames, dry_run=True)
+    assert _read(filenames) == [(None, None)] * 2
+
+
+def test_do_gain_album_error(monkeypatch, album_copies):
+    monkeypatch.setattr(replaygain, "calculate_gain",
+                        _fake_calculate_gain(fail_at=1))
+    filenames = album_copies(3)
+    with pytest.raises(Error, match="decoding failed"):
+        replaygain.do_gain(filenames)
+    # nothing has been written
+    assert _read(filenames) == [(None, None)] * 3
+
+
+def test_do_gain_no_album(monkeypatch, album_copies):
+    monkeypatch.setattr(replaygain, "calculate_gain", _fake_calculate_gain())
+    filenames = album_copies(3)
+    replaygain.do_gain(filenames, album=False)
+    for i, (trackdata, albumdata) in enumerate(_read(filenames)):
+        assert trackdata.gain == -1.0 - i
+        assert albumdata is None
+
+
+def test_do_gain_no_album_error(monkeypatch, album_copies):
+    monkeypatch.setattr(replaygain, "calculate_gain",
+                        _fake_calculate_gain(fail_at=2))
+    filenames = album_copies(3)
+    with pytest.raises(Error, match="decoding failed"):
+        replaygain.do_gain(filenames, album=False)
+    # the tracks analyzed before the error have been written
+    results = _read(filenames)
+    assert [trackdata.gain for trackdata, _ in results[:2]] == [-1.0, -2.0]
+    assert results[2] == (None, None)
+
+
+@pytest.mark.parametrize("data,null,album,jobs", [
+    (b"a\nb\n\nc\n", False, True, [["a", "b"], ["c"]]),
+    (b"\n\na\n\n\nb", False, True, [["a"], ["b"]]),
+    (b"a\nb\n\nc\n", False, False, [["a"], ["b"], ["c"]]),
+    (b"a\nb\0\0c\0", True, True, [["a\nb"], ["c"]]),
+])
+def test_read_jobs(data, null, album, jobs):
+    assert list(replaygain.read_jobs(io.BytesIO(data), null, album)) == jobs
+
+
+def test_do_gain_jobs(monkeypatch, album_copies, capsys):
+    fake = _fake_calculate_gain()
+
+    def calculate_gain(files, ref_level, on_track=None):
+        if any(f.endswith("track3.flac") for f in files):
+            raise RuntimeError("decoding failed")
+        return fake(files, ref_level, on_track)
+
+    monkeypatch.setattr(replaygain, "calculate_gain", calculate_gain)
+    filenames = album_copies(4)
+    file_jobs = [filenames[:2], filenames[2:3], filenames[3:]]
+    assert replaygain.do_gain_jobs(iter(file_jobs), jobs=2) == 1
+
+    results = _read(filenames)
+    assert [albumdata.gain for _, albumdata in results[:3]] == [-4.0] * 3
+    assert results[3] == (None, None)
+    captured = capsys.readouterr()
+    assert "decoding failed" in captured.err
+    assert "3 jobs done, 1 failed." in captured.out
+
+
+def test_group_files(copy_audio):
+    album = copy_audio("x/1.flac", "y/2.flac", source="album-tag.flac")
+    singles = copy_audio("x/3.flac", "y/4.flac")
+    files = [album[0], singles[0], album[1], singles[1]]
+
+    assert replaygain.group_files(files) == [files]
+    assert replaygain.group_files(files, "dir") == [
+        [album[0], singles[0]], [album[1], singles[1]]]
+    # files without album tags are albums of their own
+    assert replaygain.group_files(files, "album") == [
+        album, [singles[0]], [singles[1]]]
+
+
+@pytest.fixture
+def shown_files(monkeypatch, album_copies):
+    # one file without Replay Gain, two with track and album gain
+    monkeypatch.setattr(replaygain, "calculate_gain", _fake_calculate_gain())
+    filenames = album_copies(3)
+    replaygain.do_gain(filenames[1:])
+    return filenames
+
+
+def test_show_rgain_info_jsonl(shown_files, capsys):
+    capsys.readouterr()
+    replaygain.show_rgain_info(iter(shown_files), output_format="jsonl",
+                               jobs=2)
+    records = {record["file"]: record for record in map(
+        json.loads, capsys.readouterr().out.splitlines())}
+    assert records[shown_files[0]] == {
+        "file": shown_files[0], "track": None, "album": None, "error": None}
+    assert records[shown_files[2]]["track"] == {
+        "gain": -2.0, "peak": 0.5, "ref_level": 89}
+    assert records[shown_files[2]]["album"]["gain"] == -4.0
+
+
+def test_show_rgain_info_csv(shown_files, capsys):
+    capsys.readouterr()
+    replaygain.show_rgain_info(shown_files, output_format="csv")
+    rows = list(csv.reader(io.StringIO(capsys.readouterr().out)))
+    assert tuple(rows[0]) == replaygain.CSV_FIELDS
+    assert sorted(rows[1:]) == [
+        [shown_files[0], "", "", "", "", "", ""],
+        [shown_files[1], "89", "-1.00", "0.50000000", "-4.00",
+         "0.75000000", ""],
+        [shown_files[2], "89", "-2.00", "0.50000000", "-4.00",
+         "0.75000000", ""],
+    ]
+
+
+def test_gain_summary():
+    summary = replaygain.GainSummary()
+    summary.add((None, None))
+    summary.add(None, OSError("unreadable"))
+    summary.add((GainData(3.0, 1.0, 89), GainData(-1.0, 0.8, 89)))
+    summary.add((GainData(-5.0, 0.9, 83), None))
+    result = summary.as_dict()
+    assert result["files"] == 4
+    assert result["unreadable"] == result["no_gain"] == 1
+    assert result["track_and_album"] == result["track_only"] == 1
+    assert result["track_peak_full_scale"] == 1
+    assert result["track_gain_clips"] == 1
+    assert result["album_gain_clips"] == 0
+    assert result["ref_levels"] == {"83": 1, "89": 1}
+    assert ("ref_level_89", 1) in summary.rows()
+    assert "  83 dB: 1" in summary.format()
+
+
+def test_show_rgain_info_summary(shown_files, capsys):
+    capsys.readouterr()
+    replaygain.show_rgain_info(shown_files, output_format="jsonl",
+                               summary=True)
+    result = json.loads(capsys.readouterr().out)
+    assert result["files"] == 3
+    assert result["no_gain"] == 1
+    assert result["track_and_album"] == 2
+
+
+def test_check_gain(monkeypatch, album_copies):
+    monkeypatch.setattr(replaygain, "calculate_gain", _fake_calculate_gain())
+    formats_map = BaseFormatsMap()
+    filenames = album_copies(3)
+    replaygain.do_gain(filenames[:2], album=False)
+
+    assert replaygain.check_gain(formats_map, filenames, album=False) == \
+        filenames[2:]
+    # album gain needs all tracks
+    assert replaygain.check_gain(formats_map, filenames) == filenames
+    replaygain.do_gain(filenames)
+    output = io.StringIO()
+    assert replaygain.check_gain(formats_map, filenames, file=output) == []
+    assert output.getvalue().count("track and album") == 3
+
+
+def test_analyze_gain_unsupported(tmpdir):
+    unsupported = str(tmpdir / "notes.txt")
+    with open(unsupported, "w") as f:
+        f.write("not audio")
+    assert replaygain.analyze_gain(BaseFormatsMap(), [unsupported]) is None
+
+
+def test_report_written(capsys):
+    items = [("a.flac", None, None), ("b.flac", None, None)]
+    replaygain.report_written(items, [])
+    assert capsys.readouterr().out == "  a.flac:done\n  b.flac:done\n"
+
+    failure = TagResult("b.flac", None, OSError("disk full"))
+    with pytest.raises(Error, match="b.flac: disk full"):
+        replaygain.report_written(items, [failure], atomic=True)
+    assert capsys.readouterr().out == \
+        "  a.flac:not modified\n  b.flac:failed\n"
@@ -0,0 +1,159 @@
+import io
+import json
+import os
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+import mutagen
+import pytest
+
+from rgain3 import replaygainctl, replaygaind
+from rgain3.lib import GainData, GainType
+from rgain3.lib.dispatch import Dispatcher
+from rgain3.replaygainctl import Client, format_result
+
+
+def _fake_analyze_gain(formats_map, files, ref_level=89, force=False,
+                       album=True, on_track=None):
+    if any("slow" in f for f in files):
+        time.sleep(1)
+    return (
+        {f: GainData(-1.0, 0.5, ref_level, GainType.TP_TRACK) for f in files},
+        GainData(-2.0, 0.5, ref_level, GainType.TP_ALBUM) if album else None,
+    )
+
+
+@pytest.fixture
+def daemon(monkeypatch, tmpdir):
+    monkeypatch.setattr(replaygaind, "analyze_gain", _fake_analyze_gain)
+
+    def start(jobs=1, max_queued=4):
+        # the workers are forked before any threads are started
+        dispatcher = Dispatcher(jobs)
+        started.append(replaygaind.Daemon(
+            str(tmpdir / "rgain.sock"), dispatcher, max_queued))
+        threading.Thread(target=started[-1].serve_forever,
+                         daemon=True).start()
+        return started[-1]
+
+    started = []
+    yield start
+    for d in started:
+        d.shutdown()
+
+
+def test_daemon_requests(daemon, copy_audio):
+    d = daemon()
+    files = copy_audio("1.flac", "2.flac")
+    with Client(d.socket_path) as client:
+        assert client.request("ping") == {"id": 1, "ok": True,
+                                          "result": "pong"}
+
+        response = client.request("analyze", files=files, ref_level=83)
+        assert response["ok"]
+        result = response["result"]
+        assert result["tracks"][files[0]] == {
+            "gain": -1.0, "peak": 0.5, "ref_level": 83}
+        assert result["album"]["gain"] == -2.0
+        assert result["written"] == []
+        assert "replaygain_track_gain" not in mutagen.File(files[0])
+        assert "Album gain -2.00 dB" in format_result(result)
+
+        response = client.request("gain", files=files, album=False)
+        assert response["result"]["album"] is None
+        assert response["result"]["written"] == files
+        assert "replaygain_track_gain" in mutagen.File(files[0])
+
+        status = client.request("status")["result"]
+        assert status["served"] == 2
+        assert status["pending"] == 0
+
+
+@pytest.mark.parametrize("request_line,error", [
+    (b"nonsense", "invalid request"),
+    (b'{"op": "explode"}', "op must be one of"),
+    (b'{"op": "gain", "files": []}', "non-empty list"),
+    (b'{"op": "gain", "files": ["relative.flac"]}', "absolute"),
+])
+def test_daemon_invalid_request(daemon, request_line, error):
+    d = daemon()
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(d.socket_path)
+        sock.sendall(request_line + b"\n")
+        response = json.loads(sock.makefile("rb").readline())
+    assert not response["ok"]
+    assert error in response["error"]
+
+
+def test_daemon_queue_full(daemon):
+    d = daemon(jobs=1, max_queued=1)
+    requests = [{"id": i, "op": "analyze", "files": ["/slow%i.flac" % i]}
+                for i in range(3)]
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(d.socket_path)
+        # pipelined: the responses come as soon as they're ready
+        sock.sendall(b"".join(
+            json.dumps(r).encode("utf-8") + b"\n" for r in requests))
+        lines = sock.makefile("rb")
+        responses = [json.loads(lines.readline()) for _ in requests]
+    assert responses[0] == {"id": 2, "ok": False, "error": "queue full"}
+    assert [r["id"] for r in responses[1:]] == [0, 1]
+    assert all(r["ok"] for r in responses[1:])
+
+
+def test_respond_client_gone():
+    # once a connection is finished, its stream is closed; a late response
+    # mustn't kill the thread sending it
+    handler = replaygaind._Handler.__new__(replaygaind._Handler)
+    handler.write_lock = threading.Lock()
+    handler.wfile = io.BytesIO()
+    handler.wfile.close()
+    handler.respond(1, "pong")
+
+
+def test_daemon_stale_socket(daemon, tmpdir):
+    path = tmpdir / "rgain.sock"
+    path.write("")
+    d = daemon()
+    with Client(d.socket_path) as client:
+        assert client.request("ping")["ok"]
+    with pytest.raises(OSError):
+        replaygaind.Daemon(str(path), None)
+
+
+def test_daemon_fallback_socket_dir(monkeypatch, tmpdir):
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+    path = replaygainctl.default_socket_path()
+    directory = tmpdir / ("replaygaind-%i" % os.getuid())
+    assert path == str(directory / "replaygaind.sock")
+    d = replaygaind.Daemon(path, Dispatcher(1))
+    threading.Thread(target=d.serve_forever, daemon=True).start()
+    try:
+        assert stat.S_IMODE(directory.stat().mode) == 0o700
+        with Client() as client:
+            assert client.request("ping")["ok"]
+    finally:
+        d.shutdown()
+
+
+def test_daemon_fallback_socket_dir_shared(monkeypatch, tmpdir):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+    directory = tmpdir / ("replaygaind-%i" % os.getuid())
+    directory.mkdir()
+    directory.chmod(0o777)
+    path = str(directory / "replaygaind.sock")
+    with pytest.raises(PermissionError):
+        replaygaind.Daemon(path, None)
+    assert not os.path.exists(path)
+
+
+def test_client_socket_of_other_user(daemon, monkeypatch):
+    d = daemon()
+    uid = os.getuid()
+    monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+    with pytest.raises(PermissionError):
+        Client(d.socket_path)
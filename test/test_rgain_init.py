@@ -1,3 +1,4 @@
+import pickle
 import unittest
 
 from rgain3.lib import GainData, GainType
@@ -51,3 +52,13 @@ class TestGainData(unittest.TestCase):
         self.assertNotEqual(gd1, gd3)
         self.assertNotEqual(gd1, gd4)
         self.assertNotEqual(gd3, gd4)
+
+    def test_slots(self):
+        gd = GainData(-1.2)
+        with self.assertRaises(AttributeError):
+            gd.foo = "bar"
+
+    def test_pickle(self):
+        gd = GainData(-1.2, 0.6, 88, GainType.TP_ALBUM)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(pickle.loads(pickle.dumps(gd, protocol)), gd)
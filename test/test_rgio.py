@@ -1,10 +1,14 @@
+import errno
 import os
+import shutil
 import unittest
 from pathlib import Path
 
 import pytest
 
+from rgain3.lib import GainData, rgio
 from rgain3.lib.rgio import (
+    AtomicWriteError,
     BaseFormatsMap,
     BaseTagReaderWriter,
     MP3DefaultTagReaderWriter,
@@ -84,3 +88,189 @@ def test_get_accessor_more_mappings(tmpdir):
 
     assert isinstance(format_map.accessor(str(path)), DummyMatroskaReaderWriter)
     assert format_map.is_supported(str(path)) is True
+
+
+def test_read_gain_many(tmpdir):
+    format_map = BaseFormatsMap()
+    missing = str(tmpdir / "missing.flac")
+    filenames = [
+        str(DATA_PATH / "no-tags.flac"),
+        missing,
+        str(DATA_PATH / "no-tags.mp3"),
+    ]
+    results = list(format_map.read_gain_many(filenames, jobs=2))
+    assert [r.filename for r in results] == filenames
+    assert results[0].result == (None, None)
+    assert results[0].error is None
+    assert results[1].result is None
+    assert isinstance(results[1].error, FileNotFoundError)
+    assert results[2].result == (None, None)
+
+
+def test_write_gain_many(album_copies):
+    format_map = BaseFormatsMap()
+    filenames = album_copies(4)
+
+    items = [
+        (filename, GainData(-i, 0.5), GainData(-1.0, 0.75))
+        for i, filename in enumerate(filenames)
+    ]
+    results = list(format_map.write_gain_many(items, jobs=3, ordered=False))
+    assert sorted(r.filename for r in results) == filenames
+    assert all(r.error is None for r in results)
+
+    for i, result in enumerate(format_map.read_gain_many(filenames)):
+        trackdata, albumdata = result.result
+        assert trackdata.gain == -i
+        assert trackdata.peak == 0.5
+        assert albumdata.gain == -1.0
+        assert albumdata.peak == 0.75
+
+
+@pytest.mark.parametrize("fsync", [False, True])
+def test_write_album_gain(tmpdir, album_copies, fsync):
+    format_map = BaseFormatsMap()
+    filenames = album_copies(3)
+    items = [(f, GainData(-2.0), GainData(-3.0)) for f in filenames]
+    format_map.write_album_gain(items, fsync=fsync)
+
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "track0.flac", "track1.flac", "track2.flac",
+    ]
+    for result in format_map.read_gain_many(filenames):
+        trackdata, albumdata = result.result
+        assert trackdata.gain == -2.0
+        assert albumdata.gain == -3.0
+
+
+def test_write_album_gain_rollback(tmpdir, album_copies):
+    format_map = BaseFormatsMap()
+    filenames = album_copies(2)
+    missing = str(tmpdir / "missing.flac")
+    items = [(f, GainData(-2.0), GainData(-3.0)) for f in filenames]
+    items.append((missing, GainData(-2.0), GainData(-3.0)))
+
+    with pytest.raises(AtomicWriteError) as exc_info:
+        format_map.write_album_gain(items)
+    assert [r.filename for r in exc_info.value.errors] == [missing]
+
+    # neither the original files nor the temporary copies were touched
+    assert sorted(os.listdir(str(tmpdir))) == ["track0.flac", "track1.flac"]
+    for result in format_map.read_gain_many(filenames):
+        assert result.result == (None, None)
+
+
+def _no_hard_links(monkeypatch):
+    def link(src, dst):
+        raise PermissionError(errno.EPERM, "Operation not permitted", dst)
+    monkeypatch.setattr(os, "link", link)
+
+
+def test_write_album_gain_without_hard_links(
+        tmpdir, album_copies, monkeypatch):
+    _no_hard_links(monkeypatch)
+    format_map = BaseFormatsMap()
+    filenames = album_copies(2)
+    format_map.write_album_gain(
+        [(f, GainData(-2.0), GainData(-3.0)) for f in filenames])
+
+    # the backups have been copies, which are gone as well
+    assert sorted(os.listdir(str(tmpdir))) == ["track0.flac", "track1.flac"]
+    for result in format_map.read_gain_many(filenames):
+        assert result.result[1].gain == -3.0
+
+
+@pytest.mark.parametrize("hard_links", [True, False])
+def test_write_album_gain_rename_rollback(
+        tmpdir, album_copies, monkeypatch, hard_links):
+    if not hard_links:
+        _no_hard_links(monkeypatch)
+    format_map = BaseFormatsMap()
+    filenames = album_copies(3)
+    with open(filenames[0], "rb") as f:
+        original = f.read()
+    items = [(f, GainData(-2.0), GainData(-3.0)) for f in filenames]
+
+    replace = os.replace
+    calls = []
+
+    def failing_replace(src, dst):
+        if dst in filenames:
+            calls.append(dst)
+        # the first file has been committed when the second rename fails
+        if len(calls) == 2:
+            raise PermissionError(13, "Permission denied", dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    with pytest.raises(AtomicWriteError) as exc_info:
+        format_map.write_album_gain(items)
+    assert [r.filename for r in exc_info.value.errors] == [filenames[1]]
+
+    # the committed file has been restored from its backup
+    with open(filenames[0], "rb") as f:
+        assert f.read() == original
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "track0.flac", "track1.flac", "track2.flac",
+    ]
+    for result in format_map.read_gain_many(filenames):
+        assert result.result == (None, None)
+
+
+@pytest.mark.parametrize("hard_links", [True, False])
+def test_write_album_gain_crash_during_renames(
+        tmpdir, album_copies, monkeypatch, hard_links):
+    if not hard_links:
+        _no_hard_links(monkeypatch)
+    format_map = BaseFormatsMap()
+    filenames = album_copies(3)
+    format_map.write_album_gain(
+        [(f, GainData(-2.0), GainData(-3.0)) for f in filenames])
+
+    replace = os.replace
+    calls = []
+
+    def crashing_replace(src, dst):
+        if dst in filenames:
+            calls.append(dst)
+        # the process dies after the first file has been replaced
+        if len(calls) == 2:
+            raise SystemExit(1)
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", crashing_replace)
+    with pytest.raises(SystemExit):
+        format_map.write_album_gain(
+            [(f, GainData(-4.0), GainData(-5.0)) for f in filenames])
+    monkeypatch.setattr(os, "replace", replace)
+    albumgains = [result.result[1].gain
+                  for result in format_map.read_gain_many(filenames)]
+    assert albumgains == [-5.0, -3.0, -3.0]
+
+    # the next run restores the replaced file instead of keeping the album
+    # half updated
+    for filename in filenames:
+        rgio._remove_leftovers(filename)
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "track0.flac", "track1.flac", "track2.flac",
+    ]
+    albumgains = [result.result[1].gain
+                  for result in format_map.read_gain_many(filenames)]
+    assert albumgains == [-3.0, -3.0, -3.0]
+
+
+def test_write_album_gain_removes_leftovers(tmpdir, album_copies):
+    format_map = BaseFormatsMap()
+    filename, = album_copies(1)
+    # the temporary copy and backup of a write that crashed
+    leftovers = [
+        str(tmpdir / ".track0.flac.abcd.rgain3-tmp.flac"),
+        str(tmpdir / ".track0.flac.abcd.rgain3-tmp.flac.orig"),
+    ]
+    for leftover in leftovers:
+        shutil.copy(filename, leftover)
+        assert rgio.is_staged_file(leftover)
+    assert not rgio.is_staged_file(filename)
+
+    format_map.write_album_gain([(filename, GainData(-2.0), None)])
+    assert os.listdir(str(tmpdir)) == ["track0.flac"]
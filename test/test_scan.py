@@ -0,0 +1,114 @@
+import os
+
+import pytest
+
+from rgain3.lib.scan import SkippedDir, SubtreeDone, scan_tree
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * 16)
+
+
+def test_scan_tree(tmpdir):
+    root = str(tmpdir / "music")
+    expected = [
+        "a.flac",
+        os.path.join("artist", "album", "1.flac"),
+        os.path.join("artist", "album", "2.flac"),
+        os.path.join("artist", "other", "cd1", "1.mp3"),
+        os.path.join("x", "y", "z", "deep.ogg"),
+    ]
+    for path in expected:
+        _touch(os.path.join(root, path))
+    os.makedirs(os.path.join(root, "empty"))
+
+    entries = list(scan_tree(root, jobs=3))
+    assert sorted(e.relpath for e in entries) == sorted(expected)
+    for entry in entries:
+        assert entry.path == os.path.join(root, entry.relpath)
+        assert entry.stat.st_size == 16
+
+
+def test_scan_tree_symlinks(tmpdir):
+    root = str(tmpdir / "music")
+    _touch(os.path.join(root, "album", "1.flac"))
+    _touch(str(tmpdir / "elsewhere" / "2.flac"))
+    # links to files are followed, links to directories are not
+    os.symlink(str(tmpdir / "elsewhere" / "2.flac"),
+               os.path.join(root, "link.flac"))
+    os.symlink(str(tmpdir / "elsewhere"), os.path.join(root, "linkdir"))
+    os.symlink(str(tmpdir / "missing.flac"), os.path.join(root, "broken"))
+
+    entries = list(scan_tree(root))
+    assert sorted(e.relpath for e in entries) == [
+        os.path.join("album", "1.flac"), "link.flac",
+    ]
+
+
+def test_scan_tree_missing_root(tmpdir):
+    assert list(scan_tree(str(tmpdir / "missing"))) == []
+
+
+class _Dirs(dict):
+    def get_dir(self, reldir):
+        return self.get(reldir)
+
+    def set_dir(self, reldir, record):
+        self[reldir] = record
+
+
+def test_scan_tree_fast(tmpdir):
+    root = str(tmpdir / "music")
+    for path in ["a.flac", "album/1.flac", "album/cd1/1.flac", "other/1.ogg"]:
+        _touch(os.path.join(root, path))
+
+    dirs = _Dirs()
+    entries = list(scan_tree(root, dirs=dirs))
+    assert len(entries) == 4
+    assert sorted(dirs) == ["", "album", os.path.join("album", "cd1"),
+                            "other"]
+    assert dirs["album"].subdirs == ["cd1"]
+
+    # nothing changed, so no directory is read
+    entries = list(scan_tree(root, dirs=dirs, fast=True))
+    assert sorted(entries) == sorted(
+        SkippedDir(reldir) for reldir in dirs)
+
+    # adding a file changes the directory's modification time
+    _touch(os.path.join(root, "album", "cd1", "2.flac"))
+    os.utime(os.path.join(root, "album", "cd1"), ns=(0, 0))
+    entries = list(scan_tree(root, dirs=dirs, fast=True))
+    assert sorted(
+        e.relpath for e in entries if not isinstance(e, SkippedDir)
+    ) == [os.path.join("album", "cd1", "1.flac"),
+          os.path.join("album", "cd1", "2.flac")]
+    assert dirs[os.path.join("album", "cd1")].subdirs == []
+
+
+def test_scan_tree_fast_needs_dirs(tmpdir):
+    with pytest.raises(ValueError):
+        list(scan_tree(str(tmpdir), fast=True))
+
+
+def test_scan_tree_subtrees(tmpdir):
+    root = str(tmpdir / "music")
+    for path in ["a.flac", "x/1.flac", "x/y/1.flac", "x/y/z/1.flac", "w/1"]:
+        _touch(os.path.join(root, path))
+
+    seen = set()
+    for entry in scan_tree(root, jobs=4, subtrees=True):
+        if isinstance(entry, SubtreeDone):
+            # all files below the directory have been yielded
+            assert not any(
+                os.path.join(root, dirpath, name)
+                for dirpath, _, names in os.walk(
+                    os.path.join(root, entry.reldir))
+                for name in names
+                if os.path.join(root, dirpath, name) not in seen)
+            seen.add(entry.reldir)
+        else:
+            seen.add(entry.path)
+    assert {"", "x", os.path.join("x", "y"), os.path.join("x", "y", "z"),
+            "w"} <= seen
@@ -0,0 +1,77 @@
+import pytest
+
+from rgain3.lib.schedule import (
+    DEFAULT_LENGTH,
+    estimate_costs,
+    in_shard,
+    plan_jobs,
+    select_shard,
+)
+
+
+def test_estimate_costs():
+    costs = estimate_costs([
+        ("a.flac", 200.0, 20000000),
+        ("b.flac", 100.0, 5000000),
+        # estimated from the average bit rate of the others
+        ("c.flac", None, 1000000),
+        ("d.flac", None, None),
+    ])
+    assert costs["a.flac"] == 200.0
+    assert costs["b.flac"] == 100.0
+    assert costs["c.flac"] == pytest.approx(12.0)
+    assert costs["d.flac"] == DEFAULT_LENGTH
+
+
+def test_estimate_costs_nothing_known():
+    costs = estimate_costs([("a.flac", None, 32000)])
+    assert costs["a.flac"] == pytest.approx(1.0)
+
+
+def test_plan_jobs_longest_first():
+    albums = {
+        "short": ["s1", "s2"],
+        "box set": ["b%i" % i for i in range(10)],
+        "medium": ["m1", "m2", "m3"],
+    }
+    costs = {path: 100.0 for tracks in albums.values() for path in tracks}
+    assert plan_jobs(albums, [], costs, 2) == [
+        (albums["box set"], "box set"),
+        (albums["medium"], "medium"),
+        (albums["short"], "short"),
+    ]
+
+
+def test_plan_jobs_splits_single_tracks():
+    single_tracks = ["t%03i" % i for i in range(100)]
+    costs = {path: 10.0 + i for i, path in enumerate(single_tracks)}
+    jobs = plan_jobs({"album": ["a1"]}, single_tracks, costs, 4)
+
+    chunks = [tracks for tracks, album_id in jobs if album_id is None]
+    assert len(chunks) == 16
+    assert sorted(path for tracks in chunks for path in tracks) == \
+        single_tracks
+    chunk_costs = [sum(costs[path] for path in tracks) for tracks in chunks]
+    assert max(chunk_costs) - min(chunk_costs) <= max(costs.values())
+    assert chunk_costs == sorted(chunk_costs, reverse=True)
+
+
+def test_plan_jobs_few_single_tracks():
+    jobs = plan_jobs({}, ["t1"], {"t1": 1.0}, 8)
+    assert jobs == [(["t1"], None)]
+
+
+def test_select_shard():
+    albums = {"album %i" % i: ["%i/1.flac" % i] for i in range(30)}
+    singles = ["single%i.flac" % i for i in range(30)]
+    shards = [select_shard(albums, singles, (k, 3)) for k in (1, 2, 3)]
+
+    # every job is in exactly one shard, and not all in the same one
+    assert sorted(a for s, _ in shards for a in s) == sorted(albums)
+    assert sorted(p for _, s in shards for p in s) == sorted(singles)
+    assert all(s and t for s, t in shards)
+    # the assignment only depends on the job itself
+    assert select_shard({"album 0": []}, [], (1, 3))[0] == (
+        {"album 0": []} if "album 0" in shards[0][0] else {})
+    assert in_shard("album 0", (1, 1))
+    assert select_shard(albums, singles, None) == (albums, singles)
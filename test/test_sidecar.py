@@ -0,0 +1,115 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from rgain3.lib import GainData
+from rgain3.lib.rgio import AtomicWriteError, UnknownFiletype
+from rgain3.lib.sidecar import SidecarFormatsMap, SQLiteTagReaderWriter
+
+
+@pytest.fixture
+def audio_file(copy_audio):
+    return copy_audio("track.flac")[0]
+
+
+def test_read_write(tmpdir, audio_file):
+    rw = SQLiteTagReaderWriter(str(tmpdir / "db" / "gain.db"))
+    with open(audio_file, "rb") as f:
+        content = f.read()
+
+    assert rw.read_gain(audio_file) == (None, None)
+    rw.write_gain(audio_file, GainData(-1.5, 0.5, 89), GainData(-2.5, 0.75))
+    assert rw.read_gain(audio_file) == (
+        GainData(-1.5, 0.5, 89), GainData(-2.5, 0.75, 89))
+
+    # writing only the track gain keeps the album gain
+    rw.write_gain(audio_file, GainData(-3.0, 0.25, 84), None)
+    assert rw.read_gain(audio_file) == (
+        GainData(-3.0, 0.25, 84), GainData(-2.5, 0.75, 84))
+
+    # the audio file itself is never modified
+    with open(audio_file, "rb") as f:
+        assert f.read() == content
+
+
+def test_stale_entry(tmpdir, audio_file):
+    rw = SQLiteTagReaderWriter(str(tmpdir / "gain.db"))
+    rw.write_gain(audio_file, GainData(-1.5), None)
+    st = os.stat(audio_file)
+    os.utime(audio_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert rw.read_gain(audio_file) == (None, None)
+
+
+def test_formats_map(tmpdir, audio_file):
+    formats_map = SidecarFormatsMap(str(tmpdir / "gain.db"))
+    assert formats_map.accessor(audio_file) is formats_map.sidecar
+
+    other = str(tmpdir / "other.flac")
+    shutil.copy(audio_file, other)
+    formats_map.write_album_gain([
+        (audio_file, GainData(-1.0), GainData(-2.0)),
+        (other, GainData(-3.0), GainData(-2.0)),
+    ])
+    results = list(formats_map.read_gain_many([audio_file, other]))
+    assert [r.result[0].gain for r in results] == [-1.0, -3.0]
+    assert [r.result[1].gain for r in results] == [-2.0, -2.0]
+
+
+def test_formats_map_atomic(tmpdir, audio_file):
+    formats_map = SidecarFormatsMap(str(tmpdir / "gain.db"))
+    unsupported = str(tmpdir / "file.xyz")
+    with open(unsupported, "wb") as fp:
+        fp.write(b"\0" * 64)
+
+    with pytest.raises(AtomicWriteError) as exc_info:
+        formats_map.write_album_gain([
+            (audio_file, GainData(-1.0), GainData(-2.0)),
+            (unsupported, GainData(-3.0), GainData(-2.0)),
+        ])
+    assert exc_info.value.errors[0].filename == unsupported
+    assert isinstance(exc_info.value.errors[0].error, UnknownFiletype)
+    assert formats_map.read_gain(audio_file) == (None, None)
+
+
+def test_formats_map_write_gain_many(tmpdir, audio_file, monkeypatch):
+    formats_map = SidecarFormatsMap(str(tmpdir / "gain.db"))
+    other = str(tmpdir / "other.flac")
+    shutil.copy(audio_file, other)
+    unsupported = str(tmpdir / "file.xyz")
+    with open(unsupported, "wb") as fp:
+        fp.write(b"\0" * 64)
+
+    calls = []
+    write_gain_many = formats_map.sidecar.write_gain_many
+    monkeypatch.setattr(
+        formats_map.sidecar, "write_gain_many",
+        lambda items: calls.append(1) or write_gain_many(items))
+
+    results = list(formats_map.write_gain_many([
+        (audio_file, GainData(-1.0), None),
+        (unsupported, GainData(-2.0), None),
+        (other, GainData(-3.0), None),
+    ]))
+    assert [r.filename for r in results] == [audio_file, unsupported, other]
+    assert results[0].error is None and results[2].error is None
+    assert isinstance(results[1].error, UnknownFiletype)
+    # one transaction for all supported files
+    assert calls == [1]
+    assert formats_map.read_gain(other)[0].gain == -3.0
+
+    with pytest.raises(UnknownFiletype):
+        formats_map.write_gain(unsupported, GainData(-2.0), None)
+
+
+def test_close(tmpdir, audio_file):
+    rw = SQLiteTagReaderWriter(str(tmpdir / "gain.db"))
+    rw.write_gain(audio_file, GainData(-1.5), None)
+    conn = rw._connection()
+    rw.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    # a closed instance opens a new connection when used again
+    assert rw.read_gain(audio_file)[0].gain == -1.5
+    rw.close()
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+# How long the commands which don't analyze audio may take, in seconds. It's
+# generous for slow machines; loading GStreamer and its plugin registry would
+# still blow it on a cold start.
+STARTUP_BUDGET = 2.0
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(*args):
+    # The best time of three runs and the modules imported by the last one.
+    best = None
+    for _ in range(3):
+        start = time.monotonic()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime"] + list(args), cwd=ROOT,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        elapsed = time.monotonic() - start
+        best = elapsed if best is None else min(best, elapsed)
+    modules = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in proc.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return best, modules
+
+
+@pytest.mark.parametrize("args", [
+    ["-m", "rgain3.replaygain", "--version"],
+    ["-m", "rgain3.replaygain", "--help"],
+    ["-m", "rgain3.collectiongain", "--help"],
+    ["-m", "rgain3.replaygainctl", "--help"],
+    ["-c", "import rgain3.lib.rgio, rgain3.replaygain"],
+])
+def test_startup_without_gstreamer(args):
+    elapsed, modules = _run(*args)
+    assert not [name for name in modules
+                if name == "gi" or name.startswith("gi.")]
+    assert elapsed < STARTUP_BUDGET
+
+
+def test_show_without_gstreamer(copy_audio):
+    filename = copy_audio("1.flac")[0]
+    elapsed, modules = _run("-m", "rgain3.replaygain", "--show", filename)
+    assert "gi" not in modules
+    assert elapsed < STARTUP_BUDGET
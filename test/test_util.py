@@ -1,10 +1,16 @@
 import os
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import pytest
 
-from rgain3.lib.util import extension_for_file, parse_db, parse_peak
+from rgain3.lib.util import (
+    bounded_map,
+    extension_for_file,
+    parse_db,
+    parse_peak,
+)
 
 
 @pytest.mark.parametrize("in_value,expected", [
@@ -61,3 +67,34 @@ def test_extension_for_file_fallback(tmpdir):
     with open(str(path), "wb") as fp:
         fp.write(os.urandom(1024))
     extension_for_file(str(path)) == "iso"
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_bounded_map(ordered):
+    def func(i):
+        if i % 3 == 0:
+            raise ValueError(i)
+        return i * 2
+
+    results = list(bounded_map(func, iter(range(20)), 4, ordered))
+    if ordered:
+        assert [item for item, _, _ in results] == list(range(20))
+    assert len(results) == 20
+    for item, result, exc in results:
+        if item % 3 == 0:
+            assert result is None
+            assert isinstance(exc, ValueError)
+        else:
+            assert result == item * 2
+            assert exc is None
+
+
+def test_bounded_map_executor():
+    with ProcessPoolExecutor(2) as executor:
+        results = list(bounded_map(abs, [-1, -2, "x"], 2, True, executor))
+        # the executor is left running
+        assert executor.submit(abs, -3).result() == 3
+    assert [(item, result) for item, result, _ in results] == [
+        (-1, 1), (-2, 2), ("x", None),
+    ]
+    assert isinstance(results[2][2], TypeError)